@@ -6,17 +6,18 @@ import sqlite3
 
 import sqlite_utils
 
+from agent import ActionRegistry, COST_FREE, COST_CHEAP, COST_EXPENSIVE
+from cursors import PAGE_SIZE, ResultCursor, parse_token, session_cursors
+from db_profiles import DB_PROFILE, connect
+from fts import TABLE_FTS, SEARCH_LIMIT, fts_table_name, search_fts, check_fts_indexes
+from join_views import check_join_views, join_view_help, join_view_links
+from observations import MAX_OBSERVATION_TOKENS, compact_observation, estimate_tokens
+from query_plan import check_query_plan
+from sampling import approximate_common_values, should_sample
+from semantic import SEMANTIC_SEARCH_LIMIT, vector_search
 
 DB_PATH = "example.db"
 
-# columns: useful for getting table columns. input 1: table name.
-ACTIONS = """
-tables: useful for getting the names of tables available. no input.
-schema: useful for looking at the schema of a database. input 1: table name.
-help: useful for getting helpful context about how to use tables and their columns. input 1: table name. (optional) input 2: column name.
-sql-query: useful for analyzing data and getting the top 5 results of a query. input 1: a valid sqlite sql query.
-"""
-
 DATA_HELP = {
     "users": {
         None: "profiles of individuals (sometimes called creators) who are seeking work, have worked on projects, or are looking to hire other people.",
@@ -111,6 +112,9 @@ DATA_HELP = {
     }
 }
 
+# the materialized join views (see join_views.py) get the same kind of help
+DATA_HELP.update(join_view_help(DATA_HELP))
+
 IGNORED_TABLES = [
     "ar_internal_metadata",
     "schema_migrations",
@@ -119,9 +123,32 @@ IGNORED_TABLES = [
 IGNORED_COLUMNS = []
 
 
-def load_db(path):
+# relationships between tables that aren't declared as foreign keys in
+# the database, but are described in DATA_HELP
+# (table, column, referenced table, referenced column)
+TABLE_LINKS = [
+    ("experiences", "creatorUserId", "users", "creatorUserId"),
+    ("jobs", "jobPosterId", "users", "creatorUserId"),
+    ("game_stats", "placeId", "games", "placeId"),
+    ("game_passes", "game_id", "games", "placeId"),
+] + join_view_links()
+# check the query plan of every sql-query before running it and refuse
+# ones that look too slow, see query_plan.check_query_plan
+CHECK_QUERY_PLANS = True
+# how long the DATA_HELP hints in the schema digest can be
+DIGEST_HINT_CHARS = 80
+
+# schema digests, built once per database and kept around for the life
+# of the process. keyed by the sqlite_utils.Database object
+_schema_digests = {}
+
+
+def load_db(path, profile=DB_PROFILE):
     assert os.path.exists(path), f"Database doesn't exist: {path}"
-    db = sqlite_utils.Database(path)
+    db = connect(path, profile=profile)
+    get_schema_digest(db)
+    check_fts_indexes(db, path)
+    check_join_views(db, path)
     return db
 
 
@@ -132,38 +159,165 @@ def clean_truncate(results, n=3):
     ]
 
 
-## ACTIONS
-def tables(db):
-    return [
+def page_observation(rows, cursor):
+    # a page of rows, and how to get the next one if there is one
+    if not cursor.has_more:
+        return rows
+    more_text = f"(there are more rows, use next-page with input {cursor.next_token()} to see them)"
+    table = compact_observation(
+        rows, max_tokens=MAX_OBSERVATION_TOKENS - estimate_tokens(more_text) - 1
+    )
+    return f"{table}\n{more_text}"
+
+
+def short_hint(text, max_chars=DIGEST_HINT_CHARS):
+    if not text:
+        return ""
+    # first sentence only, the rest is available via the help action
+    hint = re.split(r"(?<=[.!?])\s", text.strip(), maxsplit=1)[0]
+    if len(hint) > max_chars:
+        hint = f"{hint[:max_chars].rstrip()}..."
+    return hint
+
+
+def table_links(db, table_name, column_names):
+    links = []
+    for fk in db[table_name].foreign_keys:
+        links.append((fk.column, fk.other_table, fk.other_column))
+    for table, column, other_table, other_column in TABLE_LINKS:
+        link = (column, other_table, other_column)
+        if table == table_name and column in column_names and link not in links:
+            links.append(link)
+    return links
+
+
+def build_schema_digest(db):
+    """
+    Gather everything the schema, tables, columns and help actions need
+    about the database in one go, so those actions don't need to keep
+    going back to sqlite_master.
+    """
+    all_table_names = db.table_names()
+    table_names = [
         name
-        for name in db.table_names()
+        for name in all_table_names
         # game stats confuses the model
         if (
             "_fts" not in name
+            and not name.startswith("_")
+            and not name.startswith("sqlite_")
             and name not in IGNORED_TABLES
             and not name.endswith("_history")
         )
     ]
+    digest = {
+        "tables": table_names,
+        "columns": {},
+        "schemas": {},
+        "searchable": [
+            name
+            for name in TABLE_FTS
+            if fts_table_name(name) in all_table_names
+        ],
+    }
+    for table_name in table_names:
+        table = db[table_name]
+        table_help = DATA_HELP.get(table_name, {})
+        pks = table.pks
+        column_names = []
+        column_texts = []
+        for c in table.columns:
+            if c.name in IGNORED_COLUMNS:
+                continue
+            column_names.append(c.name)
+            column_text = f"{c.name} {c.type or 'TEXT'}"
+            if c.name in pks and c.name != "rowid":
+                column_text += " PK"
+            column_texts.append(column_text)
+        lines = [f"{table_name}({', '.join(column_texts)})"]
+        for column, other_table, other_column in table_links(db, table_name, column_names):
+            lines.append(f"FK {column} -> {other_table}.{other_column}")
+        hint = short_hint(table_help.get(None))
+        if hint:
+            lines.append(f"-- {hint}")
+        digest["columns"][table_name] = column_names
+        digest["schemas"][table_name] = "\n".join(lines)
+    return digest
+
+
+def get_schema_digest(db):
+    if db not in _schema_digests:
+        _schema_digests[db] = build_schema_digest(db)
+    return _schema_digests[db]
+
+
+def schema_digest_text(db):
+    """
+    The schema of every table, suitable for putting in the system
+    prompt so the model doesn't need to spend turns exploring.
+    """
+    digest = get_schema_digest(db)
+    return "\n".join([
+        digest["schemas"][table_name]
+        for table_name in digest["tables"]
+    ])
+
+
+def inject_schema_digest(prompt, db):
+    """
+    Add the schema digest to the end of the system instructions of a raw,
+    ChatML or OpenAI message list prompt.
+    """
+    schema_text = f"The database has the following tables:\n{schema_digest_text(db)}"
+    if isinstance(prompt, list):
+        for message in prompt:
+            if message["role"] == "system":
+                message["content"] = f"{message['content'].rstrip()}\n\n{schema_text}"
+                break
+        return prompt
+    if "<|im_start|>" in prompt:
+        before, after = prompt.split("<|im_end|>", 1)
+        return f"{before.rstrip()}\n\n{schema_text}\n<|im_end|>{after}"
+    if "Question:" in prompt:
+        before, after = prompt.split("Question:", 1)
+        return f"{before.rstrip()}\n\n{schema_text}\n\nQuestion:{after}"
+    return f"{schema_text}\n\n{prompt}"
 
 
+## ACTIONS
+ACTION_REGISTRY = ActionRegistry()
+
+
+@ACTION_REGISTRY.register(
+    "tables", cost=COST_FREE,
+    description="useful for getting the names of tables available. no input."
+)
+def tables(db):
+    return list(get_schema_digest(db)["tables"])
+
+
+@ACTION_REGISTRY.register(
+    "schema", arity=1, cost=COST_FREE,
+    description="useful for looking at the schema of a database. input 1: table name."
+)
 def schema(db, table_name):
     table_names = tables(db)
     if table_name not in table_names:
         return f"Error: Invalid table. Valid tables are: {table_names}"
-    return re.sub('\s+', ' ', db[table_name].schema)
+    return get_schema_digest(db)["schemas"][table_name]
 
 
 def columns(db, table_name):
     table_names = tables(db)
     if table_name not in table_names:
         return f"Error: Invalid table. Valid tables are: {table_names}"
-    return [
-        c.name
-        for c in db[table_name].columns
-        if c.name not in IGNORED_COLUMNS
-    ]
+    return list(get_schema_digest(db)["columns"][table_name])
 
 
+@ACTION_REGISTRY.register(
+    "help", arity=(1, 2), cost=COST_CHEAP,
+    description="useful for getting helpful context about how to use tables and their columns. input 1: table name. (optional) input 2: column name."
+)
 def help(db, *args):
     if not args:
         return "Error: The help action requires at least one argument"
@@ -175,27 +329,104 @@ def help(db, *args):
         available_tables = tables(db)
         return f"Error: The table {table_name} doesn't exist. Valid tables: {available_tables}"
     if column not in DATA_HELP[table_name]:
-        available_columns = [
-            c.name
-            for c in db[table_name].columns
-            if c.name not in IGNORED_COLUMNS
-        ]
+        available_columns = get_schema_digest(db)["columns"].get(table_name, [])
         return f"Error: The column {column} isn't in the {table_name} table. Valid columns: {available_columns}"
     help_text =  DATA_HELP[table_name][column]
     # table help requested
     if column is None:
         return help_text
-    # column help requested, add common values
+    # column help requested, add common values. on big tables these come
+    # from a random sample, since counting every row is slow
+    if should_sample(db, table_name):
+        estimate = approximate_common_values(db, table_name, column, limit=2)
+        common_values = ", ".join([f"{value}" for value, count, margin in estimate["values"]])
+        return f"{help_text} the approximate top two values (from a random sample of {estimate['sample_size']} rows) are: {common_values}"
     analysis = db[table_name].analyze_column(column, common_limit=2)
     common_values = ", ".join([f"{value}" for value, count in analysis.most_common])
     return f"{help_text} the top two values are: {common_values}"
 
 
-def sql_query(db, query):
+@ACTION_REGISTRY.register(
+    "sql-query", arity=1, cost=COST_EXPENSIVE, uses_session=True,
+    description="useful for analyzing data and getting the top 5 results of a query, use next-page to see more. input 1: a valid sqlite sql query."
+)
+def sql_query(db, query, session=None):
     if query.lower().startswith("select *"):
         return "Error: Select some specific columns, not *"
     try:
-        results = list(db.query(query))
+        if CHECK_QUERY_PLANS:
+            too_slow = check_query_plan(db, query)
+            if too_slow:
+                return too_slow
+        # only read as far as the first page (and one more row, to know
+        # if there's another page) instead of every result
+        if session is None:
+            cursor = ResultCursor(None, query, db.execute(query))
+        else:
+            cursor = session_cursors(session).execute(db, query)
+        rows = cursor.fetch_page(PAGE_SIZE)
     except sqlite3.OperationalError as e:
         return f"Your query has an error: {e}"
-    return clean_truncate(results, n=5)
+    # keep it open for next-page
+    if session is not None and cursor.has_more:
+        session_cursors(session).add(cursor)
+        return page_observation(rows, cursor)
+    cursor.close()
+    return rows
+
+
+@ACTION_REGISTRY.register(
+    "next-page", arity=1, cost=COST_CHEAP, uses_session=True,
+    description="useful for getting the next 5 results of a sql-query that had more. input 1: the page given with the sql-query results, like c1:2."
+)
+def next_page(db, token, session=None):
+    cursors = session_cursors(session if session is not None else {})
+    cursor_id, page = parse_token(token)
+    cursor = cursors.get(cursor_id)
+    if cursor is None:
+        open_tokens = cursors.open_tokens()
+        if not open_tokens:
+            return f"Error: {token} isn't open (anymore), run the sql-query again"
+        return f"Error: {token} isn't open (anymore). Pages you can get: {open_tokens}"
+    if page is not None and page != cursor.page + 1:
+        return f"Error: The next page of {cursor_id} is {cursor.next_token()}"
+    try:
+        rows = cursor.fetch_page(PAGE_SIZE)
+    except sqlite3.OperationalError as e:
+        cursors.remove(cursor_id)
+        return f"Your query has an error: {e}"
+    if not cursor.has_more:
+        cursors.remove(cursor_id)
+        if not rows:
+            return "There are no more rows"
+    return page_observation(rows, cursor)
+
+
+@ACTION_REGISTRY.register(
+    "search", arity=2, cost=COST_CHEAP,
+    description="a full-text search engine, much faster than using LIKE in a sql query. useful for finding records with text containing some words. input 1: table name, input 2: a search query."
+)
+def search(db, table_name, query):
+    searchable = get_schema_digest(db)["searchable"]
+    if table_name not in searchable:
+        return f"Error: Full-text search isn't available for {table_name}. Searchable tables: {searchable}"
+    try:
+        return search_fts(db, table_name, query, limit=SEARCH_LIMIT)
+    except sqlite3.OperationalError as e:
+        return f"Your search has an error: {e}"
+
+
+@ACTION_REGISTRY.register(
+    "semantic-search", arity=2, cost=COST_CHEAP,
+    description="finds records with text that is similar in meaning to the query, even when the words don't match. input 1: table name, input 2: a description of what to look for."
+)
+def semantic_search(db, table_name, query):
+    if table_name not in TABLE_FTS:
+        return f"Error: Semantic search isn't available for {table_name}. Searchable tables: {list(TABLE_FTS.keys())}"
+    results = vector_search(db, table_name, query, limit=SEMANTIC_SEARCH_LIMIT)
+    if results is None:
+        return f"Error: Semantic search hasn't been set up for {table_name}"
+    return results
+
+
+ACTIONS = ACTION_REGISTRY.describe()
@@ -0,0 +1,575 @@
+"""
+The ReAct loop that all of the agents share. A backend runs the model
+(local llama.cpp, OpenAI or the mock), an ActionRegistry holds the actions
+the model can use and hooks get a look at every action, so caching, budgets
+and instrumentation work the same way everywhere:
+
+    agent = Agent(LlamaBackend(llm), ACTION_REGISTRY, db)
+    final_answer, trace = agent.run(prompt)
+"""
+import json
+import re
+import time
+from abc import ABC, abstractmethod
+
+from loop_guard import (
+    LoopGuard, MAX_REPEATS, MAX_STALE_TURNS, STOP_FINAL_ANSWER,
+    STOP_THOUGHT_LOOP, STOP_WHITESPACE, STOP_TOKEN_LIMIT, STOP_CANCELLED
+)
+from mock_llm import MockLlama
+from observations import compact_observation
+from speculative import PromptLookupDecoding
+
+try:
+    import openai
+except ModuleNotFoundError:
+    print("openai not installed, continuing without")
+
+
+# how many tokens to allow the model to output in a sigle go w/o stopping
+MAX_TOKENS = 400
+STOP_SEQUENCES = ["Question:", "Observation:", "<|im_end|>", "<|im_start|>user"]
+# how often (in sqlite VM instructions) a running query checks if the
+# session's been cancelled
+CANCEL_CHECK_INSTRUCTIONS = 10000
+# a response with more thoughts than this is the model talking to itself
+MAX_THOUGHTS = 4
+MAX_SEQUENTIAL_WHITESPACE = 20
+STOP_MAX_TURNS = "max_turns"
+
+# what an action costs to run, roughly. free ones only look at metadata,
+# cheap ones read a handful of rows by index and expensive ones can end up
+# scanning whole tables
+COST_FREE = "free"
+COST_CHEAP = "cheap"
+COST_EXPENSIVE = "expensive"
+
+
+class Action:
+    def __init__(self, name, fn, arity=0, cost=COST_CHEAP, description=None,
+                 uses_session=False):
+        self.name = name
+        self.fn = fn
+        # number of Action Inputs, or (min, max) for optional ones
+        self.min_args, self.max_args = (
+            arity if isinstance(arity, tuple) else (arity, arity)
+        )
+        self.cost = cost
+        self.description = description
+        # actions that keep something between turns (like result cursors)
+        # get the session's state dict passed in as session=
+        self.uses_session = uses_session
+
+    def arity_error(self, n_args):
+        """
+        Something like "The action schema takes 1 Action Input but 2 were
+        given", or None if that's the right number of inputs.
+        """
+        if self.min_args <= n_args <= self.max_args:
+            return None
+        if self.min_args == self.max_args:
+            takes = f"{self.min_args}"
+        else:
+            takes = f"from {self.min_args} to {self.max_args}"
+        inputs = "Action Input" if self.max_args == 1 else "Action Inputs"
+        were = "was" if n_args == 1 else "were"
+        return f"The action {self.name} takes {takes} {inputs} but {n_args} {were} given"
+
+    def __call__(self, db, *args, session=None):
+        if self.uses_session:
+            return self.fn(db, *args, session=session)
+        return self.fn(db, *args)
+
+
+class ActionRegistry:
+    """
+    The actions an agent can use. Register them with the decorator:
+
+        @ACTION_REGISTRY.register("tables", cost=COST_FREE)
+        def tables(db):
+            ...
+    """
+
+    def __init__(self):
+        self.actions = {}
+
+    def register(self, name, arity=0, cost=COST_CHEAP, description=None,
+                 uses_session=False):
+        def decorator(fn):
+            self.actions[name] = Action(
+                name, fn, arity=arity, cost=cost, description=description,
+                uses_session=uses_session
+            )
+            return fn
+        return decorator
+
+    def names(self):
+        return list(self.actions.keys())
+
+    def describe(self):
+        # the tools list for a prompt
+        return "\n".join(
+            f"{a.name}: {a.description}"
+            for a in self.actions.values() if a.description
+        )
+
+    def __contains__(self, name):
+        return name in self.actions
+
+    def __getitem__(self, name):
+        return self.actions[name]
+
+
+def parse_action(response):
+    try:
+        return re.findall(r"Action: (.*)", response, re.M)[0].strip()
+    except IndexError:
+        return None
+
+
+def parse_final_answer(response):
+    try:
+        final_answer = re.findall(r'Final Answer: (.*)', response, re.M|re.S)[0]
+    except IndexError:
+        return None
+    return final_answer.replace("<|im_end|>", "").strip()
+
+
+def parse_action_inputs(response):
+    inputs = re.findall(r'Action Input (\d): ```([^`]+)```', response, re.M|re.S)
+    # try and recover inputs without backticks, with or without quotes
+    if not inputs:
+        inputs = re.findall(
+            r'Action Input (\d): (.+?)(?=\nAction Input \d:|\nThought:|\Z)',
+            response, re.S
+        )
+        inputs = [(n, re.sub(r'^"(.*)"$', r"\1", i.strip(), flags=re.S)) for n, i in inputs]
+    return [inp[1] for inp in inputs]
+
+
+class Hook:
+    """
+    Gets called around every action an agent runs. Hooks can answer an
+    action themselves (caching), refuse it (budgets), keep count of things
+    (instrumentation) or end the session by setting stop_reason.
+    loop_guard.LoopGuard works as one of these too.
+    """
+    stop_reason = None
+
+    def before_action(self, action, args):
+        # return an observation to use instead of running the action
+        return None
+
+    def after_action(self, action, args, observation_text, seconds):
+        pass
+
+    def stale_turn(self):
+        # a turn without a (new) action or an answer
+        pass
+
+    def stats(self):
+        # a dict to add to the session's return_dict
+        return {}
+
+
+class ActionTimer(Hook):
+    """
+    How many times each action ran and how long it took.
+    """
+
+    def __init__(self):
+        self.actions = {}
+
+    def after_action(self, action, args, observation_text, seconds):
+        timing = self.actions.setdefault(action.name, {
+            "cost": action.cost, "count": 0, "seconds": 0.0,
+        })
+        timing["count"] += 1
+        timing["seconds"] += seconds
+
+    def stats(self):
+        return {"action_stats": self.actions}
+
+
+class ActionBudget(Hook):
+    """
+    Limits how many actions of each cost class a session gets, e.g.
+    ActionBudget({COST_EXPENSIVE: 5}).
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.used = {}
+
+    def before_action(self, action, args):
+        limit = self.limits.get(action.cost)
+        if limit is None:
+            return None
+        if self.used.get(action.cost, 0) >= limit:
+            return (
+                f"You've used all {limit} of your {action.cost} actions. "
+                "Work with what you have or give your Final Answer."
+            )
+        self.used[action.cost] = self.used.get(action.cost, 0) + 1
+        return None
+
+
+class Backend(ABC):
+    """
+    Runs the model. generate() streams back the text of the next response
+    and the other methods grow the prompt, which is a string for
+    completion models.
+    """
+    # stop generating after this many tokens over the whole session
+    max_total_tokens = None
+
+    @abstractmethod
+    def generate(self, prompt):
+        pass
+
+    def add_response(self, prompt, response):
+        return f"{prompt}{response}".strip()
+
+    def add_observation(self, prompt, observation_text):
+        return f"""{prompt}
+Observation: {observation_text}
+Thought: """
+
+    def trace_text(self, prompt):
+        return prompt
+
+    def reset_stats(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class LlamaBackend(Backend):
+    def __init__(self, llm, max_tokens=MAX_TOKENS, stop=STOP_SEQUENCES,
+                 debug_log="debug.log"):
+        self.llm = llm
+        self.max_tokens = max_tokens
+        self.stop = stop
+        self.debug_log = debug_log
+        self.prompt_is_chatml = False
+
+    def generate(self, prompt):
+        self.prompt_is_chatml = "<|im_start|>" in prompt
+        stream = self.llm(
+            prompt,
+            max_tokens=self.max_tokens,
+            stop=self.stop,
+            stream=True,
+            echo=True
+        )
+        for i, token in enumerate(stream):
+            choice = token['choices'][0]
+            print(i, choice, end="\t\t\t\t\t\r")
+            if self.debug_log:
+                with open(self.debug_log, "a") as f:
+                    f.write(json.dumps(choice["text"]))
+                    f.write('\n')
+            yield choice["text"]
+
+    def add_response(self, prompt, response):
+        if self.prompt_is_chatml and not response.strip().endswith("<|im_end|>"):
+            response = f"{response.strip()}\n<|im_end|>\n"
+        return f"{prompt}{response}".strip()
+
+    def add_observation(self, prompt, observation_text):
+        if not self.prompt_is_chatml:
+            return super().add_observation(prompt, observation_text)
+        return f"""{prompt}
+<|im_start|>user
+Observation: {observation_text}
+<|im_end|>
+<|im_start|>assistant
+Thought: """
+
+    @property
+    def draft_model(self):
+        draft_model = getattr(self.llm, "draft_model", None)
+        if isinstance(draft_model, PromptLookupDecoding):
+            return draft_model
+
+    def reset_stats(self):
+        if self.draft_model:
+            self.draft_model.reset_stats()
+
+    def stats(self):
+        if not self.draft_model:
+            return {}
+        stats = self.draft_model.stats()
+        print("Prompt lookup decoding:", stats)
+        return {"draft_stats": stats}
+
+
+class MockBackend(LlamaBackend):
+    def __init__(self, script=None, **kwargs):
+        super().__init__(MockLlama(script=script), **kwargs)
+
+
+class OpenAIBackend(Backend):
+    # the prompt is a list of chat messages here
+    def __init__(self, model_name, temp=None, top_p=None,
+                 max_tokens=MAX_TOKENS, stop=STOP_SEQUENCES,
+                 max_total_tokens=None, debug_log="debug-openai.log"):
+        self.model_name = model_name
+        self.temp = temp
+        self.top_p = top_p
+        self.max_tokens = max_tokens
+        self.stop = stop
+        self.max_total_tokens = max_total_tokens
+        self.debug_log = debug_log
+
+    def create_stream(self, prompt):
+        model_kwargs = dict(
+            model=self.model_name,
+            # Up to 4 sequences where the API will stop generating
+            # further tokens. The returned text will not contain the
+            # stop sequence.
+            stop=self.stop,
+            stream=True,
+            messages=prompt,
+        )
+        # Open AI recommends not using BOTH temperature and top-p
+        if self.temp is not None:
+            model_kwargs["temperature"] = self.temp
+        elif self.top_p is not None:
+            model_kwargs["top_p"] = self.top_p
+        while True:
+            try:
+                return openai.ChatCompletion.create(**model_kwargs)
+            except openai.error.RateLimitError:
+                print("Cooling down...")
+                time.sleep(30)
+
+    def generate(self, prompt):
+        print("Running OpenAI model:", self.model_name)
+        print("Last prompt line:", json.dumps(prompt[-1], indent=2))
+        stream = self.create_stream(prompt)
+        with open(self.debug_log, "a") as f:
+            f.write(json.dumps(prompt))
+            f.write('\n')
+        for i, item in enumerate(stream):
+            if i > self.max_tokens:
+                break
+            choice = item["choices"][0]
+            print(i, json.dumps(choice), end="          \r")
+            # if it gives a non-assistant role, end
+            role = choice["delta"].get("role")
+            if role and role != "assistant":
+                break
+            # if it wants to stop (or hits a stopword) let it
+            if choice.get("finish_reason") == "stop":
+                break
+            with open(self.debug_log, "a") as f:
+                f.write(json.dumps(item))
+                f.write('\n')
+            yield choice["delta"].get("content", "")
+
+    def add_response(self, prompt, response):
+        return prompt + [{"role": "assistant", "content": response}]
+
+    def add_observation(self, prompt, observation_text):
+        return prompt + [{
+            "role": "user", "content": f"Observation: {observation_text}"
+        }]
+
+    def trace_text(self, prompt):
+        return json.dumps(prompt, indent=2)
+
+
+class Agent:
+    def __init__(self, backend, actions, db, hooks=None, max_turns=None,
+                 max_repeats=MAX_REPEATS, max_stale_turns=MAX_STALE_TURNS,
+                 budgets=None, fence_observations=True):
+        self.backend = backend
+        self.actions = actions
+        self.db = db
+        self.max_turns = max_turns
+        self.fence_observations = fence_observations
+        self.hooks = [
+            LoopGuard(max_repeats=max_repeats, max_stale_turns=max_stale_turns),
+            ActionTimer(),
+        ]
+        if budgets:
+            self.hooks.append(ActionBudget(budgets))
+        self.hooks.extend(hooks or [])
+        # things actions keep between turns, cleared for every run
+        self.session = {}
+
+    def close_session(self):
+        for value in self.session.values():
+            if hasattr(value, "close"):
+                value.close()
+        self.session = {}
+
+    def stale_turn(self):
+        for hook in self.hooks:
+            hook.stale_turn()
+
+    def run_action(self, action, args):
+        # before the hooks, a call that was never going to run shouldn't
+        # use up any budget. it still counts as a turn that got nowhere
+        arity_error = action.arity_error(len(args))
+        if arity_error:
+            self.stale_turn()
+            return arity_error
+        for hook in self.hooks:
+            observation_text = hook.before_action(action, args)
+            if observation_text is not None:
+                return observation_text
+        print("Running action", action.name, end="... \t")
+        start = time.time()
+        result = action(self.db, *args, session=self.session)
+        seconds = time.time() - start
+        print("Done!", end="\r")
+        observation_text = compact_observation(result)
+        if self.fence_observations:
+            observation_text = f"```{observation_text}```"
+        for hook in self.hooks:
+            hook.after_action(action, args, observation_text, seconds)
+        return observation_text
+
+    def write_trace(self, outfile, prompt):
+        # outfile is a path or something with a write() like a
+        # trace_store.TraceWriter
+        if not isinstance(outfile, str):
+            outfile.write(self.backend.trace_text(prompt))
+            return
+        with open(outfile, "w") as f:
+            f.write(self.backend.trace_text(prompt))
+
+    def run(self, prompt, outfile=None, debug=True, return_dict=None,
+            on_event=None, cancel=None):
+        """
+        Run a session until the model gives a final answer or gets stuck.
+        Returns the final answer (or None) and the trace, and fills in
+        return_dict with those, why the session stopped and any stats
+        from the backend and hooks. The trace in return_dict is kept up to
+        date after every turn.
+
+        Setting the cancel event (threading or multiprocessing) ends the
+        session early, interrupting any running query, but it still
+        finishes up normally with whatever it has so far.
+        """
+        if cancel is not None:
+            self.db.conn.set_progress_handler(
+                cancel.is_set, CANCEL_CHECK_INSTRUCTIONS
+            )
+        self.close_session()
+        try:
+            return self.run_session(
+                prompt, outfile=outfile, debug=debug, return_dict=return_dict,
+                on_event=on_event, cancel=cancel
+            )
+        finally:
+            self.close_session()
+            if cancel is not None:
+                self.db.conn.set_progress_handler(None, CANCEL_CHECK_INSTRUCTIONS)
+
+    def run_session(self, prompt, outfile=None, debug=True, return_dict=None,
+                    on_event=None, cancel=None):
+        def emit(event, data):
+            if on_event:
+                on_event(event, data)
+
+        self.backend.reset_stats()
+        if debug:
+            print(prompt)
+
+        final_answer = None
+        stop_reason = None
+        n_tokens = 0
+        n_turns = 0
+        n_sequential_whitespace = 0
+        while not stop_reason:
+            n_turns += 1
+            response = ""
+            for token in self.backend.generate(prompt):
+                response += token
+                n_tokens += 1
+                if token in ["", "\n"]:
+                    n_sequential_whitespace += 1
+                else:
+                    n_sequential_whitespace = 0
+                # detect repeating loop
+                if response.count("Thought: ") > MAX_THOUGHTS:
+                    stop_reason = STOP_THOUGHT_LOOP
+                elif n_sequential_whitespace > MAX_SEQUENTIAL_WHITESPACE:
+                    stop_reason = STOP_WHITESPACE
+                elif self.backend.max_total_tokens and n_tokens > self.backend.max_total_tokens:
+                    stop_reason = STOP_TOKEN_LIMIT
+                elif cancel is not None and cancel.is_set():
+                    stop_reason = STOP_CANCELLED
+                if stop_reason:
+                    break
+
+            prompt = self.backend.add_response(prompt, response)
+            if debug:
+                print(response)
+            emit("response", {"text": response})
+            if return_dict is not None:
+                return_dict["trace"] = prompt
+                return_dict["n_turns"] = n_turns
+            if outfile:
+                print("Writing to tracefile", outfile)
+                self.write_trace(outfile, prompt)
+            if stop_reason:
+                break
+
+            action_name = parse_action(response)
+            final_answer = parse_final_answer(response)
+            if action_name and action_name not in self.actions:
+                self.stale_turn()
+                observation_text = (
+                    "That's an invalid action. Valid actions: "
+                    + ", ".join(self.actions.names())
+                )
+                emit("observation", {
+                    "action": action_name, "args": [], "text": observation_text
+                })
+                prompt = self.backend.add_observation(prompt, observation_text)
+            elif action_name:
+                args = parse_action_inputs(response)
+                observation_text = self.run_action(self.actions[action_name], args)
+                emit("observation", {
+                    "action": action_name, "args": args, "text": observation_text
+                })
+                prompt = self.backend.add_observation(prompt, observation_text)
+            elif final_answer:
+                stop_reason = STOP_FINAL_ANSWER
+                emit("final_answer", {"text": final_answer})
+                break
+            else:
+                # no action and no answer, just thinking out loud
+                self.stale_turn()
+
+            for hook in self.hooks:
+                if hook.stop_reason:
+                    stop_reason = hook.stop_reason
+                    print("Ending stuck session:", stop_reason)
+                    break
+            if not stop_reason and self.max_turns and n_turns >= self.max_turns:
+                stop_reason = STOP_MAX_TURNS
+            if not stop_reason and cancel is not None and cancel.is_set():
+                stop_reason = STOP_CANCELLED
+
+            # TODO: truncate the prompt if its grown too long
+            # using tiktoken and some keep_n value of context
+
+        if stop_reason != STOP_FINAL_ANSWER:
+            final_answer = None
+            emit("stopped", {"stop_reason": stop_reason})
+        stats = self.backend.stats()
+        for hook in self.hooks:
+            stats.update(hook.stats())
+        emit("stats", stats)
+        if return_dict is not None:
+            return_dict["final_answer"] = final_answer
+            return_dict["trace"] = prompt
+            return_dict["stop_reason"] = stop_reason
+            return_dict.update(stats)
+        return final_answer, prompt
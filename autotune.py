@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+Find the llama.cpp settings (threads, batch size and context size) that
+run a model fastest on this machine, and save them to a profile that
+benchmark_runner.py and server.py use from then on:
+
+    python autotune.py ../models/mistral-7b-v0.1.Q5_K_M.gguf [--n-gpu-layers -1]
+
+The best thread count depends a lot on the model and the machine, e.g.
+decoding a 70B model is limited by memory bandwidth so more threads stop
+helping much sooner than with a 7B, so profiles are per model and per
+host. Prompt evaluation (prefill) and generation (decode) are tuned
+separately, since they usually want a different number of threads:
+
+1. thread counts, for both prefill and decode
+2. batch sizes, with the best threads
+3. context sizes (at least --min-ctx, which sessions need to fit), with
+   the best threads and batch size
+
+Each setting is timed on example-prompt.txt, the same kind of prompt
+the benchmarks use.
+"""
+import argparse
+import json
+import os
+import socket
+import time
+from datetime import datetime
+
+try:
+    import llama_cpp
+    from llama_cpp import Llama
+except ModuleNotFoundError:
+    print("llama_cpp not installed, continuing without")
+
+from llm_sql_queries import CONTEXT_SIZE
+
+
+PROFILES_DIR = "./profiles/"
+PROMPT_FILE = "example-prompt.txt"
+PROMPT_QUESTION = "Which games have the most visits and who built them?"
+# how many tokens to generate when timing decode
+DECODE_TOKENS = 64
+# each setting is timed this many times and the best run is kept
+REPEATS = 2
+BATCH_SIZES = [64, 128, 256, 512, 1024, 2048]
+# multiples of the minimum context size to try
+CTX_MULTIPLES = [1, 2]
+# settings within this much of the fastest count as just as fast, and
+# then the smallest one wins (fewer threads, less memory)
+TIE_MARGIN = 0.05
+
+
+def thread_counts(n_cpus=None):
+    n_cpus = n_cpus or os.cpu_count()
+    counts = {n_cpus, max(1, n_cpus - 1), max(1, n_cpus // 2)}
+    n = 1
+    while n < n_cpus:
+        counts.add(n)
+        n *= 2
+    return sorted(counts)
+
+
+def profile_path(model_path, profiles_dir=PROFILES_DIR):
+    return os.path.join(profiles_dir, os.path.basename(model_path) + ".json")
+
+
+def load_runtime_profile(model_path, profiles_dir=PROFILES_DIR, host=None):
+    """
+    The tuned load_model settings for this model on this host, or None
+    if it hasn't been tuned here.
+    """
+    path = profile_path(model_path, profiles_dir=profiles_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        profile = json.load(f)
+    host_profile = profile["hosts"].get(host or socket.gethostname())
+    if not host_profile:
+        return None
+    return host_profile["settings"]
+
+
+def save_runtime_profile(model_path, host_profile, profiles_dir=PROFILES_DIR,
+                         host=None):
+    path = profile_path(model_path, profiles_dir=profiles_dir)
+    os.makedirs(profiles_dir, exist_ok=True)
+    profile = {"model": os.path.basename(model_path), "hosts": {}}
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            profile = json.load(f)
+    profile["hosts"][host or socket.gethostname()] = host_profile
+    print("Writing runtime profile to", path)
+    with open(path, "w") as f:
+        f.write(json.dumps(profile, indent=2))
+    return path
+
+
+def load_prompt_tokens(llm, prompt_file=PROMPT_FILE, max_tokens=None):
+    with open(prompt_file, "r") as f:
+        prompt = f.read().format(question=PROMPT_QUESTION)
+    tokens = llm.tokenize(prompt.encode("utf-8"))
+    if max_tokens:
+        tokens = tokens[:max_tokens]
+    return tokens
+
+
+def set_threads(llm, n_threads, n_threads_batch):
+    # no need to reload the model to change threads
+    llama_cpp.llama_set_n_threads(llm._ctx.ctx, n_threads, n_threads_batch)
+
+
+def measure(llm, tokens, decode_tokens=DECODE_TOKENS, repeats=REPEATS):
+    """
+    Prefill and decode speed in tokens/sec, the best of repeats runs.
+    """
+    prefill_tps = 0
+    decode_tps = 0
+    for _ in range(repeats):
+        llm.reset()
+        start = time.perf_counter()
+        llm.eval(tokens)
+        prefill_tps = max(prefill_tps, len(tokens) / (time.perf_counter() - start))
+        start = time.perf_counter()
+        for _ in range(decode_tokens):
+            token = llm.sample(temp=0)
+            llm.eval([token])
+        decode_tps = max(decode_tps, decode_tokens / (time.perf_counter() - start))
+    return prefill_tps, decode_tps
+
+
+def pick(results, metric, lower_is_better=False, margin=TIE_MARGIN):
+    # results are in order from smallest setting to largest
+    values = [r[metric] for r in results]
+    if lower_is_better:
+        best = min(values)
+        return next(r for r in results if r[metric] <= best * (1 + margin))
+    best = max(values)
+    return next(r for r in results if r[metric] >= best * (1 - margin))
+
+
+def turn_seconds(n_prompt_tokens, prefill_tps, decode_tps,
+                 decode_tokens=DECODE_TOKENS):
+    # how long evaluating the prompt and writing a response takes, which
+    # is what a session turn costs
+    return n_prompt_tokens / prefill_tps + decode_tokens / decode_tps
+
+
+def autotune(model_path, n_gpu_layers=0, min_ctx=None, threads=None,
+             batch_sizes=BATCH_SIZES, decode_tokens=DECODE_TOKENS,
+             repeats=REPEATS, prompt_file=PROMPT_FILE):
+    """
+    Sweep the settings one at a time (threads, then batch size, then
+    context size), keeping the best of each for the next. Returns the
+    host profile: the best settings, how fast they were and everything
+    that was tried.
+    """
+    min_ctx = min_ctx or CONTEXT_SIZE
+    threads = sorted(threads or thread_counts())
+    sweep = []
+
+    def load(n_batch, n_ctx, n_threads, n_threads_batch):
+        return Llama(
+            model_path=model_path, n_gpu_layers=n_gpu_layers, n_ctx=n_ctx,
+            n_batch=n_batch, n_threads=n_threads,
+            n_threads_batch=n_threads_batch, verbose=False
+        )
+
+    def run(llm, tokens, settings):
+        prefill_tps, decode_tps = measure(
+            llm, tokens, decode_tokens=decode_tokens, repeats=repeats
+        )
+        result = dict(
+            settings, prefill_tps=prefill_tps, decode_tps=decode_tps,
+            turn_seconds=turn_seconds(len(tokens), prefill_tps, decode_tps, decode_tokens)
+        )
+        print(json.dumps(result))
+        sweep.append(result)
+        return result
+
+    best = {
+        "n_threads": max(threads), "n_threads_batch": max(threads),
+        "n_batch": 512, "n_ctx": min_ctx,
+    }
+    print("Loading model", model_path)
+    llm = load(**best)
+    tokens = load_prompt_tokens(
+        llm, prompt_file=prompt_file, max_tokens=min_ctx - decode_tokens
+    )
+    print("Timing", len(tokens), "prompt tokens and", decode_tokens, "generated tokens")
+
+    print("Tuning threads:", threads)
+    results = []
+    for n in threads:
+        set_threads(llm, n, n)
+        results.append(run(llm, tokens, dict(best, n_threads=n, n_threads_batch=n)))
+    best["n_threads"] = pick(results, "decode_tps")["n_threads"]
+    best["n_threads_batch"] = pick(results, "prefill_tps")["n_threads_batch"]
+    del llm
+
+    batch_sizes = sorted(b for b in batch_sizes if b <= min_ctx)
+    print("Tuning batch sizes:", batch_sizes)
+    results = []
+    for n_batch in batch_sizes:
+        llm = load(**dict(best, n_batch=n_batch))
+        results.append(run(llm, tokens, dict(best, n_batch=n_batch)))
+        del llm
+    best["n_batch"] = pick(results, "prefill_tps")["n_batch"]
+
+    ctx_sizes = [min_ctx * m for m in CTX_MULTIPLES]
+    print("Tuning context sizes:", ctx_sizes)
+    results = []
+    for n_ctx in ctx_sizes:
+        llm = load(**dict(best, n_ctx=n_ctx))
+        results.append(run(llm, tokens, dict(best, n_ctx=n_ctx)))
+        del llm
+    fastest = pick(results, "turn_seconds", lower_is_better=True)
+    best["n_ctx"] = fastest["n_ctx"]
+
+    return {
+        "settings": best,
+        "prefill_tps": fastest["prefill_tps"],
+        "decode_tps": fastest["decode_tps"],
+        "n_gpu_layers": n_gpu_layers,
+        "n_cpus": os.cpu_count(),
+        "tuned": datetime.now().isoformat(),
+        "sweep": sweep,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune llama.cpp settings for a model on this machine")
+    parser.add_argument("model_path")
+    parser.add_argument("--n-gpu-layers", type=int, default=0)
+    parser.add_argument("--min-ctx", type=int,
+                        help="Smallest context size to allow (default: llm_sql_queries.CONTEXT_SIZE)")
+    parser.add_argument("--threads", type=int, nargs="+",
+                        help="Thread counts to try (default: powers of two up to the number of CPUs)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=BATCH_SIZES)
+    parser.add_argument("--decode-tokens", type=int, default=DECODE_TOKENS)
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--profiles-dir", default=PROFILES_DIR)
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Print the best settings without saving them")
+    args = parser.parse_args()
+
+    host_profile = autotune(
+        args.model_path, n_gpu_layers=args.n_gpu_layers, min_ctx=args.min_ctx,
+        threads=args.threads, batch_sizes=args.batch_sizes,
+        decode_tokens=args.decode_tokens, repeats=args.repeats
+    )
+    print("Best settings:", json.dumps(host_profile["settings"]))
+    print(f"Prefill: {host_profile['prefill_tps']:.1f} tok/s, decode: {host_profile['decode_tps']:.1f} tok/s")
+    if not args.dry_run:
+        save_runtime_profile(args.model_path, host_profile, profiles_dir=args.profiles_dir)
@@ -0,0 +1,344 @@
+"""
+Serve several ReAct sessions from one loaded model. Each session gets its
+own sequence in a single llama.cpp context and the engine decodes the next
+token of every active session in one batch. A session that's off running
+a SQL action just doesn't have a request in, so it doesn't hold up the
+others.
+
+    engine = BatchedEngine(load_model(model_path), n_seq=4)
+    engine.start()
+    execute(model_path, prompt=prompt, llm=engine.session())
+"""
+import queue
+import threading
+
+import numpy as np
+
+try:
+    import llama_cpp
+except ModuleNotFoundError:
+    print("llama_cpp not installed, continuing without")
+
+
+# context size for each session's sequence
+SEQ_CONTEXT_SIZE = 2048 * 2
+N_SEQ = 4
+N_BATCH = 512
+
+
+def sample_token(logits, temp=None, top_p=None, rng=np.random):
+    """
+    Greedy when there's no temperature, otherwise temperature and
+    (optionally) nucleus sampling.
+    """
+    if not temp:
+        return int(np.argmax(logits))
+    logits = logits.astype(np.float64) / temp
+    probs = np.exp(logits - np.max(logits))
+    probs /= probs.sum()
+    if top_p is not None and top_p < 1.0:
+        order = np.argsort(-probs)
+        cumulative = np.cumsum(probs[order])
+        keep = order[:np.searchsorted(cumulative, top_p) + 1]
+        kept = np.zeros_like(probs)
+        kept[keep] = probs[keep]
+        probs = kept / kept.sum()
+    return int(rng.choice(len(probs), p=probs))
+
+
+class Request:
+    """
+    One completion: evaluate the prompt in a sequence and generate until
+    a stop string, EOS or max_tokens.
+    """
+
+    def __init__(self, session, prompt_tokens, max_tokens, stop, temp, top_p):
+        self.session = session
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.stop = [s for s in (stop or []) if s]
+        self.temp = temp
+        self.top_p = top_p
+        # prompt tokens that are in the KV cache so far
+        self.n_evaluated = 0
+        self.generated = []
+        self.text = ""
+        self.n_emitted = 0
+        self.finish_reason = None
+        # (text, finish_reason) chunks for the caller, None when finished
+        self.chunks = queue.Queue()
+
+    @property
+    def is_prefilling(self):
+        return self.n_evaluated < len(self.prompt_tokens)
+
+    def emit_text(self, final=False):
+        # hold back anything that could be the start of a stop string so
+        # we never stream out part of one
+        holdback = 0 if final else max([len(s) for s in self.stop] + [1]) - 1
+        end = max(self.n_emitted, len(self.text) - holdback)
+        if end > self.n_emitted:
+            self.chunks.put((self.text[self.n_emitted:end], None))
+            self.n_emitted = end
+
+
+class SequenceSession:
+    """
+    Looks enough like llama_cpp.Llama for llm_sql_queries.execute, but
+    runs its completions on one sequence of a BatchedEngine.
+    """
+
+    def __init__(self, engine, seq_id):
+        self.engine = engine
+        self.seq_id = seq_id
+        # tokens currently in this sequence's KV cache
+        self.tokens = []
+
+    def tokenize(self, text):
+        return self.engine.llm.tokenize(text.encode("utf-8"))
+
+    def __call__(self, prompt, max_tokens=400, stop=None, stream=False,
+                 echo=False, temperature=None, top_p=None, **kwargs):
+        request = self.engine.submit(
+            self, prompt, max_tokens=max_tokens, stop=stop,
+            temp=temperature if temperature is not None else self.engine.temp,
+            top_p=top_p if top_p is not None else self.engine.top_p,
+        )
+        if stream:
+            return self.stream(request)
+        text = "".join(chunk["choices"][0]["text"] for chunk in self.stream(request))
+        return {"choices": [{
+            "text": f"{prompt}{text}" if echo else text,
+            "finish_reason": request.finish_reason,
+        }]}
+
+    def stream(self, request):
+        while True:
+            item = request.chunks.get()
+            if item is None:
+                break
+            text, finish_reason = item
+            yield {"choices": [{"text": text, "finish_reason": finish_reason}]}
+
+    def close(self):
+        self.engine.release(self)
+
+
+class BatchedEngine:
+    def __init__(self, llm, n_seq=N_SEQ, seq_context_size=SEQ_CONTEXT_SIZE,
+                 n_batch=N_BATCH, temp=None, top_p=None):
+        self.llm = llm
+        self.n_seq = n_seq
+        self.seq_context_size = seq_context_size
+        self.n_batch = n_batch
+        self.temp = temp
+        self.top_p = top_p
+        self.n_vocab = llm.n_vocab()
+        self.token_eos = llm.token_eos()
+
+        # the Llama object's own context only allows one sequence, so make
+        # another one on the same (already loaded) model weights
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = seq_context_size * n_seq
+        params.n_batch = n_batch
+        params.n_seq_max = n_seq
+        params.n_threads = llm.context_params.n_threads
+        params.n_threads_batch = llm.context_params.n_threads_batch
+        params.logits_all = False
+        self.ctx = llama_cpp.llama_new_context_with_model(llm._model.model, params)
+        assert self.ctx, "Failed to create batched llama.cpp context"
+        self.batch = llama_cpp.llama_batch_init(n_batch, 0, n_seq)
+
+        self.free_seq_ids = list(range(n_seq))
+        self.seq_lock = threading.Lock()
+        self.incoming = queue.Queue()
+        self.active = []
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="BatchedEngine", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.incoming.put(None)
+        if self.thread:
+            self.thread.join()
+        llama_cpp.llama_batch_free(self.batch)
+        llama_cpp.llama_free(self.ctx)
+
+    def session(self):
+        """
+        Claim a free sequence for a new session. There are only n_seq of
+        them, so close() sessions when done with them.
+        """
+        with self.seq_lock:
+            assert self.free_seq_ids, f"All {self.n_seq} sequences are in use"
+            seq_id = self.free_seq_ids.pop(0)
+        return SequenceSession(self, seq_id)
+
+    def release(self, session):
+        # the KV cache is only touched from the engine thread
+        self.incoming.put(("release", session))
+
+    def clear_sequence(self, session):
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, session.seq_id, -1, -1)
+        session.tokens = []
+        with self.seq_lock:
+            self.free_seq_ids.append(session.seq_id)
+
+    def fork(self, prompt, n):
+        """
+        Evaluate a prompt once and copy its KV cache into n sessions, so
+        they can each generate from it without evaluating it again. With
+        sampling turned on they'll go their own ways from there.
+        """
+        sessions = [self.session() for _ in range(n)]
+        request = self.submit(sessions[0], prompt, max_tokens=0)
+        for _ in sessions[0].stream(request):
+            pass
+        done = threading.Event()
+        self.incoming.put(("fork", sessions[0], sessions[1:], done))
+        done.wait()
+        return sessions
+
+    def handle_command(self, command, session, *args):
+        if command == "release":
+            self.clear_sequence(session)
+        elif command == "fork":
+            targets, done = args
+            for target in targets:
+                llama_cpp.llama_kv_cache_seq_rm(self.ctx, target.seq_id, -1, -1)
+                llama_cpp.llama_kv_cache_seq_cp(
+                    self.ctx, session.seq_id, target.seq_id, -1, -1
+                )
+                target.tokens = list(session.tokens)
+            done.set()
+
+    def submit(self, session, prompt, max_tokens=400, stop=None, temp=None,
+               top_p=None):
+        prompt_tokens = session.tokenize(prompt)
+        request = Request(session, prompt_tokens, max_tokens, stop, temp, top_p)
+        self.incoming.put(request)
+        return request
+
+    def prepare(self, request):
+        """
+        Reuse whatever part of the prompt is already in the sequence's KV
+        cache (usually everything but the last observation) and drop the
+        rest.
+        """
+        session = request.session
+        n_common = 0
+        for a, b in zip(session.tokens, request.prompt_tokens):
+            if a != b:
+                break
+            n_common += 1
+        # always evaluate at least one token so we get logits to sample
+        n_common = max(0, min(n_common, len(request.prompt_tokens) - 1))
+        llama_cpp.llama_kv_cache_seq_rm(self.ctx, session.seq_id, n_common, -1)
+        session.tokens = session.tokens[:n_common]
+        request.n_evaluated = n_common
+
+    def finish(self, request, reason):
+        request.finish_reason = reason
+        for stop in request.stop:
+            if stop in request.text:
+                request.text = request.text.split(stop, 1)[0]
+        request.emit_text(final=True)
+        request.chunks.put(("", reason))
+        request.chunks.put(None)
+        self.active.remove(request)
+
+    def run(self):
+        while self.running:
+            # wait for work when idle, otherwise just pick up new requests
+            try:
+                while True:
+                    item = self.incoming.get(block=not self.active)
+                    if item is None:
+                        break
+                    if isinstance(item, tuple):
+                        self.handle_command(*item)
+                        continue
+                    self.prepare(item)
+                    self.active.append(item)
+            except queue.Empty:
+                pass
+            if not self.active:
+                continue
+            self.step()
+
+    def step(self):
+        """
+        Build one batch out of every active request (prompt chunks for
+        the ones still prefilling, the last sampled token for the rest),
+        decode it and sample the next token for each request.
+        """
+        n = 0
+        # batch index of the token whose logits we need, per request
+        logits_at = {}
+        # prefill only requests (see fork) that will be done after this
+        prefilled = []
+        for request in list(self.active):
+            session = request.session
+            if request.is_prefilling:
+                new_tokens = request.prompt_tokens[request.n_evaluated:]
+            else:
+                new_tokens = request.generated[-1:]
+            new_tokens = new_tokens[:self.n_batch - n]
+            if not new_tokens:
+                continue
+            if len(session.tokens) + len(new_tokens) > self.seq_context_size:
+                self.finish(request, "length")
+                continue
+            for token in new_tokens:
+                self.batch.token[n] = token
+                self.batch.pos[n] = len(session.tokens)
+                self.batch.n_seq_id[n] = 1
+                self.batch.seq_id[n][0] = session.seq_id
+                self.batch.logits[n] = False
+                session.tokens.append(token)
+                n += 1
+            if request.is_prefilling:
+                request.n_evaluated += len(new_tokens)
+            # only the last prompt token (or the new token) needs logits
+            if not request.is_prefilling and not request.max_tokens:
+                prefilled.append(request)
+            elif not request.is_prefilling:
+                self.batch.logits[n - 1] = True
+                logits_at[request] = n - 1
+            if n >= self.n_batch:
+                break
+        if not n:
+            return
+        self.batch.n_tokens = n
+        result = llama_cpp.llama_decode(self.ctx, self.batch)
+        if result != 0:
+            for request in list(self.active):
+                self.finish(request, "error")
+            return
+
+        for request in prefilled:
+            self.finish(request, "length")
+        for request, i in logits_at.items():
+            logits = np.ctypeslib.as_array(
+                llama_cpp.llama_get_logits_ith(self.ctx, i), shape=(self.n_vocab,)
+            )
+            token = sample_token(logits, temp=request.temp, top_p=request.top_p)
+            if token == self.token_eos:
+                self.finish(request, "stop")
+                continue
+            request.generated.append(token)
+            request.text = self.llm.detokenize(request.generated).decode(
+                "utf-8", errors="ignore"
+            )
+            if any(stop in request.text for stop in request.stop):
+                self.finish(request, "stop")
+            elif len(request.generated) >= request.max_tokens:
+                self.finish(request, "length")
+            else:
+                request.emit_text()
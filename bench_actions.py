@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Time every action against synthetic databases of increasing size, no
+LLM needed, to see how each one scales and whether a change to an
+action made it faster:
+
+    python bench_actions.py [--scales 10000 100000 1000000] [--report bench.json]
+
+Databases are generated with synthetic_db.py into ./bench/ the first
+time and reused after that. Each action is run once cold (first call on
+a fresh connection, so schema digests, row estimates, etc. aren't
+cached yet) and then REPEATS times warm. The report has the median and
+p95 of the warm runs at every scale, plus a scaling exponent for each
+action: how its time grows with the number of rows (0 means it doesn't,
+1 means linearly).
+"""
+import argparse
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+import actions
+import run_interface
+from db_profiles import connect
+from fts import check_fts_indexes
+from synthetic_db import generate, scale_name
+
+
+BENCH_DIR = "./bench/"
+SCALES = [10_000, 100_000, 1_000_000]
+REPEATS = 5
+# (registry, action name, action inputs). semantic-search is left out, it
+# needs spaCy and vector indexes
+BENCH_CASES = [
+    (actions.ACTION_REGISTRY, "tables", []),
+    (actions.ACTION_REGISTRY, "schema", ["users"]),
+    (actions.ACTION_REGISTRY, "help", ["jobs"]),
+    (actions.ACTION_REGISTRY, "help", ["jobs", "jobType"]),
+    (actions.ACTION_REGISTRY, "sql-query", ["select jobType, count(*) from jobs group by jobType"]),
+    (actions.ACTION_REGISTRY, "sql-query", ["select u.creatorUserId, count(*) from users u join experiences e on e.creatorUserId = u.creatorUserId group by 1 order by 2 desc limit 5"]),
+    (actions.ACTION_REGISTRY, "search", ["jobs", "scripter robux"]),
+    (run_interface.ACTION_REGISTRY, "columns", ["users"]),
+    (run_interface.ACTION_REGISTRY, "facets", ["jobs", "jobType"]),
+    (run_interface.ACTION_REGISTRY, "facets", ["users", "skillTypes"]),
+    (run_interface.ACTION_REGISTRY, "filter", ["jobs", "jobType", "FullTime"]),
+    (run_interface.ACTION_REGISTRY, "search", ["games", "pizza tycoon"]),
+]
+
+
+def case_name(registry, name, args):
+    module = "run_interface" if registry is run_interface.ACTION_REGISTRY else "actions"
+    return f"{module}.{name}({', '.join(repr(a) for a in args)})"
+
+
+def bench_db_path(rows, bench_dir=BENCH_DIR):
+    return os.path.join(bench_dir, f"synthetic_{scale_name(rows)}.db")
+
+
+def time_action(fn, db, args):
+    start = time.perf_counter()
+    fn(db, *args)
+    return time.perf_counter() - start
+
+
+def bench_scale(db_path, repeats=REPEATS):
+    # a fresh connection per scale, so the first call of each action is cold
+    db = connect(db_path)
+    check_fts_indexes(db, db_path)
+    results = {}
+    for registry, name, args in BENCH_CASES:
+        fn = registry[name].fn
+        cold = time_action(fn, db, args)
+        warm = [time_action(fn, db, args) for _ in range(repeats)]
+        results[case_name(registry, name, args)] = {
+            "cold": cold,
+            "median": float(np.median(warm)),
+            "p95": float(np.percentile(warm, 95)),
+        }
+    return results
+
+
+def scaling_exponent(rows, seconds):
+    """
+    Slope of log(time) against log(rows). Needs at least two scales.
+    """
+    points = [(math.log(r), math.log(s)) for r, s in zip(rows, seconds) if s > 0]
+    if len(points) < 2:
+        return None
+    x, y = zip(*points)
+    slope, _ = np.polyfit(x, y, 1)
+    return float(slope)
+
+
+def bench(scales=SCALES, repeats=REPEATS, bench_dir=BENCH_DIR, seed=0):
+    os.makedirs(bench_dir, exist_ok=True)
+    by_scale = {}
+    for rows in scales:
+        db_path = bench_db_path(rows, bench_dir=bench_dir)
+        if not os.path.exists(db_path):
+            generate(db_path, rows=rows, seed=seed)
+        print("Benchmarking actions on", db_path)
+        by_scale[rows] = bench_scale(db_path, repeats=repeats)
+
+    curves = {}
+    for case in by_scale[scales[0]]:
+        medians = [by_scale[rows][case]["median"] for rows in scales]
+        curves[case] = {
+            "rows": list(scales),
+            "median": medians,
+            "p95": [by_scale[rows][case]["p95"] for rows in scales],
+            "cold": [by_scale[rows][case]["cold"] for rows in scales],
+            "exponent": scaling_exponent(scales, medians),
+        }
+    return curves
+
+
+def scaling_report(curves, scales):
+    print("=" * 72)
+    header = "\t".join(scale_name(rows) for rows in scales)
+    print(f"{header}\texponent\taction (median ms)")
+    for case, curve in curves.items():
+        times = "\t".join(f"{m * 1000:.3f}" for m in curve["median"])
+        exponent = curve["exponent"]
+        exponent_text = f"{exponent:.2f}" if exponent is not None else "-"
+        print(f"{times}\t{exponent_text}\t\t{case}")
+    print("=" * 72)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the actions on synthetic databases")
+    parser.add_argument("--scales", type=int, nargs="+", default=SCALES,
+                        help="Total rows in each database")
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--bench-dir", default=BENCH_DIR)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    scales = sorted(args.scales)
+    curves = bench(scales, repeats=args.repeats, bench_dir=args.bench_dir, seed=args.seed)
+    scaling_report(curves, scales)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(json.dumps(curves, indent=2))
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 from datetime import datetime
 import copy
-import multiprocessing
 import json
+import multiprocessing
 import os
 import re
 import sys
@@ -19,12 +19,31 @@ try:
 except ImportError:
     from yaml import Loader, Dumper
 
-from metrics import get_keyword_matches
-from llm_sql_queries import execute
+from metrics import (
+    get_keyword_matches, majority_answer, confidence_interval
+)
+from llm_sql_queries import CONTEXT_SIZE, execute, execute_forked
 from llm_openai_sql_queries import execute as execute_openai
+from ipc import run_in_process
+from throttle import make_throttle
+from trace_store import TraceWriter
+from autotune import load_runtime_profile
+from gguf_info import model_info, kv_cache_bytes
+from loop_guard import MAX_REPEATS, MAX_STALE_TURNS
 
 
 USE_EXAMPLE_INJECTION = True
+# always run at least this many tries before early stopping can kick in
+EARLY_STOP_MIN_TRIES = 3
+# with PACK_WORKERS, run as many models at once as fit in this much of
+# the available memory (or MEMORY_BUDGET_GB)...
+MEMORY_BUDGET_FRACTION = 0.9
+# ...counting this much for llama.cpp's buffers on top of the weights and
+# KV cache...
+MODEL_OVERHEAD_BYTES = 512 * 1024 ** 2
+# ...and giving each its own CPU cores, this many unless the model has a
+# runtime profile (see autotune.py)
+CORES_PER_WORKER = 4
 # HACK: globals
 nlp = None
 stop_words = None
@@ -149,6 +168,18 @@ def get_model_name(model_file):
     return model_name
 
 
+def model_prompt_type(model_data):
+    # when the plan doesn't say, go by the model's chat template
+    if model_data.get("prompt_type"):
+        return model_data["prompt_type"]
+    model_path = model_data["path"]
+    if model_path.startswith("openai:"):
+        return "openai"
+    prompt_type = model_info(model_path)["prompt_type"]
+    print("Detected prompt_type", prompt_type, "for", model_path)
+    return prompt_type
+
+
 def get_tracefile(model_file):
     model_name = get_model_name(model_file)
     now=datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f")
@@ -157,30 +188,184 @@ def get_tracefile(model_file):
 
 
 def run_llm(*args, timeout=30*60, **kwargs):
-    # shared dict for transferring results back from the proc
-    manager = multiprocessing.Manager()
-    return_dict = manager.dict()
-    kwargs["return_dict"] = return_dict
-
     execute_fn = execute
     if args[0].startswith("openai:"):
         execute_fn = execute_openai
 
-    p = multiprocessing.Process(
-        target=execute_fn, name="LLM",
-        args=args, kwargs=kwargs
+    # streams back the session's state as it goes, so a timed out session
+    # still gives us its partial trace and stats. the trace is already in
+    # the tracefile, so don't bother sending it
+    result, timed_out = run_in_process(
+        execute_fn, *args, timeout=timeout, skip=("trace",), **kwargs
     )
-    p.start()
-    p.join(timeout)
-    if p.is_alive():
-        p.terminate()
-        p.join()
-        raise Exception(f"Timed out after {timeout}s")
+    if timed_out:
+        result["error"] = f"Timed out after {timeout}s"
+    if not result:
+        print("Blank result. Likely an error!")
 
-    if not return_dict:
-        print("Blank return_dict. Likely an error!")
+    # final_answer, trace, stop_reason, stats and maybe an error
+    return result
 
-    return return_dict.get("final_answer"), return_dict.get("trace")
+
+def run_llm_forked(*args, timeout=30*60, **kwargs):
+    # like run_llm, but for all of a question's tries at once, see
+    # llm_sql_queries.execute_forked
+    result, timed_out = run_in_process(
+        execute_forked, *args, timeout=timeout, **kwargs
+    )
+    if timed_out:
+        result["error"] = f"Timed out after {timeout}s"
+    if not result:
+        print("Blank result. Likely an error!")
+    return result.get("results"), result.get("error")
+
+
+def load_nlp():
+    # for picking which example prompts to inject
+    global nlp, stop_words
+    print("Loading NLP models")
+    nlp = spacy.load("en_core_web_lg")
+    print("Loading stopwords")
+    download('stopwords')  # Download stopwords list.
+    stop_words = stopwords.words('english')
+
+
+def prepare_prompt(prompt_data, question, injectables=None, prompt_type=None):
+    print("Preparing prompt with Question:", question)
+    prompt_type = prompt_type or experiment_prompt
+    if prompt_type == "raw":
+        return prompt_data_to_raw(prompt_data, question, injectables=injectables)
+    elif prompt_type == "chatml":
+        return prompt_data_to_chatml(prompt_data, question, injectables=injectables)
+    elif prompt_type == "openai":
+        return prompt_data_to_openai(prompt_data, question, injectables=injectables)
+
+
+def score_intervals(q_result):
+    # keyword matches are a count, so scale them by the number of keywords
+    # to get them on the same 0-1 scale as METEOR
+    n_keywords = len(q_result["correct_keywords"]) or 1
+    keyword_scores = [m / n_keywords for m in q_result["keyword_matches"]]
+    return {
+        "meteor": confidence_interval(q_result["scores"]),
+        "keywords": confidence_interval(keyword_scores),
+    }
+
+
+def should_stop_early(q_result, ci_width, min_tries=EARLY_STOP_MIN_TRIES):
+    """
+    Returns why we can stop trying a question, or None to keep going.
+    We stop once the 95% confidence intervals of both the METEOR and the
+    keyword scores are narrower than ci_width, i.e. more tries wouldn't
+    move the question's average score much.
+    """
+    if not ci_width or len(q_result["scores"]) < min_tries:
+        return None
+    intervals = score_intervals(q_result)
+    if all(half_width * 2 < ci_width for _, half_width in intervals.values()):
+        return "converged"
+    return None
+
+
+def new_question_result(q_data, prompt_lookup=False):
+    q_result = copy.deepcopy(q_data)
+    q_result["scores"] = []
+    q_result["tracefiles"] = []
+    q_result["errors"] = []
+    q_result["keyword_matches"] = []
+    q_result["answers"] = []
+    # why each try's session ended, see loop_guard.py
+    q_result["session_stop_reasons"] = []
+    # turns, per action timings, etc. even for timed out tries
+    q_result["session_stats"] = []
+    if prompt_lookup:
+        q_result["draft_stats"] = []
+    # seconds spent waiting for the machine to cool down, see throttle.py
+    q_result["pause_seconds"] = 0
+    return q_result
+
+
+def run_try(
+    model_path, prompt, tracefile, n_gpu_layers=0, timeout=30*60,
+    temp=None, top_p=None, inject_schema=False, prompt_lookup=False,
+    max_repeats=MAX_REPEATS, max_stale_turns=MAX_STALE_TURNS,
+    runtime_profile=None
+):
+    """
+    Run one try of a question. Returns run_llm's result, or just the
+    error if it blew up.
+    """
+    kwargs = {}
+    if prompt_lookup and not model_path.startswith("openai:"):
+        kwargs["prompt_lookup"] = True
+    if runtime_profile and not model_path.startswith("openai:"):
+        kwargs["runtime_profile"] = runtime_profile
+    try:
+        return run_llm(
+            model_path, outfile=tracefile,
+            debug=False, prompt=prompt,
+            n_gpu_layers=n_gpu_layers,
+            timeout=timeout, temp=temp,
+            top_p=top_p, inject_schema=inject_schema,
+            max_repeats=max_repeats,
+            max_stale_turns=max_stale_turns,
+            **kwargs
+        )
+    except Exception as e:
+        print(f"ERROR: {e}")
+        return {"error": f"{e}", "stop_reason": "error"}
+
+
+def add_try(q_result, result, tracefile):
+    # score a try's result and add it to the question's results
+    answer = result.get("final_answer")
+    print("Answer:", answer)
+    reference = q_result["correct_answer"]
+    candidate = answer or ""
+
+    meteor_score = pymeteor.meteor(reference, candidate, print_details=True)
+    print("Score:", meteor_score)
+    keyword_matches = get_keyword_matches(candidate, q_result["correct_keywords"])
+    print("Keyword Matches:", keyword_matches)
+
+    session_stats = None
+    if "n_turns" in result:
+        session_stats = {
+            k: result.get(k)
+            for k in ["n_turns", "action_stats", "repeated_actions"]
+        }
+
+    q_result["scores"].append(meteor_score)
+    q_result["tracefiles"].append(str(tracefile) if tracefile else None)
+    q_result["errors"].append(result.get("error"))
+    q_result["keyword_matches"].append(keyword_matches)
+    q_result["answers"].append(answer)
+    q_result["session_stop_reasons"].append(result.get("stop_reason"))
+    q_result["session_stats"].append(session_stats)
+    if "draft_stats" in q_result:
+        q_result["draft_stats"].append(result.get("draft_stats"))
+    q_result["pause_seconds"] += result.get("pause_seconds") or 0
+
+
+def finish_question_result(q_result, early_stop_ci_width=None, majority_vote=False):
+    if early_stop_ci_width:
+        q_result["n_tries"] = len(q_result["scores"])
+        q_result["confidence_intervals"] = {
+            name: [mean, half_width if half_width != float("inf") else None]
+            for name, (mean, half_width) in score_intervals(q_result).items()
+        }
+
+    if majority_vote:
+        # self-consistency: score the answer most of the tries agree on
+        majority = majority_answer(q_result["answers"])
+        print("Majority answer:", majority)
+        q_result["majority_answer"] = majority
+        q_result["majority_score"] = pymeteor.meteor(
+            q_result["correct_answer"], majority or ""
+        )
+        q_result["majority_keyword_matches"] = get_keyword_matches(
+            majority or "", q_result["correct_keywords"]
+        )
 
 
 def save_experiment_data(experiment_output, experiment_data):
@@ -189,80 +374,163 @@ def save_experiment_data(experiment_output, experiment_data):
         f.write(json.dumps(experiment_data, indent=2))
 
 
+def experiment_settings(experiment_plan, model_data):
+    # run_experiment's settings for a model from the experiment plan
+    return dict(
+        cooldown=model_data.get("cooldown") or experiment_plan.get("COOLDOWN"),
+        throttle=model_data.get("throttle", experiment_plan.get("THROTTLE")),
+        n_tries=experiment_plan["N_TRIES"],
+        n_gpu_layers=model_data.get("n_gpu_layers", 0),
+        temp=experiment_plan.get("temp"),
+        top_p=experiment_plan.get("top_p"),
+        injectables=experiment_plan.get("AVAILABLE_INJECT_PROMPTS"),
+        timeout=model_data.get("timeout", experiment_plan.get("TIMEOUT")),
+        inject_schema=experiment_plan.get("INJECT_SCHEMA", False),
+        fork_tries=experiment_plan.get("FORK_TRIES", False),
+        majority_vote=experiment_plan.get("MAJORITY_VOTE", False),
+        early_stop_ci_width=experiment_plan.get("EARLY_STOP_CI_WIDTH"),
+        early_stop_min_tries=experiment_plan.get(
+            "EARLY_STOP_MIN_TRIES", EARLY_STOP_MIN_TRIES
+        ),
+        prompt_lookup=model_data.get(
+            "prompt_lookup", experiment_plan.get("PROMPT_LOOKUP", False)
+        ),
+        max_repeats=experiment_plan.get("MAX_REPEATS", MAX_REPEATS),
+        max_stale_turns=experiment_plan.get("MAX_STALE_TURNS", MAX_STALE_TURNS),
+        trace_store=experiment_plan.get("TRACE_STORE"),
+        # the fastest llama.cpp settings for the model on this machine, if
+        # autotune.py has been run for it
+        runtime_profile=(
+            load_runtime_profile(model_data["path"])
+            if experiment_plan.get("RUNTIME_PROFILES", True) else None
+        ),
+    )
+
+
 def run_experiment(
     model_path, prompt_data, qa, experiment_output,
-    cooldown=None, n_tries=10, n_gpu_layers=0,
+    cooldown=None, throttle=None, n_tries=10, n_gpu_layers=0,
     temp=None, top_p=None,
-    injectables=None, timeout=30*60
+    injectables=None, timeout=30*60, inject_schema=False,
+    fork_tries=False, majority_vote=False, early_stop_ci_width=None,
+    early_stop_min_tries=EARLY_STOP_MIN_TRIES, prompt_lookup=False,
+    max_repeats=MAX_REPEATS, max_stale_turns=MAX_STALE_TURNS,
+    trace_store=None, runtime_profile=None, prompt_type=None
 ):
+    experiment_name = os.path.basename(experiment_output).rsplit(".", 1)[0]
+    # pauses only when the machine is hot or busy, or for a fixed cooldown
+    throttle = make_throttle(cooldown, throttle)
+
+    def make_tracefile(q_n, try_n):
+        # traces go into the trace store (if there is one) under this
+        # experiment, question and try
+        if trace_store:
+            return TraceWriter(
+                trace_store, experiment_name, q_n, try_n,
+                model=get_model_name(model_path)
+            )
+        return get_tracefile(model_path)
+
     experiment_data = {
         "question_results": [],
         "model_name": get_model_name(model_path),
         "model_path": model_path,
         "prompt": prompt_data,
+        "pause_seconds": 0,
     }
-    for q_data in qa:
-        q_result = copy.deepcopy(q_data)
+    if runtime_profile:
+        experiment_data["runtime_profile"] = runtime_profile
+    for q_n, q_data in enumerate(qa):
+        q_result = new_question_result(q_data, prompt_lookup=prompt_lookup)
         print()
         print("="*72)
         print("Beginning with question:", q_result["question"])
-        q_result["scores"] = []
-        q_result["tracefiles"] = []
-        q_result["errors"] = []
-        q_result["keyword_matches"] = []
-        q_result["answers"] = []
-        for i in range(n_tries):
-            print("-" * 72)
-            print(f"Attempt: {i}")
-
+        # evaluate the prompt once and run every try off of a copy of it.
+        # local models only, since we need the KV cache
+        forked = fork_tries and not model_path.startswith("openai:")
+        if forked:
             question = q_result["question"]
-            print("Preparing prompt with Question:", question)
-            prompt = None
-            if experiment_prompt == "raw":
-                prompt = prompt_data_to_raw(prompt_data, question, injectables=injectables)
-            elif experiment_prompt == "chatml":
-                prompt = prompt_data_to_chatml(prompt_data, question, injectables=injectables)
-            elif experiment_prompt == "openai":
-                prompt = prompt_data_to_openai(prompt_data, question, injectables=injectables)
-
-            tracefile = get_tracefile(model_path)
-            correct_keywords = q_result["correct_keywords"]
-
-            print("Writing to:", tracefile)
-            answer = None
-            error = None
+            prompt = prepare_prompt(
+                prompt_data, question, injectables=injectables,
+                prompt_type=prompt_type
+            )
+            tracefiles = [make_tracefile(q_n, i) for i in range(n_tries)]
+            print(f"Running {n_tries} forked tries, writing to:", [str(t) for t in tracefiles])
+            forked_results = None
+            forked_error = None
             try:
-                answer, trace = run_llm(
-                    model_path, outfile=tracefile,
+                forked_results, forked_error = run_llm_forked(
+                    model_path, n_tries, outfiles=tracefiles,
                     debug=False, prompt=prompt,
                     n_gpu_layers=n_gpu_layers,
                     timeout=timeout, temp=temp,
-                    top_p=top_p
+                    top_p=top_p, inject_schema=inject_schema,
+                    runtime_profile=runtime_profile
                 )
             except Exception as e:
                 print(f"ERROR: {e}")
-                error = f"{e}"
+                forked_error = f"{e}"
 
-            print("Answer:", answer)
-            reference = q_result["correct_answer"]
-            candidate = answer or ""
+        for i in range(n_tries):
+            print("-" * 72)
+            print(f"Attempt: {i}")
 
-            meteor_score = pymeteor.meteor(reference, candidate, print_details=True)
-            print("Score:", meteor_score)
-            keyword_matches = get_keyword_matches(candidate, correct_keywords)
-            print("Keyword Matches:", keyword_matches)
+            question = q_result["question"]
+            if forked:
+                tracefile = tracefiles[i]
+                if forked_results:
+                    answer, trace, session_stop_reason, try_error = forked_results[i]
+                    result = {
+                        "final_answer": answer, "error": try_error or forked_error,
+                        "stop_reason": session_stop_reason,
+                    }
+                else:
+                    result = {
+                        "error": forked_error or "No results from forked tries",
+                        "stop_reason": "error",
+                    }
+            else:
+                prompt = prepare_prompt(
+                    prompt_data, question, injectables=injectables,
+                    prompt_type=prompt_type
+                )
+                tracefile = make_tracefile(q_n, i)
+                print("Writing to:", tracefile)
+                result = run_try(
+                    model_path, prompt, tracefile,
+                    n_gpu_layers=n_gpu_layers, timeout=timeout,
+                    temp=temp, top_p=top_p, inject_schema=inject_schema,
+                    prompt_lookup=prompt_lookup, max_repeats=max_repeats,
+                    max_stale_turns=max_stale_turns,
+                    runtime_profile=runtime_profile
+                )
 
-            q_result["scores"].append(meteor_score)
-            q_result["tracefiles"].append(tracefile)
-            q_result["errors"].append(error)
-            q_result["keyword_matches"].append(keyword_matches)
-            q_result["answers"].append(answer)
+            add_try(q_result, result, tracefile)
 
             save_experiment_data(experiment_output, experiment_data)
 
-            if cooldown:
-                print(f"Cooling down for {cooldown}s...")
-                time.sleep(cooldown)
+            # forked tries have all already run, so there's nothing to save
+            stop_reason = None
+            if not forked:
+                stop_reason = should_stop_early(
+                    q_result, early_stop_ci_width, min_tries=early_stop_min_tries
+                )
+            if stop_reason:
+                print(f"Stopping after {i + 1} tries:", stop_reason)
+                q_result["stop_reason"] = stop_reason
+                break
+
+            if throttle and (not forked or i == n_tries - 1):
+                paused = throttle.pause()
+                q_result["pause_seconds"] += paused
+                experiment_data["pause_seconds"] += paused
+        else:
+            q_result["stop_reason"] = "n_tries"
+
+        finish_question_result(
+            q_result, early_stop_ci_width=early_stop_ci_width,
+            majority_vote=majority_vote
+        )
 
         print("Appending experiment")
         experiment_data["question_results"].append(q_result)
@@ -274,6 +542,137 @@ def run_experiment(
     return experiment_data
 
 
+def available_memory():
+    # bytes, from /proc/meminfo, or None if we can't tell
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def estimate_model_memory(model_path, settings):
+    """
+    Bytes a model needs to run: its weights (the GGUF is memory mapped,
+    so about the file size), its KV cache and some working space.
+    """
+    if model_path.startswith("openai:"):
+        return 0
+    info = model_info(model_path)
+    n_ctx = (settings["runtime_profile"] or {}).get("n_ctx", CONTEXT_SIZE)
+    if settings["fork_tries"]:
+        # a sequence for every try, see execute_forked
+        n_ctx = CONTEXT_SIZE * settings["n_tries"]
+    return info["file_size"] + kv_cache_bytes(info, n_ctx) + MODEL_OVERHEAD_BYTES
+
+
+def run_model(experiment_plan, model_data, experiment_output, cores=None):
+    """
+    Run the plan's experiment for one model. With cores, it (and the
+    sessions it starts) only runs on those CPU cores and llama.cpp uses
+    that many threads.
+    """
+    global experiment_prompt
+    experiment_prompt = model_prompt_type(model_data)
+    settings = experiment_settings(experiment_plan, model_data)
+    if cores:
+        # no pinning on platforms without it (macOS), but still keep
+        # llama.cpp to its share of the threads
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        runtime_profile = dict(settings["runtime_profile"] or {})
+        for key in ["n_threads", "n_threads_batch"]:
+            runtime_profile[key] = min(runtime_profile.get(key, len(cores)), len(cores))
+        settings["runtime_profile"] = runtime_profile
+    experiment_data = run_experiment(
+        model_data["path"],
+        experiment_plan["PROMPT_DATA"],
+        experiment_plan["QA"],
+        experiment_output,
+        prompt_type=experiment_prompt,
+        **settings
+    )
+    save_experiment_data(experiment_output, experiment_data)
+    return experiment_data
+
+
+def pack_workers(experiment_plan, experiment_outputs, memory_budget=None,
+                 cores_per_worker=CORES_PER_WORKER, poll_interval=5):
+    """
+    Run the plan's models side by side, each in its own process on its
+    own CPU cores, starting the next (biggest first) whenever there's
+    enough memory and cores free. Models using the GPU run one at a time.
+    A model too big for the budget still gets run, on its own.
+    """
+    cores = available_cores()
+    if memory_budget is None:
+        memory_budget = (available_memory() or 0) * MEMORY_BUDGET_FRACTION
+    print(f"Packing models into {memory_budget / 1024**3:.1f}GB and {len(cores)} cores")
+
+    pending = []
+    for model_data, experiment_output in zip(experiment_plan["MODELS"], experiment_outputs):
+        model_path = model_data["path"]
+        settings = experiment_settings(experiment_plan, model_data)
+        n_cores = (settings["runtime_profile"] or {}).get("n_threads", cores_per_worker)
+        if model_path.startswith("openai:"):
+            n_cores = 1
+        job = {
+            "model_data": model_data,
+            "output": experiment_output,
+            "memory": estimate_model_memory(model_path, settings),
+            "n_cores": max(1, min(n_cores, len(cores))),
+            "gpu": model_data.get("n_gpu_layers", 0) != 0,
+        }
+        print(f"{model_path}: ~{job['memory'] / 1024**3:.1f}GB, {job['n_cores']} cores"
+              + (", GPU" if job["gpu"] else ""))
+        pending.append(job)
+    pending.sort(key=lambda job: job["memory"], reverse=True)
+
+    free_cores = list(cores)
+    free_memory = memory_budget
+    gpu_busy = False
+    running = []
+    while pending or running:
+        for job in list(pending):
+            fits = job["memory"] <= free_memory or not running
+            if not fits or len(free_cores) < job["n_cores"]:
+                continue
+            if job["gpu"] and gpu_busy:
+                continue
+            job_cores = free_cores[:job["n_cores"]]
+            free_cores = free_cores[job["n_cores"]:]
+            free_memory -= job["memory"]
+            gpu_busy = gpu_busy or job["gpu"]
+            print("Starting", job["model_data"]["path"], "on cores", job_cores)
+            process = multiprocessing.Process(
+                target=run_model, name=get_model_name(job["model_data"]["path"]),
+                args=(experiment_plan, job["model_data"], job["output"], job_cores)
+            )
+            process.start()
+            running.append((process, job, job_cores))
+            pending.remove(job)
+
+        time.sleep(poll_interval)
+        for process, job, job_cores in list(running):
+            if process.is_alive():
+                continue
+            print("Finished", job["model_data"]["path"], "exit code", process.exitcode)
+            running.remove((process, job, job_cores))
+            free_cores = sorted(free_cores + job_cores)
+            free_memory += job["memory"]
+            if job["gpu"]:
+                gpu_busy = False
+
+
 if __name__ == "__main__":
     try:
         experiment_plan_file = sys.argv[1]
@@ -287,36 +686,21 @@ if __name__ == "__main__":
 
     today=datetime.now().strftime("%Y-%m-%d")
     exp_name = experiment_plan["EXPERIMENT_NAME"]
-    timeout = experiment_plan.get("TIMEOUT")
-
-    prompt_data = experiment_plan["PROMPT_DATA"]
-    injectables = experiment_plan.get("AVAILABLE_INJECT_PROMPTS")
 
     if USE_EXAMPLE_INJECTION:
-        print("Loading NLP models")
-        nlp = spacy.load("en_core_web_lg")
-        print("Loading stopwords")
-        download('stopwords')  # Download stopwords list.
-        stop_words = stopwords.words('english')
-
-    for model_data in experiment_plan["MODELS"]:
-        experiment_model = model_data["path"]
-        experiment_prompt = model_data["prompt_type"]
-
-        model_name = get_model_name(experiment_model)
-        experiment_output = f"./experiments/{exp_name}_{today}_{model_name}.json"
-
-        experiment_data = run_experiment(
-            experiment_model,
-            prompt_data,
-            experiment_plan["QA"],
-            experiment_output,
-            cooldown=model_data.get("cooldown") or experiment_plan.get("COOLDOWN"),
-            n_tries=experiment_plan["N_TRIES"],
-            n_gpu_layers=model_data.get("n_gpu_layers", 0),
-            temp=experiment_plan.get("temp"),
-            top_p=experiment_plan.get("top_p"),
-            injectables=injectables,
-            timeout=model_data.get("timeout", timeout)
+        load_nlp()
+
+    experiment_outputs = [
+        f"./experiments/{exp_name}_{today}_{get_model_name(model_data['path'])}.json"
+        for model_data in experiment_plan["MODELS"]
+    ]
+    if experiment_plan.get("PACK_WORKERS"):
+        memory_budget = experiment_plan.get("MEMORY_BUDGET_GB")
+        pack_workers(
+            experiment_plan, experiment_outputs,
+            memory_budget=memory_budget * 1024**3 if memory_budget else None,
+            cores_per_worker=experiment_plan.get("CORES_PER_WORKER", CORES_PER_WORKER)
         )
-        save_experiment_data(experiment_output, experiment_data)
+    else:
+        for model_data, experiment_output in zip(experiment_plan["MODELS"], experiment_outputs):
+            run_model(experiment_plan, model_data, experiment_output)
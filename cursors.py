@@ -0,0 +1,122 @@
+"""
+Keep sql-query results open between turns so the model can page through
+them with the next-page action, instead of writing the query again with
+an OFFSET (which makes SQLite work out and throw away every row before
+the page it wants). Each page only reads the rows it shows.
+
+Cursors belong to a session (see agent.Agent, they're kept in its
+session state) and get closed when it ends. An open cursor holds a read
+on the database, so only a few are kept open at once and ones the model
+stops using are closed after a while.
+
+Every page gets its own token (c1:2 is the second page of cursor c1), so
+asking for the same page twice is just a repeated action.
+"""
+import itertools
+import time
+
+
+# rows per page, the same as sql-query has always shown
+PAGE_SIZE = 5
+# open cursors per session. opening another closes the least recently
+# used one
+MAX_OPEN_CURSORS = 4
+# close cursors that haven't been paged through in this long
+CURSOR_IDLE_SECONDS = 300
+
+
+class ResultCursor:
+    def __init__(self, cursor_id, query, cursor):
+        self.id = cursor_id
+        self.query = query
+        self.cursor = cursor
+        self.columns = [d[0] for d in cursor.description or []]
+        # pages read so far
+        self.page = 0
+        # we read one row past each page to know if there's another
+        self.buffered = []
+        self.last_used = time.time()
+
+    def fetch_page(self, page_size=PAGE_SIZE):
+        if not self.columns:
+            # not a query that returns rows
+            return []
+        rows = self.buffered + self.cursor.fetchmany(page_size + 1 - len(self.buffered))
+        self.buffered = rows[page_size:]
+        self.page += 1
+        self.last_used = time.time()
+        return [dict(zip(self.columns, row)) for row in rows[:page_size]]
+
+    @property
+    def has_more(self):
+        return bool(self.buffered)
+
+    def next_token(self):
+        return f"{self.id}:{self.page + 1}"
+
+    def close(self):
+        self.cursor.close()
+
+
+def parse_token(token):
+    # "c1:2" => ("c1", 2)
+    cursor_id, _, page = token.strip().partition(":")
+    if not page.isdigit():
+        return cursor_id, None
+    return cursor_id, int(page)
+
+
+class CursorStore:
+    def __init__(self, max_open=MAX_OPEN_CURSORS,
+                 idle_seconds=CURSOR_IDLE_SECONDS):
+        self.max_open = max_open
+        self.idle_seconds = idle_seconds
+        # cursor id => ResultCursor
+        self.cursors = {}
+        self.ids = itertools.count(1)
+        self.n_evicted = 0
+
+    def evict_idle(self):
+        now = time.time()
+        for cursor_id, cursor in list(self.cursors.items()):
+            if now - cursor.last_used > self.idle_seconds:
+                self.remove(cursor_id)
+                self.n_evicted += 1
+
+    def remove(self, cursor_id):
+        cursor = self.cursors.pop(cursor_id, None)
+        if cursor:
+            cursor.close()
+
+    def execute(self, db, query):
+        """
+        Run a query and return a ResultCursor for it. It only gets kept
+        open (with add) if the first page doesn't hold all of the rows.
+        """
+        return ResultCursor(f"c{next(self.ids)}", query, db.execute(query))
+
+    def add(self, cursor):
+        self.evict_idle()
+        while len(self.cursors) >= self.max_open:
+            oldest = min(self.cursors.values(), key=lambda c: c.last_used)
+            self.remove(oldest.id)
+            self.n_evicted += 1
+        self.cursors[cursor.id] = cursor
+
+    def get(self, cursor_id):
+        self.evict_idle()
+        return self.cursors.get(cursor_id)
+
+    def open_tokens(self):
+        return [c.next_token() for c in self.cursors.values()]
+
+    def close(self):
+        for cursor_id in list(self.cursors):
+            self.remove(cursor_id)
+
+
+def session_cursors(session):
+    # the session's CursorStore, made the first time it's needed
+    if "cursors" not in session:
+        session["cursors"] = CursorStore()
+    return session["cursors"]
@@ -0,0 +1,92 @@
+import os
+import sqlite3
+from urllib.parse import quote
+
+import sqlite_utils
+
+
+# The agents only ever read from the database, so by default open it read
+# only and tuned for reads. Memory mapping lets the OS share the database
+# pages between every worker process that has it open instead of each one
+# filling its own page cache.
+DB_PROFILE = "read-only"
+CONNECTION_PROFILES = {
+    # plain read/write sqlite_utils connection
+    "default": {
+        "mode": None,
+        "immutable": False,
+        "pragmas": {},
+    },
+    "read-only": {
+        "mode": "ro",
+        "immutable": False,
+        "pragmas": {
+            "query_only": 1,
+            # bytes
+            "mmap_size": 2 * 1024 ** 3,
+            # negative values are KiB
+            "cache_size": -64 * 1024,
+            "temp_store": "MEMORY",
+        },
+    },
+    # for database snapshots that will never change while we're running.
+    # sqlite skips all locking and change detection, but if the file does
+    # change the results will be wrong
+    "immutable": {
+        "mode": "ro",
+        "immutable": True,
+        "pragmas": {
+            "query_only": 1,
+            "mmap_size": 2 * 1024 ** 3,
+            "cache_size": -64 * 1024,
+            "temp_store": "MEMORY",
+        },
+    },
+}
+
+# for the files several processes write to at once (the work queue and
+# trace stores). WAL is faster, but every connection has to share its
+# -shm memory on one machine, so it doesn't work across hosts on a
+# network filesystem. only turn it on when everything runs on one host
+USE_WAL = False
+
+
+def connection_uri(path, mode=None, immutable=False):
+    params = []
+    if mode:
+        params.append(f"mode={mode}")
+    if immutable:
+        params.append("immutable=1")
+    uri = f"file:{quote(os.path.abspath(path))}"
+    if params:
+        uri += "?" + "&".join(params)
+    return uri
+
+
+def connect(path, profile=DB_PROFILE):
+    """
+    Open the database using one of the CONNECTION_PROFILES and return
+    a sqlite_utils.Database.
+    """
+    assert profile in CONNECTION_PROFILES, f"Unknown DB profile: {profile}"
+    settings = CONNECTION_PROFILES[profile]
+    if not settings["mode"] and not settings["immutable"]:
+        conn = sqlite3.connect(path)
+    else:
+        conn = sqlite3.connect(
+            connection_uri(
+                path, mode=settings["mode"], immutable=settings["immutable"]
+            ),
+            uri=True
+        )
+    for pragma, value in settings["pragmas"].items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return sqlite_utils.Database(conn)
+
+
+def set_journal_mode(db):
+    # WAL or the rollback journal, see USE_WAL
+    if USE_WAL:
+        db.enable_wal()
+    else:
+        db.disable_wal()
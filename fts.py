@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+Build the full-text search indexes used by the search action. This only
+needs to be done once per database (or after the data changes):
+
+    python fts.py [example.db] [--force]
+
+Building an index also adds triggers to its table that note when the
+indexed text changes, so telling if an index is out of date doesn't
+mean reading the table.
+"""
+import json
+import sys
+import sqlite3
+
+import sqlite_utils
+
+
+DB_PATH = "example.db"
+# tables and the text columns to index for full-text search
+TABLE_FTS = {
+    "users": ["creatorDescription"],
+    "jobs": ["title", "description"],
+    "experiences": ["projectName", "experienceDescription", "jobRole"],
+    "games": ["name", "description"],
+    "game_passes": ["name", "description"],
+}
+# records what each FTS index was built from so we can tell when it's
+# gone stale. the _fts in the name keeps it hidden from the tables action
+FTS_META_TABLE = "_fts_meta"
+# tables whose indexed text changed since their FTS index was built,
+# filled in by triggers
+FTS_CHANGES_TABLE = "_fts_changes"
+TRIGGER_EVENTS = ["insert", "update", "delete"]
+SEARCH_LIMIT = 5
+# how many tokens of context to show around the matching text
+SNIPPET_TOKENS = 12
+
+
+def fts_table_name(table_name):
+    return f"{table_name}_fts"
+
+
+def table_fingerprint(db, table_name):
+    # the vector indexes still go by this. they only check it when
+    # they're built, so the full count doesn't matter there
+    row = next(db.query(f"""
+        select count(*) as n_rows, max(rowid) as max_rowid
+        from [{table_name}]
+    """))
+    return {
+        "columns": TABLE_FTS[table_name],
+        "n_rows": row["n_rows"],
+        "max_rowid": row["max_rowid"],
+    }
+
+
+def fts_definition(table_name):
+    return {"columns": TABLE_FTS[table_name]}
+
+
+def fts_meta(db, table_name):
+    if FTS_META_TABLE not in db.table_names():
+        return None
+    rows = list(db.query(
+        f"select fingerprint from [{FTS_META_TABLE}] where table_name = ?",
+        [table_name]
+    ))
+    if not rows:
+        return None
+    return json.loads(rows[0]["fingerprint"])
+
+
+def trigger_name(table_name, event):
+    return f"_fts_{table_name}_{event}"
+
+
+def create_triggers(db, table_name):
+    # only changes to the indexed columns matter for updates
+    columns = ", ".join(f"[{c}]" for c in TABLE_FTS[table_name])
+    for event in TRIGGER_EVENTS:
+        on = f"update of {columns}" if event == "update" else event
+        name = trigger_name(table_name, event)
+        db.execute(f"drop trigger if exists [{name}]")
+        db.execute(f"""
+            create trigger [{name}] after {on} on [{table_name}]
+            begin
+            insert or ignore into [{FTS_CHANGES_TABLE}] (table_name)
+            values ('{table_name}');
+            end
+        """)
+
+
+def has_triggers(db, table_name):
+    names = set(
+        row[0] for row in
+        db.execute("select name from sqlite_master where type = 'trigger'").fetchall()
+    )
+    return all(trigger_name(table_name, event) in names for event in TRIGGER_EVENTS)
+
+
+def has_changes(db, table_name):
+    if FTS_CHANGES_TABLE not in db.table_names():
+        return False
+    return db.execute(
+        f"select 1 from [{FTS_CHANGES_TABLE}] where table_name = ? limit 1",
+        [table_name]
+    ).fetchone() is not None
+
+
+def is_fts_stale(db, table_name):
+    # only looks at the schema and the change log, never the table itself
+    if fts_table_name(table_name) not in db.table_names():
+        return True
+    if fts_meta(db, table_name) != fts_definition(table_name):
+        return True
+    if not has_triggers(db, table_name):
+        # the table was replaced, we can't know what changed
+        return True
+    return has_changes(db, table_name)
+
+
+def stale_fts_tables(db):
+    return [
+        table_name
+        for table_name in TABLE_FTS
+        if table_name in db.table_names() and is_fts_stale(db, table_name)
+    ]
+
+
+def check_fts_indexes(db, db_path):
+    stale = stale_fts_tables(db)
+    if stale:
+        print("WARNING: Missing or out of date FTS indexes for", stale)
+        print(f"Build them with: python fts.py {db_path}")
+    return stale
+
+
+def build_fts_indexes(db, force=False):
+    """
+    (Re)build the FTS5 index for every table in TABLE_FTS that is missing
+    or out of date. Returns the names of the tables that were built.
+    """
+    if FTS_CHANGES_TABLE not in db.table_names():
+        db[FTS_CHANGES_TABLE].create({"table_name": str}, pk="table_name")
+    built = []
+    for table_name, fields in TABLE_FTS.items():
+        if table_name not in db.table_names():
+            print("Skipping missing table", table_name)
+            continue
+        if not force and not is_fts_stale(db, table_name):
+            print("FTS index is up to date for", table_name)
+            continue
+        print("Building FTS index for", table_name, fields)
+        # log changes from before the build starts, so nothing written
+        # while it runs gets missed
+        with db.conn:
+            create_triggers(db, table_name)
+            db.execute(
+                f"delete from [{FTS_CHANGES_TABLE}] where table_name = ?", [table_name]
+            )
+        db[table_name].enable_fts(
+            fields, fts_version="FTS5", create_triggers=False, replace=True
+        )
+        db[FTS_META_TABLE].upsert({
+            "table_name": table_name,
+            "fingerprint": json.dumps(fts_definition(table_name)),
+        }, pk="table_name")
+        built.append(table_name)
+    return built
+
+
+def search_fts(db, table_name, query, limit=SEARCH_LIMIT):
+    """
+    Search a table's FTS index, best (lowest bm25) matches first. Returns
+    the row's primary key(s) and a snippet of the matching text.
+    """
+    fts_name = fts_table_name(table_name)
+    pks = db[table_name].pks
+    pk_select = ", ".join(f"t.[{pk}]" for pk in pks)
+    sql = f"""
+        select {pk_select},
+            snippet([{fts_name}], -1, '[', ']', '...', {SNIPPET_TOKENS}) as snippet
+        from [{fts_name}]
+        join [{table_name}] as t on t.rowid = [{fts_name}].rowid
+        where [{fts_name}] match ?
+        order by bm25([{fts_name}])
+        limit {int(limit)}
+    """
+    try:
+        return list(db.query(sql, [query]))
+    except sqlite3.OperationalError:
+        # probably FTS syntax the model didn't mean to use, so search
+        # for the words as plain terms instead
+        return list(db.query(sql, [db.quote_fts(query)]))
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    db_path = args[0] if args else DB_PATH
+    force = "--force" in sys.argv
+    db = sqlite_utils.Database(db_path)
+    built = build_fts_indexes(db, force=force)
+    print("Built FTS indexes for:", built)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Read what we need to know about a model from its GGUF header (size,
+quantization, context length, chat template, layer shapes) without
+loading any of the weights. Only the header gets read, so this is quick
+even for a 70B model:
+
+    python gguf_info.py ../models/*.gguf
+
+Used by benchmark_runner.py to guess a model's prompt_type and how much
+memory it needs.
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+from collections import Counter
+
+
+GGUF_MAGIC = b"GGUF"
+# GGUF metadata value types
+(UINT8, INT8, UINT16, INT16, UINT32, INT32, FLOAT32, BOOL, STRING, ARRAY,
+ UINT64, INT64, FLOAT64) = range(13)
+SCALAR_FORMATS = {
+    UINT8: "<B", INT8: "<b", UINT16: "<H", INT16: "<h", UINT32: "<I",
+    INT32: "<i", FLOAT32: "<f", BOOL: "<?", UINT64: "<Q", INT64: "<q",
+    FLOAT64: "<d",
+}
+# general.file_type, what the model was quantized to (llama_ftype)
+FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0",
+    9: "Q5_1", 10: "Q2_K", 11: "Q3_K_S", 12: "Q3_K_M", 13: "Q3_K_L",
+    14: "Q4_K_S", 15: "Q4_K_M", 16: "Q5_K_S", 17: "Q5_K_M", 18: "Q6_K",
+    19: "IQ2_XXS", 20: "IQ2_XS", 21: "Q2_K_S", 22: "IQ3_XS", 23: "IQ3_XXS",
+    24: "IQ1_S", 25: "IQ4_NL", 26: "IQ3_S", 27: "IQ3_M", 28: "IQ2_S",
+    29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16",
+}
+# tensor types (ggml_type), for models without a general.file_type
+TENSOR_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 6: "Q5_0", 7: "Q5_1",
+    8: "Q8_0", 9: "Q8_1", 10: "Q2_K", 11: "Q3_K", 12: "Q4_K", 13: "Q5_K",
+    14: "Q6_K", 15: "Q8_K", 16: "IQ2_XXS", 17: "IQ2_XS", 18: "IQ3_XXS",
+    19: "IQ1_S", 20: "IQ4_NL", 21: "IQ3_S", 22: "IQ2_S", 23: "IQ4_XS",
+    24: "I8", 25: "I16", 26: "I32", 27: "I64", 28: "F64", 29: "IQ1_M",
+    30: "BF16",
+}
+# arrays longer than this (the tokenizer's vocab) are skipped over
+# instead of being kept
+MAX_ARRAY_LENGTH = 64
+
+
+class GGUFReader:
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.offset = 0
+
+    def unpack(self, fmt):
+        values = struct.unpack_from(fmt, self.buffer, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return values[0]
+
+    def string(self):
+        length = self.unpack("<Q")
+        data = self.buffer[self.offset:self.offset + length]
+        self.offset += length
+        return data.decode("utf-8", errors="replace")
+
+    def skip_strings(self, n):
+        for _ in range(n):
+            self.offset += 8 + struct.unpack_from("<Q", self.buffer, self.offset)[0]
+
+    def value(self, value_type):
+        if value_type == STRING:
+            return self.string()
+        if value_type == ARRAY:
+            item_type = self.unpack("<I")
+            length = self.unpack("<Q")
+            if length > MAX_ARRAY_LENGTH:
+                if item_type == STRING:
+                    self.skip_strings(length)
+                elif item_type in SCALAR_FORMATS:
+                    self.offset += length * struct.calcsize(SCALAR_FORMATS[item_type])
+                else:
+                    for _ in range(length):
+                        self.value(item_type)
+                return {"type": item_type, "length": length}
+            return [self.value(item_type) for _ in range(length)]
+        return self.unpack(SCALAR_FORMATS[value_type])
+
+
+def read_header(path):
+    """
+    The metadata key/values and tensor infos (name, shape, type) of a
+    GGUF file. Big arrays are replaced with their type and length.
+    """
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            reader = GGUFReader(buffer)
+            magic = buffer[:4]
+            reader.offset = 4
+            if magic != GGUF_MAGIC:
+                raise ValueError(f"Not a GGUF file: {path}")
+            version = reader.unpack("<I")
+            if version < 2:
+                raise ValueError(f"GGUF version {version} isn't supported: {path}")
+            n_tensors = reader.unpack("<Q")
+            n_kv = reader.unpack("<Q")
+            metadata = {"GGUF.version": version}
+            for _ in range(n_kv):
+                key = reader.string()
+                metadata[key] = reader.value(reader.unpack("<I"))
+            tensors = []
+            for _ in range(n_tensors):
+                name = reader.string()
+                n_dims = reader.unpack("<I")
+                shape = [reader.unpack("<Q") for _ in range(n_dims)]
+                tensor_type = reader.unpack("<I")
+                reader.offset += 8  # data offset
+                tensors.append((name, shape, tensor_type))
+        finally:
+            buffer.close()
+    return metadata, tensors
+
+
+def detect_prompt_type(chat_template):
+    # the prompt formats benchmark_runner.py knows how to build
+    if chat_template and "<|im_start|>" in chat_template:
+        return "chatml"
+    return "raw"
+
+
+def model_info(path):
+    """
+    A summary of the model: parameter count, quantization, context
+    length, chat template (and the prompt_type it implies) and the
+    shapes needed to work out how big its KV cache will be.
+    """
+    metadata, tensors = read_header(path)
+    arch = metadata.get("general.architecture", "llama")
+
+    def arch_value(key, default=None):
+        return metadata.get(f"{arch}.{key}", default)
+
+    n_params = 0
+    type_params = Counter()
+    for name, shape, tensor_type in tensors:
+        n = 1
+        for dim in shape:
+            n *= dim
+        n_params += n
+        type_params[tensor_type] += n
+    file_type = metadata.get("general.file_type")
+    if file_type in FILE_TYPES:
+        quantization = FILE_TYPES[file_type]
+    elif type_params:
+        quantization = TENSOR_TYPES.get(type_params.most_common(1)[0][0], "unknown")
+    else:
+        quantization = "unknown"
+
+    n_embd = arch_value("embedding_length", 0)
+    n_head = arch_value("attention.head_count", 0)
+    n_head_kv = arch_value("attention.head_count_kv", n_head)
+    chat_template = metadata.get("tokenizer.chat_template")
+    return {
+        "path": path,
+        "name": metadata.get("general.name"),
+        "architecture": arch,
+        "file_size": os.path.getsize(path),
+        "n_params": n_params,
+        "quantization": quantization,
+        "context_length": arch_value("context_length"),
+        "n_layer": arch_value("block_count", 0),
+        "n_embd": n_embd,
+        "n_head": n_head,
+        "n_head_kv": n_head_kv,
+        "chat_template": chat_template,
+        "prompt_type": detect_prompt_type(chat_template),
+    }
+
+
+def kv_cache_bytes(info, n_ctx, bytes_per_value=2):
+    # keys and values (f16 by default) for every layer and position. with
+    # grouped query attention the KV heads are smaller than the model width
+    if not info["n_head"]:
+        return 0
+    n_embd_kv = info["n_embd"] * info["n_head_kv"] // info["n_head"]
+    return 2 * info["n_layer"] * n_ctx * n_embd_kv * bytes_per_value
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        info = model_info(path)
+        # templates are long, the first line is enough to tell what it is
+        if info["chat_template"]:
+            info["chat_template"] = info["chat_template"][:80] + "..."
+        print(json.dumps(info, indent=2))
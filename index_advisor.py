@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+"""
+Suggest (and optionally build) indexes for the SQL queries the models
+actually ran, according to the tracefiles from past experiments:
+
+    python index_advisor.py example.db [--traces ./traces/] [--create]
+"""
+import argparse
+import json
+import re
+import sqlite3
+import time
+
+from db_profiles import connect
+from query_plan import (
+    clear_row_estimates, estimate_query_cost, resolve_table
+)
+from traces import TRACES_DIR, extract_sql_queries
+
+
+# give up timing a query after this many seconds
+QUERY_TIMEOUT = 60
+# don't suggest indexes wider than this, they cost too much space
+MAX_INDEX_COLUMNS = 4
+MAX_INDEXES = 5
+
+
+def is_select_query(query):
+    """
+    Whether a query is one SELECT (or WITH ... SELECT). The models write
+    all sorts of things and their agents refuse anything else, so we
+    shouldn't be running it here either.
+    """
+    query = re.sub(r"--[^\n]*|/\*.*?\*/", " ", query, flags=re.S).strip().rstrip(";").strip()
+    if not query or ";" in query:
+        return False
+    first_word = query.split(None, 1)[0].lower()
+    if first_word == "with":
+        # the statement after the CTEs could still be a write
+        return not re.search(r"\b(insert|update|delete|replace|drop|create|alter)\b", query, re.I)
+    return first_word == "select"
+
+
+def time_query(db, query, timeout=QUERY_TIMEOUT):
+    """
+    How long a query takes to run, in seconds. Queries that error out
+    (including several statements at once or ? placeholders, which the
+    models sometimes write) or aren't a SELECT return None and ones that take too long return
+    the timeout.
+    """
+    if not is_select_query(query):
+        return None
+    deadline = time.time() + timeout
+    db.conn.set_progress_handler(lambda: time.time() > deadline, 10000)
+    start = time.time()
+    try:
+        db.execute(query).fetchall()
+    except sqlite3.Error as e:
+        if "interrupted" not in str(e):
+            return None
+        return timeout
+    finally:
+        db.conn.set_progress_handler(None, 10000)
+    return time.time() - start
+
+
+def referenced_columns(db, query):
+    """
+    Columns in the query, per table, split into the ones compared with a
+    constant (filters), the ones compared with another column (joins) and
+    everything the query uses.
+    """
+    table_names = [
+        t for t in db.table_names()
+        if re.search(rf"\b{re.escape(t)}\b", query)
+    ]
+    columns = {t: set(c.name for c in db[t].columns) for t in table_names}
+    filters = {t: [] for t in table_names}
+    joins = {t: [] for t in table_names}
+    used = {t: [] for t in table_names}
+
+    def add(table, column, kind=None):
+        if table not in columns or column not in columns[table]:
+            return
+        if kind == "filter" and column not in filters[table]:
+            filters[table].append(column)
+        if kind == "join" and column not in joins[table]:
+            joins[table].append(column)
+        if column not in used[table]:
+            used[table].append(column)
+
+    def kind_of(comparison):
+        if not comparison:
+            return None
+        if re.match(r"\s*=\s*(['\"\d?-]|null\b)", comparison, re.I):
+            return "filter"
+        return "join"
+
+    column_re = r"\b(\w+)\.\[?(\w+)\]?(\s*=\s*\S+)?"
+    for match in re.finditer(column_re, query):
+        name, column, comparison = match.groups()
+        add(resolve_table(db, query, name), column, kind_of(comparison))
+    for match in re.finditer(r"=\s*(\w+)\.\[?(\w+)\]?", query):
+        name, column = match.groups()
+        add(resolve_table(db, query, name), column, "join")
+    # unqualified columns are only unambiguous with a single table
+    if len(table_names) == 1:
+        table = table_names[0]
+        for match in re.finditer(r"(?<![.\w])\[?(\w+)\]?(\s*=\s*\S+)?", query):
+            column, comparison = match.groups()
+            add(table, column, kind_of(comparison))
+    return filters, joins, used
+
+
+def candidate_indexes(db, query, steps):
+    """
+    Indexes that would get rid of the expensive steps of a query plan:
+    automatic indexes, scans nested in other loops and scans that filter
+    on a column with a constant.
+    """
+    filters, joins, used = referenced_columns(db, query)
+    candidates = []
+    for step in steps:
+        table = step["table"]
+        if table not in used:
+            continue
+        if step["automatic_index"]:
+            key_columns = re.findall(r"(\w+)=\?", step["detail"])
+        elif step["full_scan"] and step["outer_rows"] > 1:
+            key_columns = filters[table] + joins[table]
+        elif step["full_scan"]:
+            # the outer loop of a join doesn't need the join columns
+            key_columns = list(filters[table])
+        else:
+            continue
+        if not key_columns:
+            continue
+        # include the rest of the columns the query uses so the index
+        # covers the query and the table itself never needs to be read
+        covering = key_columns + [c for c in used[table] if c not in key_columns]
+        if len(covering) <= MAX_INDEX_COLUMNS:
+            key_columns = covering
+        candidate = (table, tuple(key_columns))
+        if candidate not in candidates:
+            candidates.append(candidate)
+    return candidates
+
+
+def existing_indexes(db, table):
+    return [tuple(index.columns) for index in db[table].indexes]
+
+
+def advise(db, queries, timeout=QUERY_TIMEOUT):
+    """
+    Time each query and work out which indexes would help. Returns the
+    per-query results and the suggested indexes, ranked by how much time
+    they'd save across all of the recorded runs of the queries.
+    """
+    results = []
+    suggestions = {}
+    for query, count in queries.most_common():
+        if not is_select_query(query):
+            print("Skipping a query that isn't a single SELECT:", query[:100])
+            continue
+        try:
+            cost, steps = estimate_query_cost(db, query)
+        except (sqlite3.OperationalError, sqlite3.Warning):
+            continue
+        seconds = time_query(db, query, timeout=timeout)
+        if seconds is None:
+            continue
+        result = {
+            "query": query,
+            "count": count,
+            "cost": cost,
+            "before": seconds,
+            "indexes": [],
+        }
+        for table, columns in candidate_indexes(db, query, steps):
+            if columns in existing_indexes(db, table):
+                continue
+            result["indexes"].append([table, list(columns)])
+            suggestion = suggestions.setdefault((table, columns), {
+                "table": table,
+                "columns": list(columns),
+                "queries": 0,
+                "est_seconds_saved": 0.0,
+            })
+            suggestion["queries"] += 1
+            # assume the index gets rid of nearly all of the query's time
+            suggestion["est_seconds_saved"] += seconds * count
+        results.append(result)
+    ranked = sorted(
+        suggestions.values(), key=lambda s: s["est_seconds_saved"], reverse=True
+    )
+    return results, ranked
+
+
+def create_indexes(db_path, suggestions):
+    # the only thing the advisor writes, so the only place it gets a
+    # writable connection
+    db = connect(db_path, profile="default")
+    for suggestion in suggestions:
+        print("Creating index on", suggestion["table"], suggestion["columns"])
+        db[suggestion["table"]].create_index(
+            suggestion["columns"], if_not_exists=True
+        )
+    print("Running ANALYZE")
+    db.analyze()
+    db.conn.close()
+    # row estimates may have come from before ANALYZE
+    clear_row_estimates()
+
+
+def latency_report(results):
+    total_before = sum(r["before"] * r["count"] for r in results)
+    total_after = sum(
+        (r["before"] if r.get("after") is None else r["after"]) * r["count"]
+        for r in results
+    )
+    print("=" * 72)
+    print("count\tbefore\tafter\tquery")
+    for r in sorted(results, key=lambda r: r["before"] * r["count"], reverse=True):
+        after = r.get("after")
+        after_text = f"{after:.3f}" if after is not None else "-"
+        print(f"{r['count']}\t{r['before']:.3f}\t{after_text}\t{r['query'][:100]}")
+    print("=" * 72)
+    print(f"Total time across recorded runs: {total_before:.2f}s before, {total_after:.2f}s after")
+    return {"before": total_before, "after": total_after}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Suggest indexes for the SQL the models ran")
+    parser.add_argument("db_path")
+    parser.add_argument("--traces", default=TRACES_DIR)
+    parser.add_argument("--create", action="store_true",
+                        help="Create the suggested indexes, run ANALYZE and re-time the queries")
+    parser.add_argument("--max-indexes", type=int, default=MAX_INDEXES)
+    parser.add_argument("--timeout", type=int, default=QUERY_TIMEOUT)
+    parser.add_argument("--report", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    queries = extract_sql_queries(args.traces)
+    print("Found", len(queries), "unique queries in", sum(queries.values()), "runs")
+
+    # query_only, whatever made it into the traces can't change anything
+    db = connect(args.db_path, profile="read-only")
+    results, suggestions = advise(db, queries, timeout=args.timeout)
+    suggestions = suggestions[:args.max_indexes]
+    print("Suggested indexes:")
+    for s in suggestions:
+        print(f"  {s['table']}({', '.join(s['columns'])}): helps {s['queries']} queries, "
+              f"saves ~{s['est_seconds_saved']:.2f}s")
+
+    if args.create and suggestions:
+        create_indexes(args.db_path, suggestions)
+        for result in results:
+            result["after"] = time_query(db, result["query"], timeout=args.timeout)
+
+    totals = latency_report(results)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(json.dumps({
+                "suggestions": suggestions,
+                "queries": results,
+                "totals": totals,
+            }, indent=2))
@@ -0,0 +1,118 @@
+"""
+Run a session in its own process and get its results back over a pipe,
+as they happen:
+
+    result, timed_out = run_in_process(execute, model_path, prompt=prompt, timeout=60)
+
+The child gets a ResultChannel as its return_dict, so everything it puts
+in there (the trace after every turn, stop reason, stats) gets sent back
+right away. When the timeout hits we ask the session to stop instead of
+killing it, so we still get its partial trace and stats. Only if it
+doesn't stop within CANCEL_GRACE seconds does it get terminated, and
+then we still have whatever it sent before that.
+"""
+import multiprocessing
+import time
+
+
+# seconds a cancelled session gets to wrap up before it's terminated
+CANCEL_GRACE = 30
+
+
+class ResultChannel:
+    """
+    The write end of a return_dict, sending each update down a pipe. Keys
+    in skip don't get sent, e.g. the trace when it's already being written
+    to a trace store.
+    """
+
+    def __init__(self, conn, skip=()):
+        self.conn = conn
+        self.skip = skip
+
+    def __setitem__(self, key, value):
+        if key not in self.skip:
+            self.conn.send(("set", key, value))
+
+    def update(self, data):
+        self.conn.send(("update", {
+            k: v for k, v in data.items() if k not in self.skip
+        }))
+
+
+def run_worker(conn, cancel, execute_fn, args, kwargs, skip=()):
+    kwargs["return_dict"] = ResultChannel(conn, skip=skip)
+    kwargs["cancel"] = cancel
+    try:
+        execute_fn(*args, **kwargs)
+    except Exception as e:
+        conn.send(("set", "error", f"{e}"))
+    finally:
+        conn.send(("done",))
+        conn.close()
+
+
+def run_in_process(execute_fn, *args, timeout=30*60, grace=CANCEL_GRACE,
+                   skip=(), **kwargs):
+    """
+    Run execute_fn(*args, **kwargs) in a new process. Returns everything
+    it put in its return_dict (except for the skip keys), and whether it
+    timed out. timeout=None waits for as long as it takes.
+    """
+    # work this out before starting the child, so a bad timeout can't
+    # leave it running with nobody listening
+    if timeout is None:
+        deadline = float("inf")
+    else:
+        deadline = time.time() + float(timeout)
+    recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+    cancel = multiprocessing.Event()
+    p = multiprocessing.Process(
+        target=run_worker, name="LLM",
+        args=(send_conn, cancel, execute_fn, args, kwargs, skip)
+    )
+    p.start()
+    # only the child writes, this way we get an EOF if it dies
+    send_conn.close()
+
+    result = {}
+    timed_out = False
+    try:
+        timed_out = receive_results(recv_conn, cancel, result, deadline, timeout, grace)
+    finally:
+        p.join(grace if not timed_out else 1)
+        if p.is_alive():
+            p.terminate()
+            p.join()
+        recv_conn.close()
+    return result, timed_out
+
+
+def receive_results(recv_conn, cancel, result, deadline, timeout, grace):
+    # fill in result from the child's messages until it's done. returns
+    # whether it timed out
+    timed_out = False
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            if timed_out:
+                print(f"Session didn't stop within {grace}s, terminating")
+                break
+            print(f"Timed out after {timeout}s, cancelling session")
+            timed_out = True
+            cancel.set()
+            deadline = time.time() + grace
+            continue
+        if not recv_conn.poll(min(remaining, 1)):
+            continue
+        try:
+            message = recv_conn.recv()
+        except EOFError:
+            break
+        if message[0] == "done":
+            break
+        elif message[0] == "set":
+            result[message[1]] = message[2]
+        elif message[0] == "update":
+            result.update(message[1])
+    return timed_out
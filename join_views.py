@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+"""
+Materialize the joins most of the benchmark questions need (experiences
+with their user, jobs with the user who posted them, games with their
+stats and game passes with their game) as real, indexed tables, so a
+multi-table question can be answered from one table instead of the model
+working out (and SQLite running) the same join on every try:
+
+    python join_views.py build [example.db] [--force]
+    python join_views.py refresh [example.db]
+
+build creates the views that are missing or whose definition changed
+(or all of them with --force). It also adds triggers to the base tables
+that log which rows get inserted, updated or deleted, so refresh only
+has to recompute the view rows those changes touch. The agents see the
+views like any other table, with DATA_HELP built from JOIN_VIEWS.
+
+Every view has one row per row of its base table, with the same rowid,
+so the joined tables need to be unique on the join column (they're all
+lookups of a primary key).
+"""
+import argparse
+import json
+from datetime import datetime
+
+import sqlite_utils
+
+
+DB_PATH = "example.db"
+# view => its base table, the tables joined to it (table, column in the
+# base table, column in the joined table), its columns (view column =>
+# table, column), indexes and help. column help defaults to the DATA_HELP
+# of the column it came from
+JOIN_VIEWS = {
+    "experiences_with_users": {
+        "table": "experiences",
+        "joins": [("users", "creatorUserId", "creatorUserId")],
+        "columns": {
+            "experienceId": ("experiences", "experienceId"),
+            "creatorUserId": ("experiences", "creatorUserId"),
+            "projectName": ("experiences", "projectName"),
+            "jobRole": ("experiences", "jobRole"),
+            "teamName": ("experiences", "teamName"),
+            "startedUtc": ("experiences", "startedUtc"),
+            "endedUtc": ("experiences", "endedUtc"),
+            "isCurrent": ("experiences", "isCurrent"),
+            "isOpenToWork": ("users", "isOpenToWork"),
+            "userSkillTypes": ("users", "skillTypes"),
+            "userJobTypes": ("users", "jobTypes"),
+        },
+        "indexes": [["creatorUserId"], ["projectName"], ["jobRole"]],
+        "help": {
+            None: "experiences joined with the user who worked on them (experiences.creatorUserId = users.creatorUserId), one row per experience. use this instead of joining experiences and users yourself.",
+            "userSkillTypes": "an array containing skills the user who worked on this has",
+            "userJobTypes": "the type of jobs and work the user who worked on this is seeking",
+        },
+    },
+    "jobs_with_posters": {
+        "table": "jobs",
+        "joins": [("users", "jobPosterId", "creatorUserId")],
+        "columns": {
+            "id": ("jobs", "id"),
+            "jobPosterId": ("jobs", "jobPosterId"),
+            "title": ("jobs", "title"),
+            "jobType": ("jobs", "jobType"),
+            "paymentTypes": ("jobs", "paymentTypes"),
+            "paymentAmount": ("jobs", "paymentAmount"),
+            "paymentAmountType": ("jobs", "paymentAmountType"),
+            "publishedUtc": ("jobs", "publishedUtc"),
+            "isVerified": ("jobs", "isVerified"),
+            "posterIsOpenToWork": ("users", "isOpenToWork"),
+            "posterSkillTypes": ("users", "skillTypes"),
+            "posterCreatedUtc": ("users", "createdUtc"),
+        },
+        "indexes": [["jobPosterId"], ["jobType"], ["publishedUtc"]],
+        "help": {
+            None: "job listings joined with the user who posted them (jobs.jobPosterId = users.creatorUserId), one row per job. use this instead of joining jobs and users yourself.",
+            "posterIsOpenToWork": "whether or not the user who posted the job is looking for work themselves",
+            "posterSkillTypes": "an array containing skills the user who posted the job has",
+            "posterCreatedUtc": "a ISO8601 datetime string of when the user who posted the job signed up",
+        },
+    },
+    "games_with_stats": {
+        "table": "games",
+        "joins": [("game_stats", "placeId", "placeId")],
+        "columns": {
+            "placeId": ("games", "placeId"),
+            "name": ("games", "name"),
+            "builder": ("games", "builder"),
+            "builderId": ("games", "builderId"),
+            "price": ("games", "price"),
+            "isPlayable": ("games", "isPlayable"),
+            "Genre": ("game_stats", "Genre"),
+            "Visits": ("game_stats", "Visits"),
+            "Active": ("game_stats", "Active"),
+            "Favorites": ("game_stats", "Favorites"),
+            "Created": ("game_stats", "Created"),
+            "Updated": ("game_stats", "Updated"),
+        },
+        "indexes": [["placeId"], ["name"], ["Genre"], ["builderId"]],
+        "help": {
+            None: "games joined with their game_stats on placeId, one row per game. use this instead of joining games and game_stats yourself.",
+        },
+    },
+    "game_passes_with_games": {
+        "table": "game_passes",
+        "joins": [
+            ("games", "game_id", "placeId"),
+            ("game_stats", "game_id", "placeId"),
+        ],
+        "columns": {
+            "game_id": ("game_passes", "game_id"),
+            "passName": ("game_passes", "name"),
+            "passPrice": ("game_passes", "price"),
+            "up": ("game_passes", "up"),
+            "down": ("game_passes", "down"),
+            "gameName": ("games", "name"),
+            "builder": ("games", "builder"),
+            "Genre": ("game_stats", "Genre"),
+        },
+        "indexes": [["game_id"], ["gameName"], ["Genre"]],
+        "help": {
+            None: "game passes joined with the game they're for (game_passes.game_id = games.placeId) and its game_stats, one row per game pass. use this instead of joining game_passes, games and game_stats yourself.",
+            "game_id": "the placeId of the game this add-on is for",
+            "passName": "the title of the add-on. this is not the game's name, that's gameName",
+            "passPrice": "how much this add-on costs",
+            "gameName": "the name of the game this add-on is for",
+        },
+    },
+}
+# what each view was built from. hidden from the agents by the leading _
+VIEWS_META_TABLE = "_join_views_meta"
+# base table rows changed since each view was last refreshed, filled in
+# by triggers
+CHANGES_TABLE = "_join_view_changes"
+TRIGGER_EVENTS = ["insert", "update", "delete"]
+
+
+def view_columns(db, view):
+    """
+    The view's columns that exist in this database (the example database
+    has fewer columns than the real one), as (view column, table, column,
+    type).
+    """
+    table_columns = {}
+    columns = []
+    for view_column, (table, column) in view["columns"].items():
+        if table not in table_columns:
+            table_columns[table] = {c.name: c.type for c in db[table].columns}
+        if column in table_columns[table]:
+            columns.append((view_column, table, column, table_columns[table][column]))
+    return columns
+
+
+def view_definition(db, view):
+    # changes to this mean the view has to be built again
+    return {
+        "table": view["table"],
+        "joins": view["joins"],
+        "columns": view_columns(db, view),
+        "indexes": view["indexes"],
+    }
+
+
+def missing_tables(db, view):
+    table_names = db.table_names()
+    return [
+        table
+        for table in [view["table"]] + [j[0] for j in view["joins"]]
+        if table not in table_names
+    ]
+
+
+def join_column(view, table, column):
+    # the view column a base table column ended up as
+    for view_column, source in view["columns"].items():
+        if source == (table, column):
+            return view_column
+    return None
+
+
+def select_sql(db, view):
+    columns = view_columns(db, view)
+    select = ", ".join(
+        f"[{table}].[{column}] as [{view_column}]"
+        for view_column, table, column, _ in columns
+    )
+    joins = "\n".join(
+        f"left join [{table}] on [{table}].[{other_column}] = [{view['table']}].[{column}]"
+        for table, column, other_column in view["joins"]
+    )
+    return f"""
+        select [{view['table']}].rowid, {select}
+        from [{view['table']}]
+        {joins}
+    """
+
+
+def insert_sql(db, view_name, view):
+    columns = ", ".join(f"[{c[0]}]" for c in view_columns(db, view))
+    return f"insert into [{view_name}] (rowid, {columns}) {select_sql(db, view)}"
+
+
+def trigger_name(view_name, table, event):
+    return f"_jv_{view_name}_{table}_{event}"
+
+
+def create_triggers(db, view_name, view):
+    """
+    Log the rowids of changed base table rows, and the join column values
+    of changed rows in the joined tables, for refresh to pick up.
+    """
+    keys = [(view["table"], "rowid")] + [
+        (table, other_column) for table, _, other_column in view["joins"]
+    ]
+    for table, key in keys:
+        for event in TRIGGER_EVENTS:
+            rows = {"insert": ["new"], "update": ["old", "new"], "delete": ["old"]}[event]
+            inserts = "\n".join(
+                f"insert into [{CHANGES_TABLE}] (view_name, table_name, key) "
+                f"values ('{view_name}', '{table}', {row}.[{key}]);"
+                for row in rows
+            )
+            name = trigger_name(view_name, table, event)
+            db.execute(f"drop trigger if exists [{name}]")
+            db.execute(f"""
+                create trigger [{name}] after {event} on [{table}]
+                begin
+                {inserts}
+                end
+            """)
+
+
+def has_triggers(db, view_name, view):
+    names = set(
+        row[0] for row in
+        db.execute("select name from sqlite_master where type = 'trigger'").fetchall()
+    )
+    tables = [view["table"]] + [j[0] for j in view["joins"]]
+    return all(
+        trigger_name(view_name, table, event) in names
+        for table in tables for event in TRIGGER_EVENTS
+    )
+
+
+def view_meta(db, view_name):
+    if VIEWS_META_TABLE not in db.table_names():
+        return None
+    rows = list(db.query(
+        f"select * from [{VIEWS_META_TABLE}] where view_name = ?", [view_name]
+    ))
+    return rows[0] if rows else None
+
+
+def why_rebuild(db, view_name, view):
+    # why the view needs building from scratch, or None if it can be
+    # refreshed from the change log
+    if view_name not in db.table_names():
+        return "missing"
+    meta = view_meta(db, view_name)
+    if not meta or json.loads(meta["definition"]) != json.loads(json.dumps(view_definition(db, view))):
+        return "definition changed"
+    if not has_triggers(db, view_name, view):
+        # a base table was replaced, we can't know what changed
+        return "change triggers missing"
+    return None
+
+
+def duplicate_join_keys(db, view):
+    # joined tables with more than one row for a join value would give a
+    # base row more than one view row. NULLs never match, so they're fine
+    return [
+        table
+        for table, _, other_column in view["joins"]
+        if db.execute(
+            f"select count([{other_column}]) - count(distinct [{other_column}]) from [{table}]"
+        ).fetchone()[0]
+    ]
+
+
+def build_view(db, view_name, view):
+    columns = view_columns(db, view)
+    column_sql = ", ".join(
+        f"[{view_column}] {column_type or 'TEXT'}"
+        for view_column, _, _, column_type in columns
+    )
+    with db.conn:
+        db.execute(f"drop table if exists [{view_name}]")
+        db.execute(f"create table [{view_name}] ({column_sql})")
+        db.execute(insert_sql(db, view_name, view))
+        create_triggers(db, view_name, view)
+        db.execute(f"delete from [{CHANGES_TABLE}] where view_name = ?", [view_name])
+    column_names = [c[0] for c in columns]
+    for index in view["indexes"]:
+        if all(c in column_names for c in index):
+            db[view_name].create_index(index, if_not_exists=True)
+    db.analyze(view_name)
+    db[VIEWS_META_TABLE].upsert({
+        "view_name": view_name,
+        "definition": json.dumps(view_definition(db, view)),
+        "built": datetime.now().isoformat(),
+        "refreshed": datetime.now().isoformat(),
+    }, pk="view_name")
+
+
+def refresh_view(db, view_name, view):
+    """
+    Recompute just the view rows that the logged changes touch. Returns
+    how many rows that was.
+    """
+    with db.conn:
+        db.execute("drop table if exists temp._jv_affected")
+        db.execute("create temp table _jv_affected (id integer primary key)")
+        db.execute(f"""
+            insert or ignore into temp._jv_affected
+            select key from [{CHANGES_TABLE}]
+            where view_name = ? and table_name = ?
+        """, [view_name, view["table"]])
+        for table, column, _ in view["joins"]:
+            # found through the view's copy of the join column, which is
+            # indexed
+            view_column = join_column(view, view["table"], column)
+            db.execute(f"""
+                insert or ignore into temp._jv_affected
+                select rowid from [{view_name}]
+                where [{view_column}] in (
+                    select key from [{CHANGES_TABLE}]
+                    where view_name = ? and table_name = ?
+                )
+            """, [view_name, table])
+        n_affected = db.execute("select count(*) from temp._jv_affected").fetchone()[0]
+        db.execute(f"delete from [{view_name}] where rowid in (select id from temp._jv_affected)")
+        db.execute(
+            f"{insert_sql(db, view_name, view)} "
+            f"where [{view['table']}].rowid in (select id from temp._jv_affected)"
+        )
+        db.execute(f"delete from [{CHANGES_TABLE}] where view_name = ?", [view_name])
+        db.execute("drop table temp._jv_affected")
+        db.execute(
+            f"update [{VIEWS_META_TABLE}] set refreshed = ? where view_name = ?",
+            [datetime.now().isoformat(), view_name]
+        )
+    return n_affected
+
+
+def ensure_changes_table(db):
+    if CHANGES_TABLE not in db.table_names():
+        db[CHANGES_TABLE].create({"view_name": str, "table_name": str, "key": int})
+        db[CHANGES_TABLE].create_index(["view_name", "table_name"])
+
+
+def usable_views(db, views=JOIN_VIEWS):
+    for view_name, view in views.items():
+        missing = missing_tables(db, view)
+        if missing:
+            print("Skipping", view_name, "missing tables", missing)
+            continue
+        duplicates = duplicate_join_keys(db, view)
+        if duplicates:
+            print("Skipping", view_name, "join columns aren't unique in", duplicates)
+            continue
+        yield view_name, view
+
+
+def build_join_views(db, force=False, views=JOIN_VIEWS):
+    """
+    Build every view that's missing or out of date. Returns the names of
+    the views that were built.
+    """
+    ensure_changes_table(db)
+    built = []
+    for view_name, view in usable_views(db, views):
+        reason = "forced" if force else why_rebuild(db, view_name, view)
+        if not reason:
+            print("Join view is up to date for", view_name)
+            continue
+        print(f"Building join view {view_name} ({reason})")
+        build_view(db, view_name, view)
+        built.append(view_name)
+    return built
+
+
+def refresh_join_views(db, views=JOIN_VIEWS):
+    """
+    Bring every view up to date with its base tables, only recomputing
+    the rows that changed (unless it needs building from scratch).
+    Returns view name => rows recomputed.
+    """
+    ensure_changes_table(db)
+    refreshed = {}
+    for view_name, view in usable_views(db, views):
+        reason = why_rebuild(db, view_name, view)
+        if reason:
+            print(f"Building join view {view_name} ({reason})")
+            build_view(db, view_name, view)
+            refreshed[view_name] = db[view_name].count
+            continue
+        refreshed[view_name] = refresh_view(db, view_name, view)
+        print("Refreshed", view_name, refreshed[view_name], "rows")
+    return refreshed
+
+
+def stale_join_views(db):
+    # views with changes logged that haven't been refreshed into them yet
+    if CHANGES_TABLE not in db.table_names():
+        return []
+    return [
+        row["view_name"] for row in
+        db.query(f"select distinct view_name from [{CHANGES_TABLE}]")
+    ]
+
+
+def check_join_views(db, db_path):
+    stale = stale_join_views(db)
+    if stale:
+        print("WARNING: Out of date join views", stale)
+        print(f"Refresh them with: python join_views.py refresh {db_path}")
+    return stale
+
+
+def join_view_help(data_help, views=JOIN_VIEWS):
+    """
+    DATA_HELP entries for the views: their own help, with the help for
+    the columns they were copied from filling in the rest.
+    """
+    view_help = {}
+    for view_name, view in views.items():
+        table_help = {}
+        for view_column, (table, column) in view["columns"].items():
+            help_text = data_help.get(table, {}).get(column)
+            if help_text:
+                table_help[view_column] = help_text
+        table_help.update(view["help"])
+        view_help[view_name] = table_help
+    return view_help
+
+
+def join_view_links(views=JOIN_VIEWS):
+    # TABLE_LINKS style (view, column, table, column) for the join columns
+    links = []
+    for view_name, view in views.items():
+        for table, column, other_column in view["joins"]:
+            view_column = join_column(view, view["table"], column)
+            if view_column:
+                links.append((view_name, view_column, table, other_column))
+    return links
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build and refresh the materialized join views")
+    parser.add_argument("command", choices=["build", "refresh"])
+    parser.add_argument("db_path", nargs="?", default=DB_PATH)
+    parser.add_argument("--force", action="store_true",
+                        help="Build every view from scratch")
+    args = parser.parse_args()
+
+    db = sqlite_utils.Database(args.db_path)
+    if args.command == "build":
+        built = build_join_views(db, force=args.force)
+        print("Built join views:", built)
+    else:
+        refreshed = refresh_join_views(db)
+        print("Refreshed join views:", json.dumps(refreshed))
@@ -1,196 +1,146 @@
-import json
 import os
-import re
 import sys
-import sqlite3
+import threading
 
 try:
     from llama_cpp import Llama
 except ModuleNotFoundError:
     print("llama_cpp not installed, continuing without")
 
-from actions import (
-    DB_PATH, load_db,
-    tables, schema, help, sql_query
-)
+from actions import ACTION_REGISTRY, DB_PATH, load_db, inject_schema_digest
+from agent import Agent, LlamaBackend
+from batched import BatchedEngine
+from loop_guard import MAX_REPEATS, MAX_STALE_TURNS
+from speculative import PromptLookupDecoding
 
 
 # Larger context sizes will reduce quality, but some models
 # support large contexts better than others.
 #CONTEXT_SIZE=2048
 CONTEXT_SIZE=2048*2
-# how many tokens to allow the model to output in a sigle go w/o stopping
-MAX_TOKENS=400
 
 
 # Utils n stuff
-def load_model(model_path, n_gpu_layers=0, n_threads=os.cpu_count() - 1,
-               n_ctx=CONTEXT_SIZE, temp=None, top_p=None):
+def load_model(model_path, n_gpu_layers=0, n_threads=None, n_ctx=None,
+               temp=None, top_p=None, prompt_lookup=False, runtime_profile=None):
     # for LLaMA2 70B models add kwarg: n_gqa=8 (NOTE: not required for GGUF models)
+    # runtime_profile is the settings autotune.py found to be fastest for
+    # this model on this machine. anything passed in explicitly wins
+    settings = {"n_threads": os.cpu_count() - 1, "n_ctx": CONTEXT_SIZE}
+    settings.update(runtime_profile or {})
+    if n_threads is not None:
+        settings["n_threads"] = n_threads
+    if n_ctx is not None:
+        settings["n_ctx"] = n_ctx
     print("Loading model", model_path)
-    print("CTX:", n_ctx, "GPU layers:", n_gpu_layers, "CPU threads:", n_threads)
+    print("CTX:", settings["n_ctx"], "GPU layers:", n_gpu_layers,
+          "CPU threads:", settings["n_threads"])
+    if runtime_profile:
+        print("Runtime profile:", runtime_profile)
     print("Temperature:", temp, "Top-p Sampling:", top_p)
     kwargs = dict(
+        settings,
         model_path=model_path,
-        n_ctx=n_ctx,
         n_gpu_layers=n_gpu_layers,
-        n_threads=n_threads,
         verbose=False
     )
     if temp is not None:
         kwargs["temp"] = temp
     if top_p is not None:
         kwargs["top_p"] = top_p
+    if prompt_lookup:
+        # speculative decoding w/ guesses copied from the context, see
+        # speculative.py
+        print("Using prompt lookup decoding")
+        kwargs["draft_model"] = PromptLookupDecoding()
     llm = Llama(**kwargs)
     return llm
 
 
 def execute(model_path, outfile=None, debug=True, return_dict=None,
-            prompt=None, n_gpu_layers=0, temp=None, top_p=None):
-    llm = load_model(model_path, n_gpu_layers=n_gpu_layers, temp=temp,
-                     top_p=top_p)
-    db = load_db(DB_PATH)
-    action_fns = {
-        "tables":  tables,
-        "schema": schema,
-        "help": help,
-        "sql-query": sql_query,
-    }
-    action_names_text = ", ".join(list(action_fns.keys()))
-    prompt_is_chatml = "<|im_start|>" in prompt
-    if debug:
-        print(prompt)
-
-    n_sequential_whitespace = 0
-    n_thoughts_seen = 0
-    done = False
-    while not done:
-        stream = llm(
-            prompt,
-            max_tokens=MAX_TOKENS,
-            stop=["Question:", "Observation:", "<|im_end|>", "<|im_start|>user"],
-            stream=True,
-            echo=True
-        )
-        response = ""
-        for i, token in enumerate(stream):
-            choice = token['choices'][0]
-            print(i, choice, end="\t\t\t\t\t\r")
-            token = choice["text"]
-            response += token
-            if token in ["", "\n"]:
-                n_sequential_whitespace += 1
-            else:
-                n_sequential_whitespace = 0
-            # detect repeating loop
-            if response.count("Thought: ") > 4:
-                done = True
-                break
-            if n_sequential_whitespace > 20:
-                done = True
-                break
-
-            with open("debug.log", "a") as f:
-                f.write(json.dumps(token))
-                f.write('\n')
-
-        if prompt_is_chatml and not response.strip().endswith("<|im_end|>"):
-            response = f"{response.strip()}\n<|im_end|>\n"
-
-        # Update the prompt
-        prompt = f"{prompt}{response}".strip()
-
-        if debug:
-            print(response)
-
-        if outfile:
-            print("Writing to tracefile", outfile)
-            with open(outfile, "w") as f:
-                f.write(prompt)
-
-        if done:
-            break
+            prompt=None, n_gpu_layers=0, temp=None, top_p=None,
+            inject_schema=False, llm=None, db=None, on_event=None,
+            prompt_lookup=False, max_repeats=MAX_REPEATS,
+            max_stale_turns=MAX_STALE_TURNS, budgets=None, hooks=None,
+            cancel=None, runtime_profile=None):
+    # a warm model and database can be passed in by long running callers
+    # (like server.py) so they don't get loaded again for every question
+    if llm is None:
+        llm = load_model(model_path, n_gpu_layers=n_gpu_layers, temp=temp,
+                         top_p=top_p, prompt_lookup=prompt_lookup,
+                         runtime_profile=runtime_profile)
+    if db is None:
+        db = load_db(DB_PATH)
+    if inject_schema:
+        prompt = inject_schema_digest(prompt, db)
+    agent = Agent(
+        LlamaBackend(llm), ACTION_REGISTRY, db, hooks=hooks,
+        max_repeats=max_repeats, max_stale_turns=max_stale_turns,
+        budgets=budgets
+    )
+    return agent.run(
+        prompt, outfile=outfile, debug=debug, return_dict=return_dict,
+        on_event=on_event, cancel=cancel
+    )
 
-        try:
-            action = re.findall(r"Action: (.*)", response, re.M)[0]
-        except IndexError:
-            action = None
 
+def execute_forked(model_path, n_tries, outfiles=None, debug=True,
+                   return_dict=None, prompt=None, n_gpu_layers=0, temp=None,
+                   top_p=None, inject_schema=False, cancel=None,
+                   runtime_profile=None):
+    """
+    Run n_tries sessions of the same prompt at the same time on one copy
+    of the model. The prompt only gets evaluated once and then its KV
+    cache is copied into each session (see BatchedEngine.fork). Returns
+    a list of (final_answer, trace, stop_reason, error), one per try.
+    """
+    # the Llama object's own context isn't used, so keep it small
+    llm = load_model(model_path, n_gpu_layers=n_gpu_layers, n_ctx=512,
+                     runtime_profile=runtime_profile)
+    if inject_schema:
+        prompt = inject_schema_digest(prompt, load_db(DB_PATH))
+    engine_kwargs = {}
+    if runtime_profile and runtime_profile.get("n_batch"):
+        engine_kwargs["n_batch"] = runtime_profile["n_batch"]
+    engine = BatchedEngine(
+        llm, n_seq=n_tries, seq_context_size=CONTEXT_SIZE, temp=temp,
+        top_p=top_p, **engine_kwargs
+    ).start()
+    sessions = engine.fork(prompt, n_tries)
+    results = [(None, prompt, None, None) for _ in range(n_tries)]
+
+    def run_try(i):
+        outfile = outfiles[i] if outfiles else None
+        try_result = {}
         try:
-            final_answer = re.findall(r'Final Answer: (.*)', response, re.M|re.S)[0]
-        except IndexError:
-            final_answer = None
-
-        if action and action not in action_fns:
-            action_names = ", ".join(list(action_fns.keys()))
-            if prompt_is_chatml:
-                prompt += f"""
-<|im_start|>user
-Observation: That's an invalid action. Valid actions: {action_names}
-<|im_end|>
-<|im_start|>assistant
-Thought: """
-            else:
-                prompt += f"""Observation: That's an invalid action. Valid actions: {action_names}
-Thought: """
-
-        elif action:
-            # NOTE: we could change 1 for the number of args of selected action
-            actionInputs = re.findall(
-                r'Action Input (\d): ```([^`]+)```', response, re.M|re.S
+            execute(
+                model_path, outfile=outfile, debug=debug, prompt=prompt,
+                llm=sessions[i], return_dict=try_result, cancel=cancel
             )
-            args = [
-                inp[1]
-                for inp in actionInputs
-            ]
-            action_fn = action_fns[action]
-            observation_text = ""
-            try:
-                print("Running action", action_fn, end="... \t")
-                result = action_fn(db, *args)
-                print("Done!", end="\r")
-                result_text = json.dumps(result)
-                observation_text = f"```{result_text}```"
-            except TypeError as e:
-                if "positional argument" not in str(e):
-                    raise e
-                # trim off the name of of the action from msg like:
-                #   hi() takes 1 positional argument but 2 were given
-                # and turn it into:
-                #   The action hi takes 1 Action Input but 2 were given
-                args_err_msg = str(e).split(" ", 1)[1].replace(
-                    "positional argument", "Action Input"
-                ).replace(
-                    "positional arguments", "Action Inputs"
-                ).split(": '", 1)[0]
-                observation_text = f"The action {action} {args_err_msg}"
-            if prompt_is_chatml:
-                prompt += f"""
-<|im_start|>user
-Observation: {observation_text}
-<|im_end|>
-<|im_start|>assistant
-Thought: """
-            else:
-                prompt += f"""
-Observation: {observation_text}
-Thought: """
-
-        elif final_answer:
-            if return_dict is not None:
-                return_dict["final_answer"] = final_answer.replace(
-                    "<|im_end|>", ""
-                ).strip()
-                return_dict["trace"] = prompt
-            return final_answer, prompt
-
-        # TODO: truncate the prompt if its grown too long
-        # using tiktoken and some keep_n value of context
+        except Exception as e:
+            # otherwise it dies with the thread and the try just looks
+            # like it never answered
+            print(f"ERROR in try {i}: {e}")
+            try_result["error"] = f"{e}"
+            try_result["stop_reason"] = "error"
+        results[i] = (
+            try_result.get("final_answer"), try_result.get("trace", prompt),
+            try_result.get("stop_reason"), try_result.get("error")
+        )
+
+    threads = [
+        threading.Thread(target=run_try, args=(i,), name=f"Try {i}")
+        for i in range(n_tries)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.stop()
 
     if return_dict is not None:
-        return_dict["final_answer"] = None
-        return_dict["trace"] = prompt
-    return None, prompt
+        return_dict["results"] = results
+    return results
 
 
 if __name__ == "__main__":
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import re
+
+
+# how many repeated actions we'll answer from memory before ending the
+# session
+MAX_REPEATS = 3
+# end the session after this many turns in a row without anything new: no
+# action, an invalid action, a repeat or a result we've already seen
+MAX_STALE_TURNS = 4
+
+# reasons a session ended, stored as return_dict["stop_reason"]
+STOP_FINAL_ANSWER = "final_answer"
+STOP_REPEATED_ACTION = "repeated_action"
+STOP_NO_PROGRESS = "no_progress"
+STOP_THOUGHT_LOOP = "thought_loop"
+STOP_WHITESPACE = "whitespace"
+STOP_TOKEN_LIMIT = "token_limit"
+STOP_CANCELLED = "cancelled"
+
+
+def action_key(action, args):
+    # whitespace differences in the inputs don't make it a different query
+    normalized = [re.sub(r"\s+", " ", str(a)).strip() for a in args]
+    data = json.dumps([action, normalized])
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def repeat_observation(observation_text):
+    return (
+        "You already ran this action with these inputs. The result hasn't "
+        f"changed: {observation_text} Try something different or give "
+        "your Final Answer."
+    )
+
+
+class LoopGuard:
+    """
+    Keeps track of the actions a session has run so repeats can be
+    answered from memory instead of running them again, and tells the
+    executor when a session is stuck and should be ended. Works as an
+    agent.Hook.
+    """
+
+    def __init__(self, max_repeats=MAX_REPEATS, max_stale_turns=MAX_STALE_TURNS):
+        self.max_repeats = max_repeats
+        self.max_stale_turns = max_stale_turns
+        # action key => observation text
+        self.seen = {}
+        self.seen_observations = set()
+        self.n_repeats = 0
+        self.n_stale_turns = 0
+        self.stop_reason = None
+
+    def stale_turn(self):
+        self.n_stale_turns += 1
+        if self.max_stale_turns and self.n_stale_turns >= self.max_stale_turns:
+            self.stop_reason = self.stop_reason or STOP_NO_PROGRESS
+
+    def repeated(self, action, args):
+        """
+        The observation to give for an action we've already run, or None
+        if it's new.
+        """
+        observation_text = self.seen.get(action_key(action, args))
+        if observation_text is None:
+            return None
+        self.n_repeats += 1
+        if self.max_repeats is not None and self.n_repeats > self.max_repeats:
+            self.stop_reason = STOP_REPEATED_ACTION
+        self.stale_turn()
+        return repeat_observation(observation_text)
+
+    def record(self, action, args, observation_text):
+        self.seen[action_key(action, args)] = observation_text
+        # a different query with the same result doesn't get us anywhere
+        if observation_text in self.seen_observations:
+            self.stale_turn()
+        else:
+            self.n_stale_turns = 0
+        self.seen_observations.add(observation_text)
+
+    def before_action(self, action, args):
+        return self.repeated(action.name, args)
+
+    def after_action(self, action, args, observation_text, seconds):
+        self.record(action.name, args, observation_text)
+
+    def stats(self):
+        return {"repeated_actions": self.n_repeats}
@@ -1,3 +1,4 @@
+import math
 import re
 
 
@@ -88,3 +89,54 @@ def get_keyword_matches(result, correct_keywords, return_texts=False):
     if return_texts:
         return matches, match_texts
     return matches
+
+
+def normalize_answer(answer):
+    answer = re.sub(r"\s+", " ", answer.lower()).strip()
+    return answer.rstrip(".!")
+
+
+def majority_answer(answers):
+    """
+    The most common answer out of several tries (ignoring case,
+    whitespace and trailing punctuation). Ties go to whichever answer
+    showed up first.
+    """
+    counts = {}
+    originals = {}
+    for answer in answers:
+        if not answer:
+            continue
+        key = normalize_answer(answer)
+        counts[key] = counts.get(key, 0) + 1
+        originals.setdefault(key, answer)
+    if not counts:
+        return None
+    best = max(counts, key=lambda k: counts[k])
+    return originals[best]
+
+
+# two sided 95% Student's t critical values, by degrees of freedom. past
+# the end of the table the normal distribution's 1.96 is close enough
+T_95 = [
+    None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+    2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093,
+    2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045,
+    2.042,
+]
+
+
+def confidence_interval(values):
+    """
+    Mean of the values and the half width of its 95% confidence interval.
+    The width is infinite until there are at least two values.
+    """
+    n = len(values)
+    if not n:
+        return None, math.inf
+    mean = sum(values) / n
+    if n < 2:
+        return mean, math.inf
+    variance = sum((v - mean) ** 2 for v in values) / (n - 1)
+    t = T_95[n - 1] if n - 1 < len(T_95) else 1.96
+    return mean, t * math.sqrt(variance / n)
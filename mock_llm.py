@@ -0,0 +1,48 @@
+import re
+
+
+# What the mock model says on each turn of a session. It looks at the
+# tables, runs a query and then answers, which exercises every part of the
+# ReAct loop without needing a real model.
+MOCK_SCRIPT = [
+    "I should look at which tables I have available.\nAction: tables\n",
+    "I should count the users.\nAction: sql-query\nAction Input 1: ```select count(*) as n_users from users```\n",
+    "I now know the final answer.\nFinal Answer: This is a mock answer to: {question}\n",
+]
+
+
+class MockLlama:
+    """
+    A stand-in for llama_cpp.Llama that follows MOCK_SCRIPT instead of
+    running a model. Useful for testing things like server.py and the
+    benchmark runner on machines without the models.
+    """
+
+    def __init__(self, model_path=None, script=None, **kwargs):
+        self.model_path = model_path
+        self.script = script or MOCK_SCRIPT
+
+    def tokenize(self, text):
+        return [len(t) for t in re.findall(r"\s*\S+", text)]
+
+    def response_for(self, prompt):
+        # only count the turns after the real question, not the examples
+        session = prompt.rsplit("Question:", 1)[-1]
+        question = session.split("\n", 1)[0].strip()
+        turn = min(session.count("Observation:"), len(self.script) - 1)
+        return self.script[turn].format(question=question)
+
+    def __call__(self, prompt, max_tokens=None, stop=None, stream=False,
+                 echo=False, **kwargs):
+        text = self.response_for(prompt)
+        if not stream:
+            return {"choices": [{
+                "text": f"{prompt}{text}" if echo else text,
+                "finish_reason": "stop",
+            }]}
+        return self.stream(text)
+
+    def stream(self, text):
+        # stream back roughly a word at a time, like tokens
+        for token in re.findall(r"\s*\S+|\s+", text):
+            yield {"choices": [{"text": token, "finish_reason": None}]}
@@ -0,0 +1,90 @@
+import json
+
+
+# Rough token estimate, we don't have a tokenizer that works across the
+# llama.cpp and OpenAI backends, so use the common ~4 chars per token rule
+CHARS_PER_TOKEN = 4
+# max tokens any single cell value can take up in an observation
+MAX_CELL_TOKENS = 48
+# max tokens for the entire observation text
+MAX_OBSERVATION_TOKENS = 400
+ELLIPSIS = "..."
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate_text(text, max_tokens):
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars].rstrip()}{ELLIPSIS}"
+
+
+def truncate_value(value, max_tokens=MAX_CELL_TOKENS):
+    if isinstance(value, str):
+        return truncate_text(value, max_tokens)
+    return value
+
+
+def is_rows(result):
+    return (
+        isinstance(result, list)
+        and len(result) > 0
+        and all(isinstance(r, dict) for r in result)
+    )
+
+
+def rows_to_table(rows, max_cell_tokens=MAX_CELL_TOKENS):
+    """
+    Turn a list of row dicts into a header row of column names followed
+    by one row of values per result. The column names only get written
+    out once instead of being repeated for every row.
+    """
+    header = []
+    for row in rows:
+        for key in row.keys():
+            if key not in header:
+                header.append(key)
+    table = [header]
+    for row in rows:
+        table.append([
+            truncate_value(row.get(key), max_tokens=max_cell_tokens)
+            for key in header
+        ])
+    return table
+
+
+def compact_observation(result, max_cell_tokens=MAX_CELL_TOKENS,
+                        max_tokens=MAX_OBSERVATION_TOKENS):
+    """
+    Turn the result of an action into the text we'll put in the
+    Observation, keeping it as small as possible since every token here
+    gets re-evaluated on every later turn.
+    """
+    if isinstance(result, str):
+        return truncate_text(result, max_tokens)
+
+    if not is_rows(result):
+        result_text = json.dumps(result, ensure_ascii=False)
+        if estimate_tokens(result_text) <= max_tokens:
+            return result_text
+        return truncate_text(result_text, max_tokens)
+
+    table = rows_to_table(result, max_cell_tokens=max_cell_tokens)
+    lines = [json.dumps(table[0], ensure_ascii=False)]
+    n_rows = len(table) - 1
+    for i, row in enumerate(table[1:]):
+        line = json.dumps(row, ensure_ascii=False)
+        remaining = n_rows - i
+        more_text = f"({remaining} more rows omitted)"
+        used = estimate_tokens("\n".join(lines + [line]))
+        # leave room for the omitted rows note if there's more to come
+        if remaining > 1:
+            used += estimate_tokens(more_text) + 1
+        if used > max_tokens:
+            lines.append(more_text)
+            break
+        lines.append(line)
+    return "\n".join(lines)
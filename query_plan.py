@@ -0,0 +1,184 @@
+import re
+
+
+# Don't run queries that look like they'll need to visit more rows than
+# this. A hint about how to fix the query is returned instead.
+MAX_QUERY_COST = 10_000_000
+# rough guesses for when sqlite_stat1 doesn't have anything better
+DEFAULT_ROWS_PER_KEY = 10
+RANGE_FRACTION = 0.25
+VIRTUAL_TABLE_ROWS = 100
+
+# (db, table name) => estimated row count, cached for the process
+_row_estimates = {}
+
+
+def explain_query_plan(db, query):
+    return [
+        {"id": row[0], "parent": row[1], "detail": row[3]}
+        for row in db.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+    ]
+
+
+def clear_row_estimates():
+    _row_estimates.clear()
+
+
+def stat1_rows(db, table_name):
+    if "sqlite_stat1" not in db.table_names():
+        return []
+    return list(db.query(
+        "select idx, stat from sqlite_stat1 where tbl = ?", [table_name]
+    ))
+
+
+def estimate_table_rows(db, table_name):
+    key = (db, table_name)
+    if key in _row_estimates:
+        return _row_estimates[key]
+    estimate = None
+    for row in stat1_rows(db, table_name):
+        estimate = int(row["stat"].split()[0])
+        break
+    if estimate is None:
+        # max(rowid) is just a seek to the end of the table's b-tree,
+        # unlike count(*) which has to read the whole thing
+        try:
+            estimate = next(db.query(
+                f"select max(rowid) as n from [{table_name}]"
+            ))["n"] or 0
+        except Exception:
+            estimate = 0
+    _row_estimates[key] = estimate
+    return estimate
+
+
+def estimate_rows_per_key(db, table_name, index_name):
+    for row in stat1_rows(db, table_name):
+        if row["idx"] != index_name:
+            continue
+        stats = row["stat"].split()
+        if len(stats) > 1 and stats[1].isdigit():
+            return int(stats[1])
+    return DEFAULT_ROWS_PER_KEY
+
+
+def resolve_table(db, query, name):
+    """
+    The query plan uses the alias a table was given in the query, if
+    there was one, so find the table it refers to.
+    """
+    table_names = db.table_names()
+    if name in table_names:
+        return name
+    for match in re.finditer(
+        rf"\[?(\w+)\]?\s+(?:as\s+)?\[?{re.escape(name)}\]?\b", query, re.I
+    ):
+        if match.group(1) in table_names:
+            return match.group(1)
+    return name
+
+
+def parse_plan_step(db, query, detail):
+    """
+    Turn one line of a query plan into the table it reads, the kind of
+    access and how many rows we expect that access to produce.
+    """
+    match = re.match(r"(SCAN|SEARCH)( TABLE)? \[?(\w+)\]?(.*)", detail)
+    if not match:
+        return None
+    access, _, name, rest = match.groups()
+    table_name = resolve_table(db, query, name)
+    n_rows = estimate_table_rows(db, table_name)
+    step = {
+        "table": table_name,
+        "detail": detail,
+        "full_scan": False,
+        "automatic_index": "AUTOMATIC" in rest,
+        "build_cost": 0,
+        "rows": n_rows,
+    }
+    if "VIRTUAL TABLE" in rest:
+        step["rows"] = VIRTUAL_TABLE_ROWS
+    elif access == "SCAN":
+        step["full_scan"] = True
+    elif "AUTOMATIC" in rest:
+        # sqlite builds a temporary index on every run of the query
+        step["build_cost"] = n_rows
+        step["rows"] = DEFAULT_ROWS_PER_KEY
+    elif re.search(r"\([^)]*[<>]", rest):
+        step["rows"] = max(1, int(n_rows * RANGE_FRACTION))
+    elif "INTEGER PRIMARY KEY" in rest:
+        step["rows"] = 1
+    else:
+        index_match = re.search(r"INDEX (\S+)", rest)
+        index_name = index_match.group(1) if index_match else None
+        step["rows"] = estimate_rows_per_key(db, table_name, index_name)
+    return step
+
+
+def estimate_query_cost(db, query, plan=None):
+    """
+    Estimate how many rows a query will visit from its query plan. Each
+    loop's rows get multiplied by the rows of the loops it's nested in.
+    Returns the estimated cost and the plan steps with each step's cost.
+    """
+    if plan is None:
+        plan = explain_query_plan(db, query)
+    # rows produced by the outer loops, per parent in the plan tree
+    outer_rows = {}
+    steps = []
+    total = 0
+    for item in plan:
+        step = parse_plan_step(db, query, item["detail"])
+        if step is None:
+            continue
+        outer = outer_rows.get(item["parent"], 1)
+        step["outer_rows"] = outer
+        step["cost"] = outer * step["rows"] + step["build_cost"]
+        total += step["cost"]
+        outer_rows[item["parent"]] = outer * max(step["rows"], 1)
+        steps.append(step)
+    return total, steps
+
+
+def indexed_columns(db, table_name):
+    table = db[table_name]
+    columns = [pk for pk in table.pks if pk != "rowid"]
+    for index in table.indexes:
+        for column in index.columns:
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+
+def check_query_plan(db, query, max_cost=MAX_QUERY_COST):
+    """
+    Returns an explanation and suggestion for the model if the query
+    looks like it'll be too slow to run, otherwise None. A single pass
+    over a table is allowed (there's often no other way to answer the
+    question) unless it's a LIKE text scan, which the search action can
+    do much faster.
+    """
+    cost, steps = estimate_query_cost(db, query)
+    if cost <= max_cost:
+        return None
+    worst = max(steps, key=lambda s: s["cost"])
+    table_name = worst["table"]
+    n_rows = estimate_table_rows(db, table_name)
+    is_like_scan = re.search(r"\blike\s+['\"]%", query, re.I)
+    if worst["automatic_index"]:
+        problem = f"it joins on an unindexed column of {table_name} (~{n_rows:,} rows)"
+    elif worst["full_scan"] and worst["outer_rows"] > 1:
+        problem = f"it scans every row of {table_name} (~{n_rows:,} rows) once for each of ~{worst['outer_rows']:,} rows from another table"
+    elif worst["full_scan"] and is_like_scan:
+        problem = f"it scans the text of every row of {table_name} (~{n_rows:,} rows)"
+    else:
+        return None
+    suggestion = ""
+    indexed = indexed_columns(db, table_name)
+    if indexed:
+        suggestion = f" Try filtering or joining {table_name} on one of its indexed columns: {indexed}."
+    if is_like_scan:
+        suggestion += " To find text, use the search action instead of LIKE."
+    return f"Error: This query would be too slow because {problem}.{suggestion}"
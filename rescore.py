@@ -13,6 +13,7 @@ except ImportError:
     from yaml import Loader, Dumper
 
 from metrics import get_keyword_matches
+from traces import read_trace, trace_exists
 
 
 def load_yml_file(filename):
@@ -22,26 +23,25 @@ def load_yml_file(filename):
 
 def final_answer_from_trace_or_result(tracepath, result=None):
     final_answer = ""
-    if not os.path.exists(tracepath):
+    if not trace_exists(tracepath):
         return result or ""
-    with open(tracepath, "r") as f:
-        lines = f.readlines()
-        i = 0
-        while "Final Answer: " in "\n".join(lines):
-            try:
-                line = lines.pop()
-            except IndexError:
-                return final_answer
-            if not line.startswith("Final Answer:"):
-                continue
-            final_answer += line
-            if line.startswith("<|im_end|>"):
-                break
-            if line.startswith("Thought: "):
-                break
-            if line.startswith("Question: "):
-                break
-            i += 1
+    lines = read_trace(tracepath).splitlines(keepends=True)
+    i = 0
+    while "Final Answer: " in "\n".join(lines):
+        try:
+            line = lines.pop()
+        except IndexError:
+            return final_answer
+        if not line.startswith("Final Answer:"):
+            continue
+        final_answer += line
+        if line.startswith("<|im_end|>"):
+            break
+        if line.startswith("Thought: "):
+            break
+        if line.startswith("Question: "):
+            break
+        i += 1
     return final_answer.replace("<|im_end|>", "")
 
 
@@ -106,7 +106,7 @@ if __name__ == "__main__":
 
                     tracefile = result["tracefiles"][index]
                     print("tracefile", tracefile)
-                    if not os.path.exists(tracefile):
+                    if not trace_exists(tracefile):
                         tracefile = "missing"
 
                     final_answer = result["answers"][index] or ""
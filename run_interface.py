@@ -1,42 +1,27 @@
-import json
 import os
-import re
 import sys
 import sqlite3
 
 from llama_cpp import Llama
-import sqlite_utils
+
+from agent import (
+    ActionRegistry, Agent, LlamaBackend, COST_FREE, COST_CHEAP, COST_EXPENSIVE
+)
+from db_profiles import DB_PROFILE, connect
+from fts import TABLE_FTS, search_fts, check_fts_indexes
+from sampling import approximate_common_values, should_sample
 
 
 DB_PATH = "example.db"
 MODEL_PATH = "dolphin-2.2.1-mistral-7b.Q5_K_M.gguf"
 # columns to not ever use or show
 IGNORED_COLUMNS = ["rowid", "created_at", "_meta_score"]
-TABLE_FTS = {
-    "users": ["creatorDescription"],
-    "jobs": ["title", "description"],
-    "experiences": ["projectName", "experienceDescription", "jobRole"],
-    "games": ["name", "description"],
-    "game_passes": ["name", "description"],
-}
-# search-tables: useful for getting a list of tables that support full-text search. input 1: table name.
-# search: a full-text search engine. useful to find records with descriptions containing some text. input 1: table name, input 2: a search query.
-ACTIONS = """
-tables: useful for getting the names of tables available. no input.
-columns: useful for looking all of the columns for a given table. input 1: table name.
-facets: useful for looking at the unique values and counts for a given column. input 1: table name, input 2: column name.
-filter: useful for getting the first row where the column matches a given value. input 1: table name, input 2: column name, input 3: a value to filter on.
-"""
-
-
-def load_db(path):
+
+
+def load_db(path, profile=DB_PROFILE):
     assert os.path.exists(path), f"Database doesn't exist: {path}"
-    db = sqlite_utils.Database(path)
-    for table, fields in TABLE_FTS.items():
-        try:
-            db[table].enable_fts(fields, create_triggers=True)
-        except sqlite3.OperationalError:
-            pass
+    db = connect(path, profile=profile)
+    check_fts_indexes(db, path)
     return db
 
 
@@ -62,6 +47,13 @@ def clean_truncate(results, n=3):
 
 
 ## ACTIONS
+ACTION_REGISTRY = ActionRegistry()
+
+
+@ACTION_REGISTRY.register(
+    "tables", cost=COST_FREE,
+    description="useful for getting the names of tables available. no input."
+)
 def tables(db):
     return [
         name
@@ -70,6 +62,10 @@ def tables(db):
     ]
 
 
+@ACTION_REGISTRY.register(
+    "columns", arity=1, cost=COST_FREE,
+    description="useful for looking all of the columns for a given table. input 1: table name."
+)
 def columns(db, table_name):
     table_names = tables(db)
     if table_name not in table_names:
@@ -81,6 +77,10 @@ def columns(db, table_name):
     ]
 
 
+@ACTION_REGISTRY.register(
+    "facets", arity=2, cost=COST_EXPENSIVE,
+    description="useful for looking at the unique values and counts for a given column. input 1: table name, input 2: column name."
+)
 def facets(db, table_name, column):
     table_names = tables(db)
     if table_name not in table_names:
@@ -88,6 +88,19 @@ def facets(db, table_name, column):
     column_names = columns(db, table_name)
     if column not in column_names:
         return f"Invalid column. Valid columns are: {column_names}"
+    # big tables get approximate counts from a random sample of rows
+    if should_sample(db, table_name):
+        estimate = approximate_common_values(
+            db, table_name, column, limit=5,
+            is_array=is_array_field(db, table_name, column)
+        )
+        return {
+            "note": f"approximate counts from a random sample of {estimate['sample_size']} rows",
+            "values": [
+                [value, f"~{count} (+/- {margin})"]
+                for value, count, margin in estimate["values"]
+            ],
+        }
     if is_array_field(db, table_name, column):
         results = db.query(f"""
             SELECT value, count(*) AS count
@@ -113,6 +126,10 @@ def facets(db, table_name, column):
     ]
 
 
+@ACTION_REGISTRY.register(
+    "filter", arity=3, cost=COST_EXPENSIVE,
+    description="useful for getting the first row where the column matches a given value. input 1: table name, input 2: column name, input 3: a value to filter on."
+)
 def filter(db, table_name, column, value):
     table_names = tables(db)
     if table_name not in table_names:
@@ -131,8 +148,17 @@ def filter(db, table_name, column, value):
     return clean_truncate(results, n=1)
 
 
+@ACTION_REGISTRY.register(
+    "search", arity=2, cost=COST_CHEAP,
+    description="a full-text search engine. useful to find records with descriptions containing some text. input 1: table name, input 2: a search query."
+)
 def search(db, table_name, query):
-    results = list(db[table_name].search(query))
+    if table_name not in TABLE_FTS:
+        return f"Invalid table. Searchable tables are: {list(TABLE_FTS.keys())}"
+    try:
+        results = search_fts(db, table_name, query)
+    except sqlite3.OperationalError as e:
+        return f"Search error: {e}"
     return clean_truncate(results)
 
 
@@ -141,18 +167,14 @@ def load_model(model_path):
     return Llama(model_path=model_path, n_ctx=2048)
 
 
-def execute(llm, question):
-    action_fns = {
-        "tables":  tables,
-        "columns": columns,
-        "facets": facets,
-        "filter": filter,
-    }
-    action_names_text = ", ".join(list(action_fns.keys()))
+def execute(llm, question, db=None):
+    if db is None:
+        db = load_db(DB_PATH)
+    action_names_text = ", ".join(ACTION_REGISTRY.names())
     prompt = f"""
 Answer the following questions as best you can. You have access to the following tools:
 
-{ACTIONS.strip()}
+{ACTION_REGISTRY.describe()}
 
 Use the following format:
 
@@ -201,88 +223,19 @@ Begin!
 
 Question: {question.strip()}
 Thought:""".strip()
-    print(prompt)
-
-    # allow the LLM to try 15 goes to get to an answer
-    attempts = 0
-    while attempts < 15:
-        attempts += 1
-        # print(f"** running attempt: {attempts}")
-
-        output = llm(
-            prompt,
-            max_tokens=256,
-            stop=["Question:", "Observation:"],
-            echo=True
-        )
-        # print("** output:", output)
-
-        # get the response minus our prompt (just the new stuff)
-        response = output["choices"][0]["text"].replace(prompt, "").strip()
-        #print(f"** response:\n{response}")
-        print(f"\n{response}")
-
-        try:
-            action = re.findall(r"Action: (.*)", response, re.M)[0]
-        except IndexError:
-            action = None
-        # print("** action:", action)
-
-        try:
-            final_answer = re.findall(r'Final Answer: (.*)', response, re.M)[0]
-        except IndexError:
-            final_answer = None
-        # print("** final answer:", final_answer)
-
-        if action and action not in action_fns:
-            prompt = output["choices"][0]["text"].strip()
-            action_names = ", ".join(list(action_fns.keys()))
-            prompt += f"\nObservation: That's an invalid action. Valid actions: {action_names}\n"
-
-        elif action:
-            # force to have quotes
-            actionInputs = re.findall(
-                r'Action Input (\d): "(.*)"', response, re.M
-            )
-            args = [
-                inp[1]
-                for inp in actionInputs
-            ]
-            action_fn = action_fns[action]
-            # print("** action_fn:", action_fn, "args", args)
-            try:
-                observation = action_fn(db, *args)
-            except TypeError as e:
-                if "positional argument" not in str(e):
-                    raise e
-                # trim off the name of of the action from msg like:
-                #   hi() takes 1 positional argument but 2 were given
-                # and turn it into:
-                #   The action hi takes 1 Action Input but 2 were given
-                args_err_msg = str(e).split(" ", 1)[1].replace(
-                    "positional argument", "Action Input"
-                ).replace(
-                    "positional arguments", "Action Inputs"
-                ).split(": '", 1)[0]
-                observation = f"The action {action} {args_err_msg}"
-            # print("** observation:", observation)
-            observation_text = json.dumps(observation)
-            print(f"Observation: {observation_text}\n")
-            prompt = output["choices"][0]["text"].strip()
-            prompt += f"\nObservation: {observation_text}\n"
-
-        elif final_answer:
-            trace = output["choices"][0]["text"]
-            return final_answer, trace
-
-        # TODO: truncate the prompt if its grown too long
-        # using tiktoken and some keep_n value of context
-
-    return None, output["choices"][0]["text"]
+    agent = Agent(
+        LlamaBackend(llm, max_tokens=256, stop=["Question:", "Observation:"]),
+        ACTION_REGISTRY, db,
+        # allow the LLM to try 15 goes to get to an answer
+        max_turns=15,
+        # the examples in the prompt don't put observations in backticks
+        fence_observations=False
+    )
+    return agent.run(prompt)
 
 
 if __name__ == "__main__":
     question = sys.argv[1]
     db = load_db(DB_PATH)
     llm = load_model(MODEL_PATH)
-    answer, trace = execute(llm, question)
+    answer, trace = execute(llm, question, db=db)
@@ -0,0 +1,136 @@
+import json
+import math
+import random
+from collections import Counter
+
+from query_plan import estimate_table_rows
+
+
+# tables with more rows than this get sampled instead of fully counted
+SAMPLE_THRESHOLD = 1_000_000
+# the largest error we'll accept in a value's estimated share of the
+# table (0.01 == +/- 1%), at 95% confidence. this decides the sample size
+SAMPLE_ERROR = 0.01
+# force a sample size instead of working it out from SAMPLE_ERROR
+SAMPLE_SIZE = None
+Z_95 = 1.96
+# "rowid" picks random rowids, which only needs to read the sampled rows.
+# "reservoir" streams the whole column once but works for any table
+SAMPLE_METHOD = "rowid"
+
+
+def sample_size_for_error(error=SAMPLE_ERROR, z=Z_95):
+    # worst case variance of a proportion is at p = 0.5
+    return math.ceil(z * z * 0.25 / (error * error))
+
+
+def should_sample(db, table_name, threshold=SAMPLE_THRESHOLD):
+    return estimate_table_rows(db, table_name) > threshold
+
+
+def max_rowid(db, table_name):
+    # the end of the rowid b-tree, so this doesn't scan anything
+    return db.execute(f"select max(rowid) from [{table_name}]").fetchone()[0]
+
+
+def rowid_sample(db, table_name, column, n, max_rowid, n_rows=None):
+    # there can be gaps in the rowids (deleted rows), so ask for enough more
+    # than we need to make up for them
+    rowids = set()
+    density = min(1, n_rows / max_rowid) if n_rows else 1
+    n_wanted = min(max_rowid, int(n * 1.2 / density))
+    while len(rowids) < n_wanted:
+        rowids.add(random.randint(1, max_rowid))
+    values = []
+    rowids = sorted(rowids)
+    for i in range(0, len(rowids), 1000):
+        chunk = ", ".join(str(r) for r in rowids[i:i + 1000])
+        values.extend(
+            row["value"]
+            for row in db.query(
+                f"select [{column}] as value from [{table_name}] where rowid in ({chunk})"
+            )
+        )
+    # values came back in rowid order, so just cutting off the end would
+    # never keep the newest rows
+    if len(values) > n:
+        values = random.sample(values, n)
+    return values
+
+
+def reservoir_sample(db, table_name, column, n):
+    sample = []
+    rows = db.query(f"select [{column}] as value from [{table_name}]")
+    for i, row in enumerate(rows):
+        if i < n:
+            sample.append(row["value"])
+            continue
+        j = random.randint(0, i)
+        if j < n:
+            sample[j] = row["value"]
+    return sample
+
+
+def sample_column(db, table_name, column, n, method=SAMPLE_METHOD):
+    values = []
+    if method == "rowid":
+        # the row count (from sqlite_stat1) isn't the highest rowid once
+        # rows have been deleted, and using it would never sample the newest rows
+        top_rowid = max_rowid(db, table_name)
+        if top_rowid:
+            values = rowid_sample(
+                db, table_name, column, n, top_rowid,
+                n_rows=estimate_table_rows(db, table_name)
+            )
+    # fall back if the rowids were too sparse to get a decent sample
+    if len(values) < n // 2:
+        values = reservoir_sample(db, table_name, column, n)
+    return values
+
+
+def explode_arrays(values):
+    exploded = []
+    for value in values:
+        if not isinstance(value, str) or not value.startswith("["):
+            exploded.append(value)
+            continue
+        try:
+            exploded.extend(json.loads(value))
+        except json.decoder.JSONDecodeError:
+            exploded.append(value)
+    return exploded
+
+
+def approximate_common_values(db, table_name, column, limit=5, is_array=False,
+                              error=SAMPLE_ERROR, sample_size=SAMPLE_SIZE,
+                              method=SAMPLE_METHOD):
+    """
+    Estimate the most common values of a column, and how many rows have
+    them, from a random sample of the table. Returns a dict with the
+    values as [value, estimated count, +/- margin] and the sample size.
+    """
+    n = sample_size or sample_size_for_error(error)
+    n_rows = estimate_table_rows(db, table_name)
+    sample = sample_column(db, table_name, column, n, method=method)
+    n_sampled = len(sample)
+    if not n_sampled:
+        return {"values": [], "sample_size": 0, "n_rows": n_rows}
+    if is_array:
+        sample = explode_arrays(sample)
+    counts = Counter(v for v in sample if v is not None and v != "")
+    values = []
+    for value, count in counts.most_common(limit):
+        # a value can come up more than once in a row's array, which
+        # would put p over 1 (and the sqrt below would blow up)
+        p = min(1.0, count / n_sampled)
+        margin = Z_95 * math.sqrt(p * (1 - p) / n_sampled)
+        values.append([
+            value,
+            round(p * n_rows),
+            round(margin * n_rows),
+        ])
+    return {
+        "values": values,
+        "sample_size": n_sampled,
+        "n_rows": n_rows,
+    }
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Build the word vector indexes used by the semantic-search action. Like
+the FTS indexes, this only needs to be done once per database:
+
+    python semantic.py [example.db] [--force]
+"""
+import json
+import os
+import sys
+
+import numpy as np
+import sqlite_utils
+
+from fts import TABLE_FTS, table_fingerprint
+
+
+DB_PATH = "example.db"
+VECTORS_DIR = "./vectors/"
+SPACY_MODEL = "en_core_web_lg"
+SEMANTIC_SEARCH_LIMIT = 5
+# how much of the matching text to show in the results
+SNIPPET_CHARS = 120
+BATCH_SIZE = 1000
+
+# HACK: globals, loaded on first use so the actions that don't need
+# spaCy don't pay to load it
+nlp = None
+# table name => (rowids, memory mapped vectors)
+_vector_indexes = {}
+
+
+def get_nlp():
+    global nlp
+    if nlp is None:
+        import spacy
+        print("Loading NLP model", SPACY_MODEL)
+        nlp = spacy.load(SPACY_MODEL)
+    return nlp
+
+
+def vector_paths(table_name, vectors_dir=VECTORS_DIR):
+    base = os.path.join(vectors_dir, table_name)
+    return f"{base}.f32", f"{base}.rowids.npy", f"{base}.json"
+
+
+def embed_texts(texts):
+    """
+    Average word vectors for each text, normalized to unit length so the
+    cosine similarity is just a dot product.
+    """
+    model = get_nlp()
+    vectors = np.zeros((len(texts), model.vocab.vectors_length), dtype=np.float32)
+    # we only need the static word vectors, so skip the rest of the pipeline
+    for i, doc in enumerate(model.tokenizer.pipe(texts)):
+        vectors[i] = doc.vector
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def row_text(row, fields):
+    return "\n".join([
+        f"{row[field]}"
+        for field in fields
+        if row[field]
+    ])
+
+
+def vector_meta(table_name, vectors_dir=VECTORS_DIR):
+    _, _, meta_path = vector_paths(table_name, vectors_dir=vectors_dir)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "r") as f:
+        return json.load(f)
+
+
+def is_vector_index_stale(db, table_name, vectors_dir=VECTORS_DIR):
+    meta = vector_meta(table_name, vectors_dir=vectors_dir)
+    if not meta:
+        return True
+    return meta["fingerprint"] != table_fingerprint(db, table_name)
+
+
+def build_vector_index(db, table_name, vectors_dir=VECTORS_DIR):
+    fields = TABLE_FTS[table_name]
+    vectors_path, rowids_path, meta_path = vector_paths(
+        table_name, vectors_dir=vectors_dir
+    )
+    n_rows = db[table_name].count
+    dim = get_nlp().vocab.vectors_length
+    matrix = np.memmap(
+        vectors_path, dtype=np.float32, mode="w+", shape=(max(n_rows, 1), dim)
+    )
+    rowids = np.zeros(n_rows, dtype=np.int64)
+    select = ", ".join(f"[{field}]" for field in fields)
+    rows = db.query(f"select rowid as _rowid, {select} from [{table_name}] order by rowid")
+    i = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) < BATCH_SIZE:
+            continue
+        matrix[i:i + len(batch)] = embed_texts([row_text(r, fields) for r in batch])
+        rowids[i:i + len(batch)] = [r["_rowid"] for r in batch]
+        i += len(batch)
+        batch = []
+        print(f"Embedded {i}/{n_rows} rows from {table_name}", end="\r")
+    if batch:
+        matrix[i:i + len(batch)] = embed_texts([row_text(r, fields) for r in batch])
+        rowids[i:i + len(batch)] = [r["_rowid"] for r in batch]
+    matrix.flush()
+    np.save(rowids_path, rowids)
+    with open(meta_path, "w") as f:
+        f.write(json.dumps({
+            "model": SPACY_MODEL,
+            "dim": dim,
+            "n_rows": n_rows,
+            "fingerprint": table_fingerprint(db, table_name),
+        }))
+    _vector_indexes.pop(table_name, None)
+
+
+def build_vector_indexes(db, vectors_dir=VECTORS_DIR, force=False):
+    os.makedirs(vectors_dir, exist_ok=True)
+    built = []
+    for table_name in TABLE_FTS:
+        if table_name not in db.table_names():
+            print("Skipping missing table", table_name)
+            continue
+        if not force and not is_vector_index_stale(db, table_name, vectors_dir=vectors_dir):
+            print("Vector index is up to date for", table_name)
+            continue
+        print("Building vector index for", table_name, TABLE_FTS[table_name])
+        build_vector_index(db, table_name, vectors_dir=vectors_dir)
+        built.append(table_name)
+    return built
+
+
+def load_vector_index(table_name, vectors_dir=VECTORS_DIR):
+    if table_name in _vector_indexes:
+        return _vector_indexes[table_name]
+    meta = vector_meta(table_name, vectors_dir=vectors_dir)
+    if not meta:
+        return None
+    vectors_path, rowids_path, _ = vector_paths(table_name, vectors_dir=vectors_dir)
+    rowids = np.load(rowids_path)
+    matrix = np.memmap(
+        vectors_path, dtype=np.float32, mode="r",
+        shape=(max(meta["n_rows"], 1), meta["dim"])
+    )[:meta["n_rows"]]
+    _vector_indexes[table_name] = (rowids, matrix)
+    return _vector_indexes[table_name]
+
+
+def vector_search(db, table_name, query, limit=SEMANTIC_SEARCH_LIMIT,
+                  vectors_dir=VECTORS_DIR):
+    """
+    Find the rows whose text is most similar in meaning to the query.
+    Returns the row's primary key(s), the similarity and a snippet of the
+    text that was matched.
+    """
+    index = load_vector_index(table_name, vectors_dir=vectors_dir)
+    if index is None:
+        return None
+    rowids, matrix = index
+    if not len(rowids):
+        return []
+    query_vector = embed_texts([query])[0]
+    scores = matrix @ query_vector
+    k = min(limit, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+
+    fields = TABLE_FTS[table_name]
+    pks = db[table_name].pks
+    select = ", ".join(f"[{c}]" for c in dict.fromkeys(pks + fields))
+    results = []
+    for i in top:
+        rows = list(db.query(
+            f"select {select} from [{table_name}] where rowid = ?",
+            [int(rowids[i])]
+        ))
+        if not rows:
+            continue
+        row = rows[0]
+        result = {pk: row[pk] for pk in pks}
+        result["similarity"] = round(float(scores[i]), 3)
+        text = row_text(row, fields).replace("\n", " ")
+        if len(text) > SNIPPET_CHARS:
+            text = f"{text[:SNIPPET_CHARS].rstrip()}..."
+        result["snippet"] = text
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    db_path = args[0] if args else DB_PATH
+    force = "--force" in sys.argv
+    db = sqlite_utils.Database(db_path)
+    built = build_vector_indexes(db, force=force)
+    print("Built vector indexes for:", built)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""
+A local HTTP server that keeps models and database connections warm and
+answers questions, streaming the session back as Server-Sent Events:
+
+    python server.py --model dolphin-2.2.1-mistral-7b.Q5_K_M.gguf
+    curl -N -d '{"question": "How many users are there?"}' localhost:8000/ask
+
+Use --mock to run it with the mock LLM instead of a real model.
+"""
+import argparse
+import json
+import queue
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from actions import DB_PATH, load_db
+from autotune import load_runtime_profile
+from batched import BatchedEngine
+from llm_sql_queries import execute, load_model
+from mock_llm import MockLlama
+
+
+HOST = "127.0.0.1"
+PORT = 8000
+PROMPT_PATH = "example-prompt.txt"
+MODEL_PATH = "dolphin-2.2.1-mistral-7b.Q5_K_M.gguf"
+# each worker holds its own copy of the model (unless --batched), so keep
+# this low
+N_WORKERS = 1
+# questions waiting for a worker past this get turned away with a 503
+MAX_QUEUE_DEPTH = 8
+# how often (in seconds) a request waiting on events checks that the
+# workers haven't died
+EVENT_TIMEOUT = 5
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, question):
+        self.id = uuid.uuid4().hex
+        self.question = question
+        # events for the request handler to stream back
+        self.events = queue.Queue()
+        self.cancelled = False
+        # the Worker answering it, once one has picked it up
+        self.worker = None
+
+    def emit(self, event, data):
+        if self.cancelled:
+            raise JobCancelled()
+        self.events.put((event, data))
+
+
+class Worker(threading.Thread):
+    """
+    Owns a warm model and database connection and answers queued
+    questions one at a time.
+    """
+
+    def __init__(self, jobs, model_path, prompt_template, db_path=DB_PATH,
+                 mock=False, n_gpu_layers=0, engine=None, prompt_lookup=False,
+                 runtime_profile=None):
+        super().__init__(daemon=True)
+        self.jobs = jobs
+        self.model_path = model_path
+        self.prompt_template = prompt_template
+        self.db_path = db_path
+        self.mock = mock
+        self.n_gpu_layers = n_gpu_layers
+        # when set, share this engine's model instead of loading our own
+        self.engine = engine
+        self.prompt_lookup = prompt_lookup
+        self.runtime_profile = runtime_profile
+        self.ready = threading.Event()
+
+    def run(self):
+        if self.mock:
+            llm = MockLlama(model_path=self.model_path)
+        elif self.engine:
+            llm = self.engine.session()
+        else:
+            llm = load_model(self.model_path, n_gpu_layers=self.n_gpu_layers,
+                             prompt_lookup=self.prompt_lookup,
+                             runtime_profile=self.runtime_profile)
+        # sqlite connections have to stay on the thread that made them
+        db = load_db(self.db_path)
+        self.ready.set()
+        while True:
+            job = self.jobs.get()
+            job.worker = self
+            try:
+                self.answer(job, llm, db)
+            finally:
+                self.jobs.task_done()
+
+    def answer(self, job, llm, db):
+        if job.cancelled:
+            return
+        prompt = self.prompt_template.format(question=job.question.strip())
+        try:
+            job.emit("started", {"id": job.id})
+            answer, trace = execute(
+                self.model_path, debug=False, prompt=prompt,
+                llm=llm, db=db, on_event=job.emit
+            )
+            if answer:
+                answer = answer.replace("<|im_end|>", "").strip()
+            job.emit("done", {"id": job.id, "final_answer": answer})
+        except JobCancelled:
+            print("Cancelled job", job.id)
+        except Exception as e:
+            job.events.put(("error", {"id": job.id, "error": f"{e}"}))
+            job.events.put(("done", {"id": job.id, "final_answer": None}))
+
+
+def stalled_reason(job, workers):
+    # why a job that's gone quiet is never going to finish, or None if it
+    # still might
+    if job.worker is not None:
+        if not job.worker.is_alive():
+            return "The worker answering this question stopped"
+        return None
+    if not any(w.is_alive() for w in workers):
+        return "No workers are running"
+    return None
+
+
+class QuestionHandler(BaseHTTPRequestHandler):
+    # set on the server: jobs queue, workers
+    server_version = "ReasonActSQLite/0.1"
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_event(self, event, data):
+        self.wfile.write(
+            f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+        )
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self.send_json(404, {"error": "Not found"})
+        self.send_json(200, {
+            "workers": len(self.server.workers),
+            "ready": sum(w.ready.is_set() for w in self.server.workers),
+            "alive": sum(w.is_alive() for w in self.server.workers),
+            "queue_depth": self.server.jobs.qsize(),
+            "max_queue_depth": self.server.jobs.maxsize,
+        })
+
+    def do_POST(self):
+        if self.path != "/ask":
+            return self.send_json(404, {"error": "Not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            question = json.loads(self.rfile.read(length))["question"]
+        except (ValueError, KeyError, TypeError):
+            return self.send_json(400, {"error": "Expected JSON like {\"question\": \"...\"}"})
+
+        job = Job(question)
+        try:
+            self.server.jobs.put_nowait(job)
+        except queue.Full:
+            return self.send_json(503, {"error": "Too many questions queued"}, {
+                "Retry-After": "30",
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            self.send_event("queued", {
+                "id": job.id, "queue_depth": self.server.jobs.qsize()
+            })
+            while True:
+                try:
+                    event, data = job.events.get(timeout=EVENT_TIMEOUT)
+                except queue.Empty:
+                    reason = stalled_reason(job, self.server.workers)
+                    if not reason:
+                        continue
+                    job.cancelled = True
+                    self.send_event("error", {"id": job.id, "error": reason})
+                    self.send_event("done", {"id": job.id, "final_answer": None})
+                    break
+                self.send_event(event, data)
+                if event == "done":
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            # client went away, stop working on their question
+            job.cancelled = True
+
+
+def make_server(model_path, prompt_template, host=HOST, port=PORT,
+                n_workers=N_WORKERS, max_queue_depth=MAX_QUEUE_DEPTH,
+                db_path=DB_PATH, mock=False, n_gpu_layers=0, batched=False,
+                prompt_lookup=False, runtime_profile=None):
+    server = ThreadingHTTPServer((host, port), QuestionHandler)
+    server.daemon_threads = True
+    server.jobs = queue.Queue(maxsize=max_queue_depth)
+    engine = None
+    if batched and not mock:
+        # one copy of the model, with a sequence for each worker. the
+        # model's own context isn't used, so keep it small
+        llm = load_model(model_path, n_gpu_layers=n_gpu_layers, n_ctx=512,
+                         runtime_profile=runtime_profile)
+        engine = BatchedEngine(llm, n_seq=n_workers).start()
+    server.workers = [
+        Worker(server.jobs, model_path, prompt_template, db_path=db_path,
+               mock=mock, n_gpu_layers=n_gpu_layers, engine=engine,
+               prompt_lookup=prompt_lookup, runtime_profile=runtime_profile)
+        for _ in range(n_workers)
+    ]
+    for worker in server.workers:
+        worker.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer questions over HTTP with warm models")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--prompt", default=PROMPT_PATH,
+                        help="Prompt template file with a {question} placeholder")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=N_WORKERS)
+    parser.add_argument("--max-queue", type=int, default=MAX_QUEUE_DEPTH)
+    parser.add_argument("--n-gpu-layers", type=int, default=0)
+    parser.add_argument("--batched", action="store_true",
+                        help="Share one copy of the model between all of the workers, "
+                        "decoding their sessions together in batches")
+    parser.add_argument("--prompt-lookup", action="store_true",
+                        help="Speculative decoding with tokens guessed from the context "
+                        "(not used with --batched)")
+    parser.add_argument("--no-runtime-profile", action="store_true",
+                        help="Don't use the settings autotune.py found for the model")
+    parser.add_argument("--mock", action="store_true",
+                        help="Use the mock LLM instead of loading a model")
+    args = parser.parse_args()
+
+    with open(args.prompt, "r") as f:
+        prompt_template = f.read()
+
+    server = make_server(
+        args.model, prompt_template, host=args.host, port=args.port,
+        n_workers=args.workers, max_queue_depth=args.max_queue,
+        db_path=args.db, mock=args.mock, n_gpu_layers=args.n_gpu_layers,
+        batched=args.batched, prompt_lookup=args.prompt_lookup,
+        runtime_profile=(
+            None if args.no_runtime_profile else load_runtime_profile(args.model)
+        )
+    )
+    print(f"Listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,91 @@
+"""
+Prompt lookup decoding: instead of a separate draft model, guess the next
+few tokens by finding the last couple of generated tokens earlier in the
+context and proposing whatever followed them there. Table and column
+names, values from query results, etc get copied from the observations
+into the SQL and final answers all the time, so these guesses are right
+often. llama.cpp then checks all of the guessed tokens in one batch.
+
+    llm = load_model(model_path, prompt_lookup=True)
+    ...
+    print(llm.draft_model.stats())
+"""
+import numpy as np
+
+try:
+    from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+except ModuleNotFoundError:
+    print("llama_cpp not installed, continuing without")
+    LlamaPromptLookupDecoding = object
+
+
+# longest n-gram to look up in the context
+PROMPT_LOOKUP_NGRAM = 3
+# how many tokens to propose at a time. on CPU every extra one costs a
+# little, so don't go overboard
+PROMPT_LOOKUP_TOKENS = 10
+
+
+class PromptLookupDecoding(LlamaPromptLookupDecoding):
+    """
+    llama_cpp's prompt lookup draft model, but keeping count of how many
+    of its proposed tokens actually get accepted.
+    """
+
+    def __init__(self, max_ngram_size=PROMPT_LOOKUP_NGRAM,
+                 num_pred_tokens=PROMPT_LOOKUP_TOKENS):
+        super().__init__(
+            max_ngram_size=max_ngram_size, num_pred_tokens=num_pred_tokens
+        )
+        self.reset_stats()
+
+    def reset_stats(self):
+        # number of times we were asked for a draft (~ decode steps)
+        self.n_calls = 0
+        self.n_proposed = 0
+        self.n_accepted = 0
+        self.last_input = None
+        self.last_draft = None
+
+    def score_last_draft(self, input_ids):
+        # llama.cpp keeps whatever part of the draft matched what it sampled
+        # and the next call's input picks up from there, so that's how many
+        # were accepted. a new prompt (the next turn of a session) doesn't
+        # tell us anything about the old draft
+        if self.last_draft is None or not len(self.last_draft):
+            return
+        n_last = len(self.last_input)
+        if len(input_ids) <= n_last:
+            return
+        if not np.array_equal(input_ids[:n_last], self.last_input):
+            return
+        following = input_ids[n_last:n_last + len(self.last_draft)]
+        for proposed, actual in zip(self.last_draft, following):
+            if proposed != actual:
+                break
+            self.n_accepted += 1
+
+    def __call__(self, input_ids, /, **kwargs):
+        self.score_last_draft(input_ids)
+        draft = super().__call__(input_ids, **kwargs)
+        self.n_calls += 1
+        self.n_proposed += len(draft)
+        self.last_input = np.array(input_ids, copy=True)
+        self.last_draft = draft
+        return draft
+
+    def stats(self):
+        return {
+            "draft_calls": self.n_calls,
+            "proposed": self.n_proposed,
+            "accepted": self.n_accepted,
+            "acceptance_rate": (
+                round(self.n_accepted / self.n_proposed, 3)
+                if self.n_proposed else None
+            ),
+            # every step produces one sampled token plus the accepted ones
+            "tokens_per_step": (
+                round((self.n_calls + self.n_accepted) / self.n_calls, 3)
+                if self.n_calls else None
+            ),
+        }
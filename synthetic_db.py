@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+"""
+Generate a database with the same tables and columns as DATA_HELP
+(users, experiences, games, game_stats, game_passes and jobs) filled
+with made up but realistic looking data: skewed categories, JSON arrays
+of skills and links, free-text descriptions and IDs that join up. Handy
+for trying things out without example.db, and for seeing how the
+actions hold up on much bigger databases than it:
+
+    python synthetic_db.py synthetic.db --rows 1000000 [--seed 0] [--no-fts]
+
+Rows are generated and inserted in batches, so memory use stays flat no
+matter how many rows you ask for. 100M rows takes a few hours and around
+40GB of disk.
+"""
+import argparse
+import json
+import os
+import random
+from datetime import datetime, timedelta
+
+import sqlite_utils
+
+from fts import build_fts_indexes
+
+
+DB_PATH = "synthetic.db"
+# roughly how the rows get split between the tables
+TABLE_SHARES = {
+    "users": 0.2,
+    "experiences": 0.35,
+    "games": 0.1,
+    "game_stats": 0.1,
+    "game_passes": 0.15,
+    "jobs": 0.1,
+}
+BATCH_SIZE = 10000
+# everything happens between these dates
+START_DATE = datetime(2019, 1, 1)
+END_DATE = datetime(2023, 11, 1)
+
+SKILL_TYPES = [
+    "Scripter", "Builder", "Modeler", "UIDesigner", "Animator", "VFXArtist",
+    "SoundDesigner", "GameDesigner", "Clothing", "Translator", "Programmer",
+    "TextureArtist", "Composer", "Tester",
+]
+JOB_TYPES = ["Commission", "PartTime", "FullTime"]
+PAYMENT_TYPES = ["Robux", "Currency", "RevenuePercent"]
+PAYMENT_AMOUNT_TYPES = ["PerTask", "PerHour", "PerProject", "Total"]
+LINK_TYPES = ["Discord", "Twitter", "YouTube", "Twitch", "GitHub", "Guilded", "Email"]
+GENRES = [
+    "All Genres", "Adventure", "Town and City", "RPG", "Fighting",
+    "Obby", "Tutorial", "Horror", "Sports", "Comedy", "FPS", "Military",
+    "Naval", "Sci-Fi", "Building", "Western", "Medieval",
+]
+GAME_KINDS = [
+    "obby", "tycoon", "simulator", "roleplay", "racing game", "horror game",
+    "shooter", "tower defense", "battle royale", "survival game",
+    "pet game", "fashion show", "escape room", "parkour map",
+]
+GAME_WORDS = [
+    "Pizza", "Dragon", "Ninja", "Pet", "Zombie", "Speed", "Mega", "Super",
+    "Island", "City", "Space", "Candy", "Shadow", "Legends", "Kingdom",
+    "Factory", "Prison", "Hospital", "Mining", "Farming", "Robot", "Pirate",
+    "Galaxy", "Dungeon", "Castle", "Neon", "Blox", "Tower", "Arena", "Quest",
+]
+ROLES = [
+    "Lead Scripter", "Scripter", "Builder", "Lead Builder", "3D Modeler",
+    "UI Designer", "Animator", "Game Designer", "Project Manager",
+    "Sound Designer", "VFX Artist", "Owner", "Co-Owner", "Tester",
+]
+PASS_WORDS = [
+    "VIP", "2x Coins", "2x Speed", "Radio", "Gravity Coil", "Extra Slots",
+    "Admin Commands", "Pet Pack", "Starter Pack", "Auto Farm", "Skip Stage",
+    "Golden Sword", "Jetpack", "Private Server", "Double XP", "Infinite Ammo",
+]
+DESCRIPTION_PARTS = [
+    "I have been making games for {years} years",
+    "I am {age} years old",
+    "I specialize in {skill} work",
+    "mostly {kind} projects",
+    "I worked on {game} with over {visits} visits",
+    "open to commissions, paid in robux or USD",
+    "I can work {hours} hours a week",
+    "fast, reliable and easy to work with",
+    "check out my portfolio on {link}",
+    "I'm learning {skill} at the moment",
+    "my time zone is UTC{tz:+d}",
+    "looking for a long term team",
+]
+JOB_PARTS = [
+    "We are looking for an experienced {skill} to help with our {kind}",
+    "must have at least {years} years of experience",
+    "payment is {amount} {payment} per {unit}",
+    "you will be working with a team of {team} developers",
+    "the game currently has {visits} visits",
+    "please send examples of your past work",
+    "must be at least {age} years old",
+    "long term work available for the right person",
+]
+GAME_PARTS = [
+    "Welcome to {game}!",
+    "a {kind} where you can {verb} with your friends",
+    "{verb} your way to the top of the leaderboard",
+    "new update: {game} {version}",
+    "join the group for {bonus}",
+    "like and favorite for more updates",
+    "thanks for {visits} visits!",
+]
+VERBS = ["build", "explore", "race", "fight", "trade", "collect pets", "escape", "survive"]
+
+
+def skewed_choice(rng, values, skew=1.2):
+    # a few values are much more common than the rest, like real data
+    i = min(int(rng.paretovariate(skew)) - 1, len(values) - 1)
+    return values[i]
+
+
+def sample_skills(rng, max_n=4):
+    skills = []
+    for _ in range(rng.randint(1, max_n)):
+        skill = skewed_choice(rng, SKILL_TYPES)
+        if skill not in skills:
+            skills.append(skill)
+    return skills
+
+
+def random_date(rng, start=START_DATE, end=END_DATE):
+    seconds = (end - start).total_seconds()
+    return start + timedelta(seconds=rng.random() * seconds)
+
+
+def iso(date):
+    return date.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def short_date(date):
+    return f"{date.month}/{date.day}/{date.year}"
+
+
+def short_number(n):
+    # the human-readable numbers game_stats uses
+    for suffix, size in [("B+", 10**9), ("M+", 10**6), ("K+", 10**3)]:
+        if n >= size:
+            return f"{n / size:.1f}{suffix}"
+    return f"{n:,}"
+
+
+def game_name(rng):
+    return f"{rng.choice(GAME_WORDS)} {rng.choice(GAME_WORDS)} {skewed_choice(rng, GAME_KINDS).title()}"
+
+
+def fill(rng, parts, n_parts, **values):
+    defaults = {
+        "years": rng.randint(1, 12),
+        "age": rng.randint(13, 40),
+        "skill": skewed_choice(rng, SKILL_TYPES).lower(),
+        "kind": skewed_choice(rng, GAME_KINDS),
+        "game": f"{rng.choice(GAME_WORDS)} {rng.choice(GAME_WORDS)}",
+        "visits": short_number(int(rng.paretovariate(0.8) * 1000)),
+        "hours": rng.choice([5, 10, 20, 40]),
+        "link": rng.choice(LINK_TYPES),
+        "tz": rng.randint(-8, 10),
+        "amount": rng.choice([500, 1000, 2500, 10000, 50]),
+        "payment": rng.choice(["robux", "USD", "percent"]),
+        "unit": rng.choice(["task", "hour", "month", "model"]),
+        "team": rng.randint(2, 20),
+        "verb": rng.choice(VERBS),
+        "version": f"v{rng.randint(1, 9)}.{rng.randint(0, 20)}",
+        "bonus": rng.choice(["a free pet", "2x coins", "a chat tag"]),
+    }
+    defaults.update(values)
+    return ". ".join(
+        part.format(**defaults) for part in rng.sample(parts, n_parts)
+    ) + "."
+
+
+def table_sizes(total_rows):
+    sizes = {
+        table: max(1, int(total_rows * share))
+        for table, share in TABLE_SHARES.items()
+    }
+    # one stats row per game
+    sizes["game_stats"] = sizes["games"]
+    return sizes
+
+
+def users(rng, n):
+    for user_id in range(1, n + 1):
+        created = random_date(rng)
+        links = rng.sample(LINK_TYPES, rng.randint(0, 3))
+        yield {
+            "creatorUserId": user_id,
+            "createdUtc": iso(created),
+            "updatedUtc": iso(random_date(rng, start=created)),
+            "isPublic": 1,
+            "isContactAllowed": int(rng.random() < 0.8),
+            "creatorDescription": fill(rng, DESCRIPTION_PARTS, rng.randint(1, 5)),
+            "isOpenToWork": int(rng.random() < 0.6),
+            "interestDescription": f"I like {skewed_choice(rng, GAME_KINDS)}s and {skewed_choice(rng, GAME_KINDS)}s",
+            "linkTypes": json.dumps(links),
+            "preferredContactLinkType": links[0] if links else None,
+            "socialLinks": json.dumps([
+                {"type": link, "url": f"https://example.com/{link.lower()}/{user_id}"}
+                for link in links
+            ]),
+            "jobTypes": json.dumps(sorted(set(
+                skewed_choice(rng, JOB_TYPES) for _ in range(rng.randint(1, 3))
+            ))),
+            "skillTypes": json.dumps(sample_skills(rng)),
+            "requiresAction": "noAction",
+        }
+
+
+def games(rng, n, n_users):
+    for place_id in range(1, n + 1):
+        name = game_name(rng)
+        description = fill(rng, GAME_PARTS, rng.randint(2, 4), game=name)
+        yield {
+            "placeId": place_id,
+            "name": name,
+            "description": description,
+            "sourceName": name,
+            "sourceDescription": description,
+            "url": f"https://www.roblox.com/games/{place_id}/{name.replace(' ', '-')}",
+            "builder": f"user{rng.randint(1, n_users)}",
+            "builderId": rng.randint(1, n_users),
+            "hasVerifiedBadge": int(rng.random() < 0.05),
+            "isPlayable": int(rng.random() < 0.9),
+            "reasonProhibited": "None" if rng.random() < 0.9 else rng.choice(["UnderReview", "Private"]),
+            "universeId": place_id * 7 + 1000,
+            "universeRootPlaceId": place_id,
+            "price": 0 if rng.random() < 0.95 else rng.choice([25, 50, 100, 400]),
+            "imageToken": f"{rng.getrandbits(64):016x}",
+        }
+
+
+def game_stats(rng, n):
+    for place_id in range(1, n + 1):
+        visits = int(rng.paretovariate(0.6) * 100)
+        created = random_date(rng)
+        yield {
+            "placeId": place_id,
+            "Active": short_number(int(visits * rng.random() * 0.001)),
+            "Favorites": short_number(int(visits * rng.random() * 0.05)),
+            "Visits": short_number(visits),
+            "Created": short_date(created),
+            "Updated": short_date(random_date(rng, start=created)),
+            "Server Size": str(rng.choice([1, 6, 10, 12, 20, 30, 50, 100])),
+            "Genre": skewed_choice(rng, GENRES),
+            "Allowed Gear": "",
+        }
+
+
+def game_passes(rng, n, n_games):
+    for _ in range(n):
+        place_id = min(int(rng.paretovariate(0.5)), n_games)
+        name = rng.choice(PASS_WORDS)
+        yield {
+            "game_id": place_id,
+            "name": name,
+            "price": rng.choice([5, 25, 49, 99, 199, 499, 999]),
+            "seller_name": f"Game {place_id}",
+            "description": f"{name}! {rng.choice(['Get', 'Unlock', 'Buy'])} {rng.choice(PASS_WORDS).lower()} and {rng.choice(VERBS)} faster.",
+            "down": int(rng.paretovariate(1.5)) - 1,
+            "up": int(rng.paretovariate(0.9) * 3),
+        }
+
+
+def experiences(rng, n, n_users, n_games):
+    for experience_id in range(1, n + 1):
+        started = random_date(rng)
+        is_current = rng.random() < 0.3
+        place_id = min(int(rng.paretovariate(0.5)), n_games)
+        project = f"{rng.choice(GAME_WORDS)} {rng.choice(GAME_WORDS)}"
+        yield {
+            "experienceId": experience_id,
+            "creatorUserId": rng.randint(1, n_users),
+            "createdUtc": iso(started),
+            "updatedUtc": iso(random_date(rng, start=started)),
+            "projectName": project,
+            "experienceDescription": fill(rng, DESCRIPTION_PARTS, rng.randint(1, 4), game=project),
+            "jobRole": skewed_choice(rng, ROLES),
+            "experienceMedia": json.dumps([
+                {"title": f"{project} screenshot {i}", "mediaType": "Image"}
+                for i in range(rng.randint(0, 3))
+            ]),
+            "experienceLinks": json.dumps([
+                f"[{project}](https://www.roblox.com/games/{place_id})"
+            ]),
+            "teamName": f"{rng.choice(GAME_WORDS)} Studios" if rng.random() < 0.4 else None,
+            "teamId": rng.randint(1, max(1, n_users // 10)),
+            "startedUtc": iso(started),
+            "endedUtc": None if is_current else iso(random_date(rng, start=started)),
+            "isCurrent": int(is_current),
+        }
+
+
+def jobs(rng, n, n_users):
+    for job_id in range(1, n + 1):
+        published = random_date(rng)
+        skills = sample_skills(rng, max_n=3)
+        yield {
+            "id": job_id,
+            "jobPosterId": rng.randint(1, n_users),
+            "title": f"Looking for {skills[0]}" if rng.random() < 0.7 else f"{skills[0]} needed for {skewed_choice(rng, GAME_KINDS)}",
+            "description": fill(rng, JOB_PARTS, rng.randint(2, 5), skill=skills[0].lower()),
+            "jobType": skewed_choice(rng, JOB_TYPES),
+            "paymentTypes": json.dumps([skewed_choice(rng, PAYMENT_TYPES)]),
+            "skillTypes": json.dumps(skills),
+            "publishedUtc": iso(published),
+            "expiresUtc": iso(published + timedelta(days=30)),
+            "minAgeRequirement": rng.choice([0, 0, 13, 16, 18]),
+            "isVerifiedRequirement": "false",
+            "isVerified": rng.choice(["true", "false"]),
+            "paymentAmount": round(rng.paretovariate(1.1) * 100, 2),
+            "paymentAmountType": skewed_choice(rng, PAYMENT_AMOUNT_TYPES),
+        }
+
+
+def generate(path=DB_PATH, rows=100000, seed=0, fts=True):
+    """
+    Build a synthetic database at path with about this many rows in total.
+    Anything already at path is replaced.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    sizes = table_sizes(rows)
+    print("Generating", path, sizes)
+    db = sqlite_utils.Database(path)
+    # we can always generate it again, so don't bother being durable
+    db.execute("pragma journal_mode = off")
+    db.execute("pragma synchronous = off")
+    tables = [
+        ("users", users(rng, sizes["users"]), "creatorUserId"),
+        ("games", games(rng, sizes["games"], sizes["users"]), "placeId"),
+        ("game_stats", game_stats(rng, sizes["game_stats"]), None),
+        ("game_passes", game_passes(rng, sizes["game_passes"], sizes["games"]), None),
+        ("experiences", experiences(rng, sizes["experiences"], sizes["users"], sizes["games"]), "experienceId"),
+        ("jobs", jobs(rng, sizes["jobs"], sizes["users"]), "id"),
+    ]
+    for table_name, records, pk in tables:
+        print("Inserting", sizes[table_name], "rows into", table_name)
+        db[table_name].insert_all(records, pk=pk, batch_size=BATCH_SIZE)
+    if fts:
+        build_fts_indexes(db)
+    print("Running ANALYZE")
+    db.analyze()
+    db.execute("pragma journal_mode = delete")
+    return db
+
+
+def scale_name(rows):
+    # 10000 => 10k, 100000000 => 100M
+    for suffix, size in [("B", 10**9), ("M", 10**6), ("k", 10**3)]:
+        if rows >= size and rows % size == 0:
+            return f"{rows // size}{suffix}"
+    return str(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic database like example.db")
+    parser.add_argument("db_path", nargs="?", default=DB_PATH)
+    parser.add_argument("--rows", type=int, default=100000,
+                        help="About how many rows to generate across all tables")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-fts", action="store_true",
+                        help="Don't build the full-text search indexes")
+    args = parser.parse_args()
+    generate(args.db_path, rows=args.rows, seed=args.seed, fts=not args.no_fts)
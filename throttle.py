@@ -0,0 +1,169 @@
+"""
+Only pause between benchmark tries when the machine needs it, instead of
+sleeping a flat COOLDOWN after every one. Before each try we check the
+CPU temperature (from /sys) and how busy the CPUs are (from /proc/stat)
+and wait until both are under their targets, or MAX_PAUSE runs out:
+
+    THROTTLE:
+      MAX_TEMP: 75
+      MAX_BUSY: 0.9
+
+On machines where neither can be read we don't pause at all.
+"""
+import glob
+import os
+import time
+
+
+# degrees C
+MAX_TEMP = 75
+# fraction of all CPU time spent busy (0-1). other models running at the
+# same time (PACK_WORKERS) count too, so raise this if packing
+MAX_BUSY = 0.9
+# never pause for longer than this many seconds in one go
+MAX_PAUSE = 300
+POLL_INTERVAL = 5
+# how long to watch /proc/stat for when measuring how busy the CPUs are
+BUSY_SAMPLE_SECONDS = 1
+# thermal zones/hwmon sensors that are the CPU, others (wifi, battery,
+# NVMe) are ignored unless there's nothing else
+CPU_SENSORS = ["x86_pkg_temp", "coretemp", "k10temp", "zenpower", "cpu", "soc", "acpitz"]
+
+
+def read_file(path):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cpu_temperature():
+    """
+    The hottest CPU sensor in degrees C, or None if there aren't any we
+    can read.
+    """
+    cpu_temps = []
+    other_temps = []
+    sensors = [
+        (read_file(os.path.join(zone, "type")), os.path.join(zone, "temp"))
+        for zone in glob.glob("/sys/class/thermal/thermal_zone*")
+    ] + [
+        (read_file(os.path.join(os.path.dirname(temp), "name")), temp)
+        for temp in glob.glob("/sys/class/hwmon/hwmon*/temp*_input")
+    ]
+    for name, path in sensors:
+        value = read_file(path)
+        if not value or not value.lstrip("-").isdigit():
+            continue
+        # millidegrees
+        temp = int(value) / 1000
+        if name and any(name.lower().startswith(s) for s in CPU_SENSORS):
+            cpu_temps.append(temp)
+        else:
+            other_temps.append(temp)
+    temps = cpu_temps or other_temps
+    return max(temps) if temps else None
+
+
+def cpu_times():
+    # (busy, total) jiffies across all CPUs
+    line = read_file("/proc/stat")
+    if not line:
+        return None
+    fields = [int(v) for v in line.split("\n", 1)[0].split()[1:]]
+    # idle and iowait
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+    total = sum(fields)
+    return total - idle, total
+
+
+def cpu_busy(sample_seconds=BUSY_SAMPLE_SECONDS):
+    """
+    Fraction of CPU time spent busy over the next sample_seconds, or None
+    if /proc/stat isn't there.
+    """
+    before = cpu_times()
+    if before is None:
+        return None
+    time.sleep(sample_seconds)
+    after = cpu_times()
+    total = after[1] - before[1]
+    if not total:
+        return 0.0
+    return (after[0] - before[0]) / total
+
+
+class Throttle:
+    def __init__(self, max_temp=MAX_TEMP, max_busy=MAX_BUSY,
+                 max_pause=MAX_PAUSE, poll_interval=POLL_INTERVAL):
+        self.max_temp = max_temp
+        self.max_busy = max_busy
+        self.max_pause = max_pause
+        self.poll_interval = poll_interval
+
+    def why_wait(self):
+        """
+        Why we should keep waiting (e.g. "CPU at 82C"), or None if we
+        can carry on.
+        """
+        if self.max_temp is not None:
+            temp = cpu_temperature()
+            if temp is not None and temp > self.max_temp:
+                return f"CPU at {temp:.0f}C"
+        if self.max_busy is not None:
+            busy = cpu_busy()
+            if busy is not None and busy > self.max_busy:
+                return f"CPUs {busy:.0%} busy"
+        return None
+
+    def pause(self):
+        """
+        Wait until the machine is under its targets. Returns how many
+        seconds we waited.
+        """
+        start = time.time()
+        reason = self.why_wait()
+        if not reason:
+            return 0
+        print(f"Pausing, {reason}...")
+        while reason and time.time() - start < self.max_pause:
+            time.sleep(self.poll_interval)
+            reason = self.why_wait()
+        paused = time.time() - start
+        if reason:
+            print(f"Still {reason} after {paused:.0f}s, carrying on")
+        else:
+            print(f"Paused for {paused:.0f}s")
+        return paused
+
+
+class FixedCooldown:
+    # the old way, sleep the same amount every time
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def pause(self):
+        print(f"Cooling down for {self.seconds}s...")
+        time.sleep(self.seconds)
+        return self.seconds
+
+
+def make_throttle(cooldown=None, throttle=None):
+    """
+    A Throttle from the plan's THROTTLE settings (MAX_TEMP, MAX_BUSY,
+    MAX_PAUSE and POLL_INTERVAL), a FixedCooldown if there's only a
+    COOLDOWN, or None to never pause.
+    """
+    if throttle:
+        if throttle is True:
+            throttle = {}
+        return Throttle(
+            max_temp=throttle.get("MAX_TEMP", MAX_TEMP),
+            max_busy=throttle.get("MAX_BUSY", MAX_BUSY),
+            max_pause=throttle.get("MAX_PAUSE", MAX_PAUSE),
+            poll_interval=throttle.get("POLL_INTERVAL", POLL_INTERVAL),
+        )
+    if cooldown:
+        return FixedCooldown(cooldown)
+    return None
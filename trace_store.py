@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+"""
+A content addressed store for traces, instead of a tracefile per try that
+repeats the whole prompt every time. Traces are split into chunks: the
+system prompt and examples (everything before the real question), then
+the question and each turn as the session goes. Chunks are zlib
+compressed and stored once by their hash, so the prompt shared by every
+try is only stored once. Reading a trace only decompresses its own
+chunks.
+
+Traces are found by (experiment, question, try) and referred to (e.g. in
+an experiment's tracefiles) with a URI like:
+
+    ./traces/traces.db#EXPERIMENT_SQL_2023-11-01_model/3/0
+
+Move the tracefiles of old experiments into a store with:
+
+    python trace_store.py import [--experiments ./experiments/] [--store ./traces/traces.db]
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import zlib
+
+import sqlite_utils
+
+from db_profiles import connect, set_journal_mode
+
+
+TRACE_STORE_PATH = "./traces/traces.db"
+COMPRESSION_LEVEL = 6
+STORE_TABLES = {"blobs", "traces", "chunks"}
+
+
+def split_prefix(text):
+    # everything before the last question is the shared prompt
+    if "Question:" not in text:
+        return [text]
+    i = text.rindex("Question:")
+    return [c for c in (text[:i], text[i:]) if c]
+
+
+def split_messages(text):
+    # an OpenAI trace (a JSON list of messages, indent=2) gets rewritten
+    # every turn since the closing bracket moves, so give every message its
+    # own chunk. then only the new messages (and the one that got a comma)
+    # are new blobs
+    return [c for c in re.split(r"(?=\n  \{)|(?=\n\]$)", text) if c]
+
+
+def trace_uri(store_path, experiment, question, try_n):
+    return f"{store_path}#{experiment}/{question}/{try_n}"
+
+
+def is_trace_uri(tracefile):
+    return "#" in tracefile
+
+
+def parse_trace_uri(uri):
+    store_path, key = uri.split("#", 1)
+    experiment, question, try_n = key.rsplit("/", 2)
+    return store_path, experiment, int(question), int(try_n)
+
+
+def is_trace_store(path):
+    """
+    Whether a .db file is a trace store, checked without changing it
+    (opening a TraceStore creates its tables).
+    """
+    try:
+        db = connect(path, profile="read-only")
+        table_names = set(db.table_names())
+        db.conn.close()
+    except sqlite3.DatabaseError:
+        return False
+    return STORE_TABLES <= table_names
+
+
+class TraceStore:
+    def __init__(self, path=TRACE_STORE_PATH, read_only=False):
+        self.path = path
+        if read_only:
+            # for reading stores we didn't make, without touching them
+            self.db = connect(path, profile="read-only")
+            return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite_utils.Database(path)
+        # several benchmark processes can write at once
+        self.db.execute("pragma busy_timeout = 30000")
+        # a store can be shared by work_queue.py workers on several nodes
+        set_journal_mode(self.db)
+        if not self.db["blobs"].exists():
+            self.db["blobs"].create({
+                "hash": str, "data": bytes, "size": int,
+            }, pk="hash")
+        if not self.db["traces"].exists():
+            self.db["traces"].create({
+                "experiment": str, "question": int, "try": int,
+                "model": str, "size": int, "n_chunks": int,
+            }, pk=("experiment", "question", "try"))
+        if not self.db["chunks"].exists():
+            self.db["chunks"].create({
+                "experiment": str, "question": int, "try": int,
+                "n": int, "hash": str,
+            }, pk=("experiment", "question", "try", "n"))
+        # for finding blobs nothing uses anymore
+        self.db["chunks"].create_index(["hash"], if_not_exists=True)
+
+    def put_blob(self, text):
+        data = text.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        self.db.execute(
+            "insert or ignore into blobs (hash, data, size) values (?, ?, ?)",
+            [digest, zlib.compress(data, COMPRESSION_LEVEL), len(data)]
+        )
+        return digest
+
+    def delete_unused_blobs(self, hashes):
+        for digest in set(hashes):
+            self.db.execute(
+                "delete from blobs where hash = ? and not exists (select 1 from chunks where hash = ?)",
+                [digest, digest]
+            )
+
+    def get_blob(self, digest):
+        row = self.db.execute(
+            "select data from blobs where hash = ?", [digest]
+        ).fetchone()
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def write(self, experiment, question, try_n, chunks, model=None,
+              append=False):
+        """
+        Store a trace as the given chunks of text, or add them to the end
+        of what's already stored with append=True.
+        """
+        key = [experiment, question, try_n]
+        with self.db.conn:
+            trace = self.db.execute(
+                "select size, n_chunks from traces where experiment = ? and question = ? and try = ?",
+                key
+            ).fetchone()
+            size, n_chunks = trace if trace and append else (0, 0)
+            old_hashes = []
+            if not append:
+                old_hashes = [row[0] for row in self.db.execute(
+                    "select hash from chunks where experiment = ? and question = ? and try = ?",
+                    key
+                ).fetchall()]
+                self.db.execute(
+                    "delete from chunks where experiment = ? and question = ? and try = ?",
+                    key
+                )
+            for chunk in chunks:
+                digest = self.put_blob(chunk)
+                self.db.execute(
+                    "insert or replace into chunks values (?, ?, ?, ?, ?)",
+                    key + [n_chunks, digest]
+                )
+                n_chunks += 1
+                size += len(chunk.encode("utf-8"))
+            # the old version of a rewritten trace shouldn't stick around
+            self.delete_unused_blobs(old_hashes)
+            self.db["traces"].upsert({
+                "experiment": experiment, "question": question, "try": try_n,
+                "model": model, "size": size, "n_chunks": n_chunks,
+            }, pk=("experiment", "question", "try"))
+
+    def read(self, experiment, question, try_n):
+        hashes = self.db.execute(
+            "select hash from chunks where experiment = ? and question = ? and try = ? order by n",
+            [experiment, question, try_n]
+        ).fetchall()
+        if not hashes:
+            raise KeyError(f"No trace for {experiment} question {question} try {try_n}")
+        return "".join(self.get_blob(h) for h, in hashes)
+
+    def exists(self, experiment, question, try_n):
+        return bool(self.db.execute(
+            "select 1 from traces where experiment = ? and question = ? and try = ?",
+            [experiment, question, try_n]
+        ).fetchone())
+
+    def keys(self, experiment=None):
+        where = "where experiment = ?" if experiment else ""
+        return self.db.execute(
+            f"select experiment, question, try from traces {where} order by 1, 2, 3",
+            [experiment] if experiment else []
+        ).fetchall()
+
+    def stats(self):
+        traces_size = self.db.execute("select coalesce(sum(size), 0) from traces").fetchone()[0]
+        blobs_size, stored_size = self.db.execute(
+            "select coalesce(sum(size), 0), coalesce(sum(length(data)), 0) from blobs"
+        ).fetchone()
+        return {
+            "traces": self.db["traces"].count,
+            "blobs": self.db["blobs"].count,
+            "trace_bytes": traces_size,
+            "unique_bytes": blobs_size,
+            "stored_bytes": stored_size,
+        }
+
+
+class TraceWriter:
+    """
+    Can be given to the agents as their outfile. They write the whole
+    trace after every turn and this only stores what's new since the last
+    write. The store gets opened on the first write, so it's fine to
+    create these before starting a subprocess.
+    """
+
+    def __init__(self, store_path, experiment, question, try_n, model=None):
+        self.store_path = store_path
+        self.experiment = experiment
+        self.question = question
+        self.try_n = try_n
+        self.model = model
+        self.store = None
+        self.written = None
+
+    def write(self, text):
+        if self.store is None:
+            self.store = TraceStore(self.store_path)
+        key = [self.experiment, self.question, self.try_n]
+        if self.written and text.startswith(self.written):
+            delta = text[len(self.written):]
+            if delta:
+                self.store.write(*key, [delta], model=self.model, append=True)
+        elif text.startswith("["):
+            self.store.write(*key, split_messages(text), model=self.model)
+        else:
+            self.store.write(*key, split_prefix(text), model=self.model)
+        self.written = text
+
+    def __str__(self):
+        return trace_uri(self.store_path, self.experiment, self.question, self.try_n)
+
+
+_stores = {}
+
+
+def open_store(path):
+    # keep one connection per store around for reading lots of traces.
+    # only for reading, so it shouldn't create (or change) anything
+    if path not in _stores:
+        _stores[path] = TraceStore(path, read_only=True)
+    return _stores[path]
+
+
+def read_trace_uri(uri):
+    store_path, experiment, question, try_n = parse_trace_uri(uri)
+    return open_store(store_path).read(experiment, question, try_n)
+
+
+def trace_uri_exists(uri):
+    store_path, experiment, question, try_n = parse_trace_uri(uri)
+    if not os.path.exists(store_path):
+        return False
+    return open_store(store_path).exists(experiment, question, try_n)
+
+
+def import_experiments(experiments_dir, store_path=TRACE_STORE_PATH):
+    """
+    Move the tracefiles of every experiment into the store, pointing the
+    experiment's tracefiles at it instead. The tracefiles themselves are
+    left alone, delete them once you're happy.
+    """
+    store = TraceStore(store_path)
+    for filename in sorted(os.listdir(experiments_dir)):
+        if not filename.endswith(".json"):
+            continue
+        path = os.path.join(experiments_dir, filename)
+        with open(path, "r") as f:
+            try:
+                experiment = json.load(f)
+            except json.decoder.JSONDecodeError:
+                continue
+        name = filename[:-len(".json")]
+        n_imported = 0
+        for q_n, result in enumerate(experiment.get("question_results", [])):
+            tracefiles = result.get("tracefiles", [])
+            for i, tracefile in enumerate(tracefiles):
+                if not tracefile or is_trace_uri(tracefile):
+                    continue
+                if not os.path.exists(tracefile):
+                    continue
+                with open(tracefile, "r") as f:
+                    text = f.read()
+                chunks = split_messages(text) if text.startswith("[") else split_prefix(text)
+                store.write(
+                    name, q_n, i, chunks,
+                    model=experiment.get("model_name")
+                )
+                tracefiles[i] = trace_uri(store_path, name, q_n, i)
+                n_imported += 1
+        if n_imported:
+            print("Imported", n_imported, "traces from", filename)
+            with open(path, "w") as f:
+                f.write(json.dumps(experiment, indent=2))
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Store traces once instead of a file per try")
+    parser.add_argument("command", choices=["import", "stats"])
+    parser.add_argument("--experiments", default="./experiments/")
+    parser.add_argument("--store", default=TRACE_STORE_PATH)
+    args = parser.parse_args()
+
+    if args.command == "import":
+        store = import_experiments(args.experiments, store_path=args.store)
+    else:
+        store = TraceStore(args.store)
+    print(json.dumps(store.stats(), indent=2))
@@ -0,0 +1,110 @@
+import json
+import os
+import re
+from collections import Counter
+
+from trace_store import (
+    TraceStore, is_trace_store, is_trace_uri, read_trace_uri, trace_uri,
+    trace_uri_exists
+)
+
+
+TRACES_DIR = "./traces/"
+
+
+def read_trace(tracefile):
+    """
+    Get the text of a tracefile, or a trace in a trace store (see
+    trace_store.py). The llama.cpp agent writes the raw prompt while the
+    OpenAI agent writes the list of chat messages as JSON.
+    """
+    if is_trace_uri(tracefile):
+        text = read_trace_uri(tracefile)
+    else:
+        with open(tracefile, "r") as f:
+            text = f.read()
+    if text.startswith("["):
+        try:
+            messages = json.loads(text)
+        except json.decoder.JSONDecodeError:
+            return text
+        return "\n".join([m["content"] for m in messages])
+    return text
+
+
+def trace_exists(tracefile):
+    if is_trace_uri(tracefile):
+        return trace_uri_exists(tracefile)
+    return os.path.exists(tracefile)
+
+
+def iter_tracefiles(traces_dir=TRACES_DIR):
+    """
+    Every tracefile in the traces dir, and the URI of every trace in any
+    trace stores in there.
+    """
+    for basedir, subdirs, filenames in os.walk(traces_dir):
+        for filename in sorted(filenames):
+            path = os.path.join(basedir, filename)
+            if filename.endswith((".db-wal", ".db-shm")):
+                continue
+            if filename.endswith(".db"):
+                # other databases can end up in here too, leave them be
+                if not is_trace_store(path):
+                    continue
+                store = TraceStore(path, read_only=True)
+                for key in store.keys():
+                    yield trace_uri(path, *key)
+                store.db.conn.close()
+                continue
+            yield path
+
+
+def session_text(trace_text):
+    """
+    Cut off the system prompt and example traces, leaving only what
+    happened while answering the real question (the last one asked).
+    """
+    return trace_text.rsplit("Question:", 1)[-1]
+
+
+def extract_actions(trace_text):
+    """
+    All of the (action, [inputs]) the model ran in a trace, in order.
+    """
+    actions = []
+    steps = re.split(r"^Action: ", session_text(trace_text), flags=re.M)[1:]
+    for step in steps:
+        action = step.split("\n", 1)[0].strip()
+        step = re.split(
+            r"^(?:Observation|Thought):|<\|im_end\|>", step, flags=re.M
+        )[0]
+        inputs = re.findall(
+            r"Action Input (\d): ```([^`]+)```", step, re.M | re.S
+        )
+        # the OpenAI agent recovers inputs without backticks, too
+        if not inputs:
+            inputs = re.findall(
+                r"Action Input (\d): ([^`]+?)\s*(?=^Action Input|\Z)",
+                step, re.M | re.S
+            )
+        actions.append((action, [inp[1].strip() for inp in inputs]))
+    return actions
+
+
+def extract_sql_queries(traces_dir=TRACES_DIR):
+    """
+    Every sql-query the models ran across all tracefiles, with how many
+    times each one was run.
+    """
+    queries = Counter()
+    for tracefile in iter_tracefiles(traces_dir):
+        try:
+            trace_text = read_trace(tracefile)
+        except UnicodeDecodeError:
+            continue
+        for action, inputs in extract_actions(trace_text):
+            if action == "sql-query" and inputs:
+                query = re.sub(r"\s+", " ", inputs[0]).strip().rstrip(";")
+                queries[query] += 1
+    return queries
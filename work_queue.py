@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+"""
+Spread a benchmark run over as many machines (or processes) as you like
+with a queue of jobs in a shared SQLite file. Each job is one try of one
+question with one model:
+
+    python work_queue.py enqueue example-benchmark.yml --queue ./experiments/queue.db
+    python work_queue.py work --queue ./experiments/queue.db    # on every node
+    python work_queue.py status --queue ./experiments/queue.db
+    python work_queue.py assemble --queue ./experiments/queue.db
+
+Workers lease a job at a time and keep renewing the lease while the job
+runs. If a worker dies its lease runs out and the job goes to another
+worker, up to MAX_ATTEMPTS times. Results go back into the queue and
+assemble turns them into the usual ./experiments/ JSON, one file per
+model, same as benchmark_runner.py. Tries of a question that has
+already converged (EARLY_STOP_CI_WIDTH) get skipped.
+
+FORK_TRIES doesn't apply here, every try is its own job.
+
+The queue needs to be somewhere every node can get to with working file
+locking (and db_profiles.USE_WAL off unless every worker is on one
+host). Set TRACE_STORE in the plan to keep the traces in one place too,
+otherwise each node writes tracefiles to its own ./traces/.
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+import socket
+import threading
+import time
+
+import sqlite_utils
+
+import benchmark_runner
+from benchmark_runner import (
+    load_yml_file, get_model_name, model_prompt_type, get_tracefile,
+    experiment_settings, prepare_prompt, run_try, new_question_result, add_try,
+    finish_question_result, should_stop_early, save_experiment_data
+)
+from db_profiles import set_journal_mode
+from throttle import make_throttle
+from trace_store import TraceWriter
+
+
+QUEUE_PATH = "./experiments/queue.db"
+# a job goes back on the queue if its worker hasn't renewed the lease in
+# this many seconds
+LEASE_SECONDS = 120
+HEARTBEAT_INTERVAL = 30
+# give up on a job after it's been leased this many times
+MAX_ATTEMPTS = 3
+# how long an idle worker waits before looking for work again
+POLL_INTERVAL = 10
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    def __init__(self, path=QUEUE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # autocommit, so we can do our own begin immediate when leasing
+        self.db = sqlite_utils.Database(path)
+        self.db.conn.isolation_level = None
+        self.db.execute("pragma busy_timeout = 30000")
+        set_journal_mode(self.db)
+        if not self.db["plans"].exists():
+            self.db["plans"].create({
+                "experiment": str, "plan": str, "created": str,
+            }, pk="experiment")
+        if not self.db["jobs"].exists():
+            self.db["jobs"].create({
+                "id": int, "experiment": str, "model": int,
+                "question": int, "try": int,
+                # pending, running, done, skipped or failed
+                "status": str, "worker": str,
+                "lease_expires": float, "attempts": int,
+                "started": float, "finished": float,
+                "error": str, "tracefile": str, "result": str,
+            }, pk="id")
+            self.db["jobs"].create_index(
+                ["experiment", "model", "question", "try"], unique=True
+            )
+            self.db["jobs"].create_index(["status", "lease_expires"])
+
+    def enqueue(self, experiment_plan, experiment=None):
+        """
+        Add a job for every model, question and try in the plan. Jobs
+        already in the queue are left alone, so enqueueing the same plan
+        again (e.g. with a bigger N_TRIES) only adds what's missing.
+        """
+        if experiment is None:
+            today = datetime.now().strftime("%Y-%m-%d")
+            experiment = f"{experiment_plan['EXPERIMENT_NAME']}_{today}"
+        self.db["plans"].upsert({
+            "experiment": experiment,
+            "plan": json.dumps(experiment_plan),
+            "created": datetime.now().isoformat(),
+        }, pk="experiment")
+        n_tries = experiment_plan["N_TRIES"]
+        before = self.db["jobs"].count
+        with self.db.conn:
+            self.db.execute("begin")
+            for m_n, model_data in enumerate(experiment_plan["MODELS"]):
+                for q_n in range(len(experiment_plan["QA"])):
+                    for try_n in range(n_tries):
+                        self.db.execute("""
+                            insert or ignore into jobs
+                            (experiment, model, question, try, status, attempts)
+                            values (?, ?, ?, ?, 'pending', 0)
+                        """, [experiment, m_n, q_n, try_n])
+        print("Queued", self.db["jobs"].count - before, "jobs for", experiment)
+        return experiment
+
+    def plan(self, experiment):
+        row = self.db.execute(
+            "select plan from plans where experiment = ?", [experiment]
+        ).fetchone()
+        return json.loads(row[0])
+
+    def lease(self, worker, models=None):
+        """
+        Take the next pending job, or one whose lease has run out. Returns
+        the job's row, or None if there's nothing to do right now.
+        """
+        now = time.time()
+        where_model = ""
+        params = [now]
+        if models:
+            where_model = f"and model in ({', '.join('?' for _ in models)})"
+            params += list(models)
+        self.db.execute("begin immediate")
+        try:
+            # jobs that have run out of attempts aren't coming back
+            self.db.execute("""
+                update jobs set status = 'failed', worker = null,
+                error = 'Lease expired ' || attempts || ' times'
+                where status = 'running' and lease_expires < ? and attempts >= ?
+            """, [now, MAX_ATTEMPTS])
+            row = self.db.execute(f"""
+                select id from jobs
+                where (status = 'pending'
+                       or (status = 'running' and lease_expires < ?))
+                {where_model}
+                order by experiment, model, question, try
+                limit 1
+            """, params).fetchone()
+            if row is None:
+                self.db.execute("commit")
+                return None
+            self.db.execute("""
+                update jobs set status = 'running', worker = ?,
+                lease_expires = ?, attempts = attempts + 1, started = ?
+                where id = ?
+            """, [worker, now + LEASE_SECONDS, now, row[0]])
+            self.db.execute("commit")
+        except Exception:
+            self.db.execute("rollback")
+            raise
+        return self.db["jobs"].get(row[0])
+
+    def renew(self, job_id, worker):
+        # returns False if the job isn't ours anymore
+        cursor = self.db.execute("""
+            update jobs set lease_expires = ?
+            where id = ? and worker = ? and status = 'running'
+        """, [time.time() + LEASE_SECONDS, job_id, worker])
+        return cursor.rowcount == 1
+
+    def complete(self, job_id, worker, result, tracefile):
+        cursor = self.db.execute("""
+            update jobs set status = 'done', finished = ?, error = ?,
+            tracefile = ?, result = ?, lease_expires = null
+            where id = ? and worker = ? and status = 'running'
+        """, [
+            time.time(), result.get("error"), str(tracefile),
+            json.dumps(result, default=str), job_id, worker
+        ])
+        return cursor.rowcount == 1
+
+    def fail(self, job_id, worker, error, tracefile=None):
+        # the job blew up rather than just giving a wrong answer
+        cursor = self.db.execute("""
+            update jobs set status = 'failed', finished = ?, error = ?,
+            tracefile = ?, lease_expires = null
+            where id = ? and worker = ? and status = 'running'
+        """, [
+            time.time(), error, str(tracefile) if tracefile else None,
+            job_id, worker
+        ])
+        return cursor.rowcount == 1
+
+    def skip_question(self, experiment, model, question):
+        # the question has converged, don't bother with the rest of its tries
+        cursor = self.db.execute("""
+            update jobs set status = 'skipped'
+            where experiment = ? and model = ? and question = ?
+            and status = 'pending'
+        """, [experiment, model, question])
+        return cursor.rowcount
+
+    def results(self, experiment, model, question):
+        return list(self.db.query("""
+            select * from jobs
+            where experiment = ? and model = ? and question = ?
+            order by try
+        """, [experiment, model, question]))
+
+    def runtime_profiles(self, experiment, model):
+        # host => the runtime profile the model's jobs ran with there
+        profiles = {}
+        for row in self.db.execute("""
+            select result from jobs
+            where experiment = ? and model = ? and status = 'done'
+        """, [experiment, model]).fetchall():
+            result = json.loads(row[0])
+            if result.get("host") and result.get("runtime_profile"):
+                profiles[result["host"]] = result["runtime_profile"]
+        return profiles
+
+    def experiments(self):
+        return [row[0] for row in self.db.execute(
+            "select experiment from plans order by created"
+        ).fetchall()]
+
+    def status(self):
+        counts = {}
+        for experiment, status, count in self.db.execute("""
+            select experiment, status, count(*) from jobs
+            group by experiment, status order by experiment, status
+        """).fetchall():
+            counts.setdefault(experiment, {})[status] = count
+        return counts
+
+
+class Heartbeat(threading.Thread):
+    """
+    Keeps renewing a job's lease while it runs. Uses its own connection,
+    sqlite connections don't like being shared between threads.
+    """
+
+    def __init__(self, queue_path, job_id, worker):
+        super().__init__(daemon=True)
+        self.queue_path = queue_path
+        self.job_id = job_id
+        self.worker = worker
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        queue = WorkQueue(self.queue_path)
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            if not queue.renew(self.job_id, self.worker):
+                print(f"Lost the lease on job {self.job_id}")
+                self.lost = True
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def output_name(experiment, model_path):
+    # same naming as benchmark_runner.py
+    return f"{experiment}_{get_model_name(model_path)}"
+
+
+def question_result(queue, experiment, m_n, q_n, experiment_plan):
+    # build a question's results from its finished jobs, in try order
+    model_data = experiment_plan["MODELS"][m_n]
+    settings = experiment_settings(experiment_plan, model_data)
+    q_result = new_question_result(
+        experiment_plan["QA"][q_n], prompt_lookup=settings["prompt_lookup"]
+    )
+    jobs = queue.results(experiment, m_n, q_n)
+    for job in jobs:
+        if job["status"] == "done":
+            add_try(q_result, json.loads(job["result"]), job["tracefile"])
+        elif job["status"] == "failed":
+            add_try(q_result, {
+                "error": job["error"], "stop_reason": "error"
+            }, job["tracefile"])
+    if any(job["status"] == "skipped" for job in jobs):
+        q_result["stop_reason"] = "converged"
+    elif all(job["status"] in ("done", "failed") for job in jobs):
+        q_result["stop_reason"] = "n_tries"
+    return q_result
+
+
+def run_job(queue, job, worker, pause=True):
+    experiment = job["experiment"]
+    tracefile = None
+    error = None
+    heartbeat = Heartbeat(queue.path, job["id"], worker)
+    heartbeat.start()
+    try:
+        experiment_plan = queue.plan(experiment)
+        model_data = experiment_plan["MODELS"][job["model"]]
+        model_path = model_data["path"]
+        settings = experiment_settings(experiment_plan, model_data)
+        q_data = experiment_plan["QA"][job["question"]]
+
+        print("="*72)
+        print(f"Job {job['id']} (attempt {job['attempts']}):", model_path,
+              "question", job["question"], "try", job["try"])
+        prompt = prepare_prompt(
+            experiment_plan["PROMPT_DATA"], q_data["question"],
+            injectables=settings["injectables"],
+            prompt_type=model_prompt_type(model_data)
+        )
+        if settings["trace_store"]:
+            tracefile = TraceWriter(
+                settings["trace_store"], output_name(experiment, model_path),
+                job["question"], job["try"], model=get_model_name(model_path)
+            )
+        else:
+            tracefile = get_tracefile(model_path)
+        print("Writing to:", tracefile)
+
+        # let the machine cool down from the last job first, we already
+        # hold the lease so keep the heartbeat going while we wait
+        throttle = make_throttle(settings["cooldown"], settings["throttle"])
+        paused = throttle.pause() if throttle and pause else 0
+        result = run_try(
+            model_path, prompt, tracefile,
+            n_gpu_layers=settings["n_gpu_layers"],
+            timeout=settings["timeout"] or 30*60,
+            temp=settings["temp"], top_p=settings["top_p"],
+            inject_schema=settings["inject_schema"],
+            prompt_lookup=settings["prompt_lookup"],
+            max_repeats=settings["max_repeats"],
+            max_stale_turns=settings["max_stale_turns"],
+            runtime_profile=settings["runtime_profile"]
+        )
+        result["pause_seconds"] = paused
+        # the settings are per host, so assemble needs to know which
+        # ones this job ran with
+        result["host"] = socket.gethostname()
+        result["runtime_profile"] = settings["runtime_profile"]
+    except Exception as e:
+        # one broken job (a bad plan, a prompt that won't build, a model
+        # that won't load) shouldn't take the whole worker down with it
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        heartbeat.stop()
+
+    if error:
+        print(f"Job {job['id']} failed:", error)
+        if not heartbeat.lost:
+            queue.fail(job["id"], worker, error, tracefile)
+        return
+
+    if heartbeat.lost or not queue.complete(job["id"], worker, result, tracefile):
+        print(f"Job {job['id']} was taken over by another worker, dropping result")
+        return
+
+    # the tries we have so far might be enough for this question
+    q_result = question_result(
+        queue, experiment, job["model"], job["question"], experiment_plan
+    )
+    stop_reason = should_stop_early(
+        q_result, settings["early_stop_ci_width"],
+        min_tries=settings["early_stop_min_tries"]
+    )
+    if stop_reason:
+        n_skipped = queue.skip_question(experiment, job["model"], job["question"])
+        if n_skipped:
+            print(f"Question {job['question']} {stop_reason}, skipping {n_skipped} tries")
+
+
+def work(queue_path=QUEUE_PATH, models=None, once=False):
+    """
+    Run jobs until the queue is empty, or forever (waiting for more to
+    be queued) with once=False.
+    """
+    queue = WorkQueue(queue_path)
+    worker = worker_id()
+    print("Worker", worker, "starting on", queue_path)
+    nlp_loaded = False
+    first_job = True
+    while True:
+        job = queue.lease(worker, models=models)
+        if job is None:
+            if once:
+                print("Nothing left to do")
+                return
+            time.sleep(POLL_INTERVAL)
+            continue
+        if not nlp_loaded and benchmark_runner.USE_EXAMPLE_INJECTION:
+            benchmark_runner.load_nlp()
+            nlp_loaded = True
+        run_job(queue, job, worker, pause=not first_job)
+        first_job = False
+
+
+def assemble(queue_path=QUEUE_PATH, experiment=None, output_dir="./experiments/"):
+    """
+    Write the experiment JSON for each model from the queue's results,
+    including whatever is finished of an unfinished run.
+    """
+    queue = WorkQueue(queue_path)
+    outputs = []
+    for name in ([experiment] if experiment else queue.experiments()):
+        experiment_plan = queue.plan(name)
+        for m_n, model_data in enumerate(experiment_plan["MODELS"]):
+            model_path = model_data["path"]
+            settings = experiment_settings(experiment_plan, model_data)
+            experiment_data = {
+                "question_results": [],
+                "model_name": get_model_name(model_path),
+                "model_path": model_path,
+                "prompt": experiment_plan["PROMPT_DATA"],
+                "pause_seconds": 0,
+            }
+            # what the workers used, not what this host would use
+            runtime_profiles = queue.runtime_profiles(name, m_n)
+            if runtime_profiles:
+                experiment_data["runtime_profiles"] = runtime_profiles
+                distinct = {json.dumps(p, sort_keys=True) for p in runtime_profiles.values()}
+                if len(distinct) == 1:
+                    experiment_data["runtime_profile"] = next(iter(runtime_profiles.values()))
+            for q_n in range(len(experiment_plan["QA"])):
+                q_result = question_result(queue, name, m_n, q_n, experiment_plan)
+                if not q_result["scores"]:
+                    continue
+                finish_question_result(
+                    q_result,
+                    early_stop_ci_width=settings["early_stop_ci_width"],
+                    majority_vote=settings["majority_vote"]
+                )
+                experiment_data["question_results"].append(q_result)
+                experiment_data["pause_seconds"] += q_result["pause_seconds"]
+            if not experiment_data["question_results"]:
+                continue
+            experiment_output = os.path.join(
+                output_dir, output_name(name, model_path) + ".json"
+            )
+            save_experiment_data(experiment_output, experiment_data)
+            outputs.append(experiment_output)
+    return outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run benchmarks from a shared job queue")
+    parser.add_argument("command", choices=["enqueue", "work", "status", "assemble"])
+    parser.add_argument("experiment_plan_file", nargs="?",
+                        help="Experiment plan to enqueue")
+    parser.add_argument("--queue", default=QUEUE_PATH)
+    parser.add_argument("--experiment",
+                        help="Name to queue the plan under, or to assemble (default: all)")
+    parser.add_argument("--model", type=int, action="append",
+                        help="Only work on this model (index into the plan's MODELS), can be repeated")
+    parser.add_argument("--once", action="store_true",
+                        help="Exit once there's nothing left to do instead of waiting for more")
+    parser.add_argument("--output-dir", default="./experiments/")
+    args = parser.parse_args()
+
+    if args.command == "enqueue":
+        if not args.experiment_plan_file:
+            parser.error("enqueue needs an experiment_plan_file")
+        queue = WorkQueue(args.queue)
+        queue.enqueue(load_yml_file(args.experiment_plan_file), experiment=args.experiment)
+    elif args.command == "work":
+        work(args.queue, models=args.model, once=args.once)
+    elif args.command == "status":
+        print(json.dumps(WorkQueue(args.queue).status(), indent=2))
+    elif args.command == "assemble":
+        assemble(args.queue, experiment=args.experiment, output_dir=args.output_dir)
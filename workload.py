@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Capture the SQL the models actually ran (every sql-query in the traces,
+across all experiments) and replay it against a database, no LLM
+needed. Good for checking whether an index, a pragma or a connection
+profile change really made things faster:
+
+    python workload.py capture [--traces ./traces/] [--workload workload.json]
+    python workload.py replay example.db [--workload workload.json] [--profile read-only] [--concurrency 4] [--report replay.json]
+
+The workload is the deduplicated queries with how many times the models
+ran each one. Replay runs each query --repeats times, or with --weighted
+as many times as the models ran it, so the mix matches the real one.
+Pass an earlier replay's report as --baseline to compare against it.
+"""
+import argparse
+import json
+import queue
+import random
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+from db_profiles import DB_PROFILE, CONNECTION_PROFILES, connect
+from index_advisor import QUERY_TIMEOUT, time_query
+from traces import TRACES_DIR, extract_sql_queries
+
+
+WORKLOAD_PATH = "workload.json"
+REPEATS = 3
+PERCENTILES = [50, 95, 99]
+
+
+def capture(traces_dir=TRACES_DIR, workload_path=WORKLOAD_PATH):
+    queries = extract_sql_queries(traces_dir)
+    workload = {
+        "captured": datetime.now().isoformat(),
+        "traces": traces_dir,
+        "queries": [
+            {"query": query, "count": count}
+            for query, count in queries.most_common()
+        ],
+    }
+    print("Captured", len(queries), "unique queries from",
+          sum(queries.values()), "runs in", traces_dir)
+    with open(workload_path, "w") as f:
+        f.write(json.dumps(workload, indent=2))
+    return workload
+
+
+def load_workload(workload_path=WORKLOAD_PATH):
+    with open(workload_path, "r") as f:
+        return json.load(f)
+
+
+def replay_worker(db_path, profile, queries, jobs, timings, errors, timeout):
+    # every worker gets its own connection, like the agents do
+    db = connect(db_path, profile=profile)
+    while True:
+        try:
+            i = jobs.get_nowait()
+        except queue.Empty:
+            break
+        seconds = time_query(db, queries[i], timeout=timeout)
+        # lists are fine to append to from several threads
+        if seconds is None:
+            errors[i].append(1)
+        else:
+            timings[i].append(seconds)
+    db.conn.close()
+
+
+def replay(db_path, workload, profile=DB_PROFILE, concurrency=1,
+           repeats=REPEATS, weighted=False, timeout=QUERY_TIMEOUT, seed=0):
+    """
+    Run every query in the workload against the database, from
+    concurrency threads at once, in a shuffled order. Returns the per
+    query results and the totals.
+    """
+    queries = [q["query"] for q in workload["queries"]]
+    runs = []
+    for i, q in enumerate(workload["queries"]):
+        runs += [i] * (q["count"] if weighted else repeats)
+    random.Random(seed).shuffle(runs)
+    jobs = queue.Queue()
+    for i in runs:
+        jobs.put(i)
+
+    timings = [[] for _ in queries]
+    errors = [[] for _ in queries]
+    print(f"Replaying {len(runs)} runs of {len(queries)} queries against",
+          db_path, f"({profile}, concurrency {concurrency})")
+    start = time.perf_counter()
+    workers = [
+        threading.Thread(
+            target=replay_worker,
+            args=(db_path, profile, queries, jobs, timings, errors, timeout)
+        )
+        for _ in range(concurrency)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    wall_seconds = time.perf_counter() - start
+
+    results = []
+    for i, query in enumerate(queries):
+        result = {
+            "query": query,
+            "count": workload["queries"][i]["count"],
+            "runs": len(timings[i]),
+            "errors": len(errors[i]),
+        }
+        if timings[i]:
+            for p in PERCENTILES:
+                result[f"p{p}"] = float(np.percentile(timings[i], p))
+            result["max"] = max(timings[i])
+            result["total"] = sum(timings[i])
+        results.append(result)
+    all_timings = [t for ts in timings for t in ts]
+    totals = {
+        "db": db_path,
+        "profile": profile,
+        "concurrency": concurrency,
+        "runs": len(runs),
+        "errors": sum(len(e) for e in errors),
+        "wall_seconds": wall_seconds,
+        "query_seconds": sum(all_timings),
+        "queries_per_second": len(all_timings) / wall_seconds if wall_seconds else None,
+    }
+    for p in PERCENTILES:
+        totals[f"p{p}"] = float(np.percentile(all_timings, p)) if all_timings else None
+    return results, totals
+
+
+def replay_report(results, totals, baseline=None):
+    # baseline is an earlier replay report to compare the p50s against
+    before = {}
+    if baseline:
+        before = {r["query"]: r.get("p50") for r in baseline["queries"]}
+    print("=" * 72)
+    print("count\tp50\tp95\tp99\tbefore\tquery")
+    for r in sorted(results, key=lambda r: r.get("total", 0), reverse=True):
+        if not r["runs"]:
+            print(f"{r['count']}\terror\t\t\t\t{r['query'][:100]}")
+            continue
+        before_p50 = before.get(r["query"])
+        before_text = f"{before_p50:.4f}" if before_p50 is not None else "-"
+        print(f"{r['count']}\t{r['p50']:.4f}\t{r['p95']:.4f}\t{r['p99']:.4f}\t{before_text}\t{r['query'][:100]}")
+    print("=" * 72)
+    print(f"{totals['runs']} runs ({totals['errors']} errors) in {totals['wall_seconds']:.2f}s, "
+          f"{totals['query_seconds']:.2f}s of query time")
+    if totals["p50"] is not None:
+        print(f"p50 {totals['p50']:.4f}s, p95 {totals['p95']:.4f}s, p99 {totals['p99']:.4f}s, "
+              f"{totals['queries_per_second']:.1f} queries/s")
+    if baseline:
+        b = baseline["totals"]
+        print(f"baseline: {b['wall_seconds']:.2f}s wall, {b['query_seconds']:.2f}s of query time, "
+              f"p50 {b['p50'] or 0:.4f}s, p95 {b['p95'] or 0:.4f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Capture and replay the SQL the models ran")
+    parser.add_argument("command", choices=["capture", "replay"])
+    parser.add_argument("db_path", nargs="?", help="Database to replay against")
+    parser.add_argument("--traces", default=TRACES_DIR)
+    parser.add_argument("--workload", default=WORKLOAD_PATH)
+    parser.add_argument("--profile", default=DB_PROFILE, choices=list(CONNECTION_PROFILES))
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--weighted", action="store_true",
+                        help="Run each query as many times as the models did instead of --repeats times")
+    parser.add_argument("--timeout", type=int, default=QUERY_TIMEOUT)
+    parser.add_argument("--baseline", help="An earlier replay report to compare against")
+    parser.add_argument("--report", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.command == "capture":
+        capture(args.traces, args.workload)
+    else:
+        if not args.db_path:
+            parser.error("replay needs a db_path")
+        results, totals = replay(
+            args.db_path, load_workload(args.workload), profile=args.profile,
+            concurrency=args.concurrency, repeats=args.repeats,
+            weighted=args.weighted, timeout=args.timeout
+        )
+        baseline = None
+        if args.baseline:
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+        replay_report(results, totals, baseline=baseline)
+        if args.report:
+            with open(args.report, "w") as f:
+                f.write(json.dumps({"queries": results, "totals": totals}, indent=2))